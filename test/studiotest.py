@@ -1,20 +1,143 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import socket
+import threading
+import httplib
+import re
+import zlib
+import hashlib
+import json
+import urllib
 import urllib2
 import unittest
+import SocketServer
+import BaseHTTPServer
+from StringIO import StringIO
 import mox
 from mox import IsA
 
 import studioapi
+import studiotypes
+import studioreconcile
+import studiocatalogue
+import studiodiff
+import studiod
+import studiosync
+import studiomirror
+import studiobuilds
+import studioasync
+
+
+class FixtureServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves the fixtures on 127.0.0.1 the way ReplayHandler maps them
+
+    script maps a path regex to a list of (status, body) answers given
+    before the fixture, a body that is a list is sent in chunks and a
+    status of None closes the connection without an answer.  delay is added to every answer.  requests, connections and
+    the highest number of concurrent requests are recorded.  Connections
+    are kept
+    alive unless the client asks otherwise.
+    """
+    daemon_threads = True
+    request_queue_size = 64
+
+    def __init__(self, resdir):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FixtureRequestHandler)
+        self.resdir = resdir
+        self.routes = [(re.compile('(%s)$' % method), re.compile('(%s)$' % path),
+                        filename)
+                       for method, path, filename in studioapi.ReplayHandler.routes]
+        self.script = {}
+        self.delay = 0
+        self.requests = []
+        self.connections = 0
+        self.concurrent = self.max_concurrent = 0
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def handle_error(self, request, client_address):
+        # clients that time out or hang up aren't the server's problem
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                                                   client_address)
+
+    def answer(self, method, path):
+        with self.lock:
+            self.requests.append((method, path))
+            for pattern, answers in self.script.items():
+                if re.search(pattern, path) and answers:
+                    return answers.pop(0)
+        path = path.split('?')[0]
+        if path.startswith('/api/v1'):
+            path = path[len('/api/v1'):]
+        for methods, paths, filename in self.routes:
+            if methods.match(method) and paths.match(path):
+                return 200, open(os.path.join(self.resdir, filename)).read()
+        return 404, '<error><code>not_found</code></error>'
+
+
+class FixtureRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def handle_one(self):
+        server = self.server
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self.rfile.read(length)
+        with server.lock:
+            server.concurrent += 1
+            server.max_concurrent = max(server.max_concurrent,
+                                        server.concurrent)
+        try:
+            time.sleep(server.delay)
+            status, body = server.answer(self.command, self.path)
+        finally:
+            with server.lock:
+                server.concurrent -= 1
+        if status is None:
+            self.close_connection = 1
+            return
+        self.send_response(status)
+        if isinstance(body, list):
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in body + ['']:
+                self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+            return
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_one
+
+    def log_message(self, *args):
+        pass
 
 
 class StudioTest(mox.MoxTestBase):
     def __init__(self, methodName):
         mox.MoxTestBase.__init__(self, methodName)
-        self.resdir = '/home/chorler/projects/src/PySUSEStudio/test/responses'
+        self.resdir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'responses')
 
     def setUp(self):
         mox.MoxTestBase.setUp(self)
         self.connection = studioapi.BaseConnection(
-            'http://www.nostudio.com', 'api/v1')
+            'http://www.nostudio.com', 'api/v1',
+            transport=studioapi.ReplayHandler(self.resdir))
         self.studio = studioapi.StudioAPI(self.connection)
                                             
     def test_get_api_key(self):
@@ -34,11 +157,1014 @@ class StudioTest(mox.MoxTestBase):
         
         
         self.mox.VerifyAll()
+
+    def test_connection_pool_reuse(self):
+        class FakeConnection:
+            def __init__(self):
+                self.sock, self.peer = socket.socketpair()
+            def close(self):
+                self.sock = None
+        pool = studioapi.ConnectionPool(maxsize=1)
+        key = ('http', 'www.nostudio.com')
+        conn, reused = pool.acquire(key, FakeConnection)
+        self.assertFalse(reused)
+        pool.release(key, conn)
+        self.assertEqual(pool.acquire(key, FakeConnection), (conn, True))
+        pool.release(key, conn)
+        conn.peer.close()   # server side hangs up while idle
+        self.assertFalse(pool.acquire(key, FakeConnection)[0] is conn)
+
+    def test_keepalive_replay(self):
+        server = FixtureServer(self.resdir)
+        try:
+            opener = urllib2.build_opener(studioapi.KeepAliveHandler())
+            url = server.url() + '/api/v1/user/appliances'
+            appliances = open('%s/appliances.xml' % self.resdir).read()
+            self.assertEqual(opener.open(url).read(), appliances)
+            # a GET the idle connection dropped is sent on a fresh one
+            server.script['/appliances$'] = [(None, '')]
+            self.assertEqual(opener.open(url).read(), appliances)
+            self.assertEqual(len(server.requests), 3)
+            # a POST is sent once, the server may have acted on it
+            self.assertEqual(opener.open(url).read(), appliances)
+            server.script['/running_builds$'] = [(None, '')]
+            post = studioapi.HTTPPostRequest(
+                server.url() + '/api/v1/user/running_builds', 'appliance_id=1')
+            self.assertRaises(urllib2.URLError, opener.open, post)
+            self.assertEqual(server.requests[3:],
+                [('GET', '/api/v1/user/appliances'),
+                 ('POST', '/api/v1/user/running_builds')])
+            # and nothing that timed out is sent again
+            self.assertEqual(opener.open(url).read(), appliances)
+            server.delay = 0.3
+            self.assertRaises(urllib2.URLError, opener.open, url, None, 0.1)
+            time.sleep(0.5)
+            self.assertEqual(len(server.requests), 7)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_multipart_encode_streams(self):
+        rpm = open('%s/rpm.xml' % self.resdir, 'rb')
+        boundary, body = studioapi.MultipartPostHandler.multipart_encode(
+            [('base_system', 'SLES11_SP1')], [('file', rpm)], 'BOUNDARY')
+        data = body.read(7) + body.read()
+        self.assertEqual(len(data), len(body))
+        self.assertTrue(data.endswith('</rpm>\n\r\n--BOUNDARY--\r\n\r\n'))
+        body.seek(0)
+        self.assertEqual(body.read(), data)
+
+    def test_checksums(self):
+        rpm = studioapi.ET.parse('%s/rpm.xml' % self.resdir).getroot()
+        self.assertEqual(studioapi._checksums(rpm),
+            {'md5': '111395637da8b6530b74953d2994c86f'})
+        build = studioapi.ET.parse('%s/build.xml' % self.resdir).getroot()
+        self.assertEqual(studioapi._checksums(build),
+            {'md5': 'a0f0217f0645099c9e41c42e9bf89976',
+             'sha1': '9c984b05f9301e70cd72aa44b8fd9f12b920fde6'})
+
+    def test_retry_policy(self):
+        policy = studioapi.RetryPolicy(retries=2, backoff=1, max_backoff=10)
+        get = urllib2.Request('http://localhost/api/v1/user/appliances')
+        post = urllib2.Request(get.get_full_url(), data='x')
+        def error(code, retry_after=None):
+            headers = httplib.HTTPMessage(StringIO(
+                retry_after and 'Retry-After: %s\r\n' % retry_after or ''))
+            return urllib2.HTTPError(get.get_full_url(), code, '', headers,
+                                     StringIO(''))
+        self.assertTrue(0 <= policy.delay(get, 1, error(503)) <= 2)
+        self.assertEqual(policy.delay(get, 0, error(429, '7')), 7)
+        self.assertEqual(policy.delay(get, 0, error(429, '60')), None)
+        self.assertEqual(policy.delay(get, 2, error(503)), None)
+        self.assertEqual(policy.delay(get, 0, error(404)), None)
+        self.assertEqual(policy.delay(post, 0, error(503)), None)
+
+        breaker = studioapi.CircuitBreaker(threshold=2, reset_timeout=60)
+        breaker.failure('localhost')
+        breaker.check('localhost')
+        breaker.failure('localhost')
+        self.assertRaises(studioapi.StudioError, breaker.check, 'localhost')
+
+        # one trial at a time, a released trial lets the next one through
+        breaker = studioapi.CircuitBreaker(threshold=1, reset_timeout=0)
+        breaker.failure('www.nostudio.com')
+        self.assertTrue(breaker.check('www.nostudio.com'))
+        self.assertRaises(studioapi.StudioError, breaker.check,
+                          'www.nostudio.com')
+        breaker.release('www.nostudio.com')
+        self.assertTrue(breaker.check('www.nostudio.com'))
+        breaker.release('www.nostudio.com')
+        # an exception outside success / failure gives the trial back
+        studio = studioapi.StudioAPI(self.connection, breaker=breaker)
+        class BrokenLimiter:
+            def acquire(self, request):
+                raise KeyboardInterrupt
+        studio.limiter = BrokenLimiter()
+        self.assertRaises(KeyboardInterrupt, studio.get_api_version)
+        studio.limiter = None
+        self.assertEqual(studio.get_api_version().text, '1.0')
+        self.assertFalse(breaker.check('www.nostudio.com'))
+
+    def test_rate_limiter(self):
+        get = urllib2.Request('http://studio/api/v1/user/appliances')
+        post = studioapi.HTTPPostRequest('http://studio/api/v1/user/rpms', '')
+        limiter = studioapi.RateLimiter(rate=10, burst=2,
+                                        limits={(None, 'POST'): (1, 1)})
+        waits = [limiter.reserve(get) for i in range(4)]
+        self.assertEqual(waits[:2], [0, 0])
+        self.assertAlmostEqual(waits[3], 0.2, 2)
+        # POSTs take from the host bucket and their own
+        self.assertAlmostEqual(limiter.reserve(post), 0.3, 2)
+        self.assertAlmostEqual(limiter.reserve(post), 1, 2)
+        limiter.throttled(get, 5)
+        self.assertTrue(limiter.reserve(get) > 5)
+
+        path = os.path.join(tempfile.mkdtemp(), 'limits')
+        try:
+            first = studioapi.RateLimiter(rate=10, burst=1, path=path)
+            second = studioapi.RateLimiter(rate=10, burst=1, path=path)
+            self.assertEqual(first.reserve(get), 0)
+            self.assertAlmostEqual(second.reserve(get), 0.1, 2)
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+        self.studio.limiter = studioapi.RateLimiter(rate=1000)
+        self.studio.get_api_version()
+        self.assertEqual(self.studio.limiter._buckets.keys(),
+                         ['www.nostudio.com *'])
+
+    def test_batch(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'most': 0, 'calls': []}
+        def call(item, delay=0):
+            with lock:
+                state['calls'].append(item)
+                state['running'] += 1
+                state['most'] = max(state['most'], state['running'])
+            try:
+                time.sleep(delay)
+                if item % 3 == 0:
+                    raise studioapi.StudioError, 'bad %d' % item
+                return item * 10
+            finally:
+                with lock:
+                    state['running'] -= 1
+
+        # completion order, per item errors, bounded by max_workers
+        ids = [(i, 0.02 * (8 - i)) for i in range(1, 9)]
+        results = list(self.studio.batch(call, ids, max_workers=3))
+        self.assertEqual(sorted(r[0] for r in results), ids)
+        self.assertEqual(state['most'], 3)
+        for item, result, error in results:
+            if item[0] % 3 == 0:
+                self.assertEqual(result, None)
+                self.assertEqual(str(error), 'bad %d' % item[0])
+            else:
+                self.assertEqual((result, error), (item[0] * 10, None))
+        # the slow first calls finish after the quicker later ones
+        order = [r[0][0] for r in results]
+        self.assertTrue(order.index(1) > order.index(3))
+
+        # names work too, and an empty batch yields nothing
+        status = list(self.studio.batch('get_appliance_status', [266657]))
+        self.assertEqual(status[0][1].findtext('state'), 'ok')
+        self.assertEqual(list(self.studio.batch(call, [])), [])
+
+        # closing early starts no more calls and leaves no live threads
+        del state['calls'][:]
+        before = set(threading.enumerate())
+        results = self.studio.batch(call, [(i, 0.05) for i in range(1, 21)],
+                                    max_workers=2)
+        results.next()
+        workers = set(threading.enumerate()) - before
+        self.assertTrue(workers)
+        self.assertEqual([t for t in workers if not t.daemon], [])
+        results.close()
+        time.sleep(0.2)
+        self.assertTrue(len(state['calls']) <= 4)
+        self.assertEqual([t for t in workers if t.is_alive()], [])
+
+    def test_single_flight(self):
+        flight = studioapi.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return '<status/>'
+        results = []
+        leader = threading.Thread(
+            target=lambda: results.append(flight.do('url', fetch)))
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(
+            target=lambda: results.append(flight.do('url', fetch)))
+            for i in range(3)]
+        for t in followers:
+            t.start()
+        while flight.stats['shared'] < 3:
+            time.sleep(0.01)
+        release.set()
+        for t in [leader] + followers:
+            t.join()
+        self.assertEqual(results, ['<status/>'] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.do('url', lambda: 'again'), 'again')
+
+        # with share, only the threads that joined get a copy
+        copies = []
+        def share(result):
+            copies.append(result)
+            return list(result)
+        release.clear()
+        results = []
+        leader = threading.Thread(target=lambda: results.append(
+            flight.do('url', lambda: (release.wait(), ['tree'])[1], share)))
+        leader.start()
+        while not flight._calls:
+            time.sleep(0.01)
+        follower = threading.Thread(target=lambda: results.append(
+            flight.do('url', fetch, share)))
+        follower.start()
+        while flight.stats['shared'] < 4:
+            time.sleep(0.01)
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(results, [['tree'], ['tree']])
+        self.assertFalse(results[0] is results[1])
+        self.assertEqual(len(copies), 1)
+        self.assertEqual(flight.do('url', lambda: ['tree'], share), ['tree'])
+        self.assertEqual(len(copies), 1)
+
+    def test_coalesced_get_streams(self):
+        body = '<software>%s</software>' % (
+            '<package version="1.0">p</package>' * 20000)
+        reads = []
+        class Streamed(StringIO):
+            def read(self, size=-1):
+                if size is None or size < 0:
+                    raise AssertionError('response read in one piece')
+                reads.append(size)
+                return StringIO.read(self, size)
+            def close(self):
+                pass
+        self.studio._urlopen = lambda request: Streamed(body)
+        software = self.studio.get_appliance_software(266657)
+        self.assertEqual(len(software), 20000)
+        self.assertTrue(len(reads) > 1)
+
+    def test_instrumentation(self):
+        observed = []
+        instrumentation = studioapi.Instrumentation(
+            hooks=[lambda metric, labels, value: observed.append(metric)])
+        studio = studioapi.StudioAPI(self.connection,
+                                     instrumentation=instrumentation)
+        studio.get_appliance_status(266657)
+        studio.get_appliance_status(266658)
+        self.assertRaises(urllib2.HTTPError, studio.get_account)
+        self.assertEqual(sorted(set(observed)), ['parse_seconds',
+            'request_seconds', 'requests', 'response_bytes'])
+        text = instrumentation.export()
+        self.assertTrue('# TYPE studio_response_bytes histogram' in text)
+        self.assertTrue('studio_response_bytes_count{endpoint='
+            '"/user/appliances/:id/status",verb="GET"} 2' in text)
+        self.assertTrue('studio_requests_total{endpoint="/user/account",'
+            'verb="GET",status="404"} 1' in text)
+
+    def test_decompression(self):
+        xml = open('%s/software_installed.xml' % self.resdir).read()
+        handler = studioapi.DecompressionHandler()
+        request = urllib2.Request('http://www.nostudio.com/api/v1')
+        handler.http_request(request)
+        self.assertEqual(request.get_header('Accept-encoding'), 'gzip, deflate')
+
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress(xml) + compressor.flush()
+        headers = httplib.HTTPMessage(StringIO(
+            'Content-Encoding: gzip\r\nContent-Length: %d\r\n' % len(body)))
+        response = urllib.addinfourl(StringIO(body), headers,
+                                     request.get_full_url())
+        response.code, response.msg = 200, 'OK'
+        response = handler.http_response(request, response)
+        self.assertEqual(response.info().getheader('Content-Encoding'), None)
+        root = studioapi.ET.parse(response).getroot()
+        self.assertEqual(root.tag, 'software_map')
+
+    def test_package_catalogue(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'catalogue.json')
+            catalogue = studiocatalogue.PackageCatalogue(path)
+            self.assertEqual(catalogue.refresh_installed(self.studio, 214486),
+                             [6347, 6349, 6351, 7860])
+            self.assertEqual(len(catalogue), 608)
+            self.assertTrue(catalogue.available('vim', repository_id=6347))
+            self.assertFalse(catalogue.available('vim', repository_id=6349))
+            self.assertFalse(catalogue.available('emacs'))
+            self.assertTrue('yast2-core' in [p.name for p in
+                                             catalogue.prefix('name', 'yast2-')])
+            self.assertTrue(all('python' in p.name for p in
+                                catalogue.search('name', 'python')))
+            catalogue.save()
+
+            loaded = studiocatalogue.PackageCatalogue(path)
+            self.assertEqual(loaded.find(name='vim'), catalogue.find(name='vim'))
+            loaded.remove_repository(6347)
+            self.assertFalse(loaded.available('vim'))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_repository_catalogue(self):
+        path = os.path.join(tempfile.mkdtemp(), 'repositories.json')
+        try:
+            fetched = []
+            get_repositories = self.studio.get_repositories
+            def counting(base_system=''):
+                fetched.append(base_system)
+                return get_repositories(base_system)
+            self.studio.get_repositories = counting
+            catalogue = studiocatalogue.RepositoryCatalogue(self.studio, path)
+            self.assertEqual([r.id for r in catalogue.search(
+                'sp1 updates', base_system='SLES11_SP1')], [6345])
+            self.assertEqual([r.id for r in catalogue.find(
+                base_system='SLES11_SP1', name='SLES 11 SP1 i386')], [6343])
+            self.assertEqual([r.id for r in catalogue.find(
+                base_system='SLES11_SP1', name='sles 11 sp1 I386')], [6343])
+            self.assertEqual(catalogue.info(6351).name, 'SLE 11 SP1 SDK i386')
+            self.assertEqual(fetched, ['SLES11_SP1'])
+            catalogue.save()
+            loaded = studiocatalogue.RepositoryCatalogue(self.studio, path)
+            self.assertEqual(loaded.repositories('SLES11_SP1'),
+                             catalogue.repositories('SLES11_SP1'))
+            self.assertEqual(fetched, ['SLES11_SP1'])
+            loaded.ttl = -1
+            self.assertTrue('SLES11_SP1' in loaded.stale())
+            loaded.repositories()
+            self.assertEqual(fetched, ['SLES11_SP1', ''])
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_software_diff(self):
+        comparer = studiodiff.SoftwareComparer(self.studio)
+        diff = comparer.compare(214486, 100, 101)
+        self.assertFalse(diff)
+        software = comparer.software([(214486, 100)])[('214486', '100')]
+        self.assertEqual(software[('vim', 'i586')], '7.2-8.8')
+
+        new = dict(software)
+        del new[('vim', 'i586')]
+        new[('emacs', 'i586')] = '22.3-4.42'
+        new[('zypper', 'i586')] = '1.0'
+        diff = studiodiff.SoftwareDiff(software, new)
+        self.assertEqual(diff.added, [('emacs', 'i586', '22.3-4.42')])
+        self.assertEqual(diff.removed, [('vim', 'i586', '7.2-8.8')])
+        self.assertEqual([c[0] for c in diff.changed], ['zypper'])
+        # finished builds are served from the cache
+        def fetch(*args):
+            self.fail('fetched a cached build')
+        self.studio.iter_appliance_installed_software = fetch
+        self.assertFalse(comparer.compare(214486, 101, 100))
+
+        # builds that aren't finished are fetched every time, a package
+        # without a version compares as ''
+        def get_build_info(build_id, cached=True):
+            self.assertFalse(cached)
+            return studioapi.ET.fromstring(
+                '<build><state>running</state></build>')
+        self.studio.get_build_info = get_build_info
+        package = studioapi.ET.fromstring(
+            '<package arch="noarch">branding</package>')
+        fetched = []
+        def fetch(appliance_id, build_id):
+            fetched.append(build_id)
+            return iter([(None, package), (None, package), (None, other)])
+        self.studio.iter_appliance_installed_software = fetch
+        other = studioapi.ET.fromstring(
+            '<package arch="i586">branding</package>')
+        for i in range(2):
+            self.assertEqual(comparer.software([(214486, 102)]),
+                {('214486', '102'): {('branding', 'noarch'): '',
+                                     ('branding', 'i586'): ''}})
+        self.assertEqual(fetched, ['102', '102'])
+        other.set('arch', 'noarch')
+        other.set('version', '1.0')
+        self.assertEqual(comparer.software([(214486, 102)])[
+            ('214486', '102')], {('branding', 'noarch'): '1.0'})
+
+    def test_resumable_download(self):
+        blob = ''.join(chr(i % 253) for i in range(50000))
+        class FileHandler(urllib2.BaseHandler):
+            handler_order = 350
+            ranges = True
+            etag = '"v1"'
+            cut = None
+            requests = []
+            def http_open(self, req):
+                if '/download/' not in req.get_full_url():
+                    return None
+                self.requests.append((req.get_header('Range'),
+                                      req.get_header('If-range')))
+                start = 0
+                if (self.ranges and req.has_header('Range')
+                    and req.get_header('If-range') in (None, self.etag)):
+                    start = int(req.get_header('Range')[6:].rstrip('-'))
+                body = blob[start:]
+                headers = 'Content-Length: %d\r\nETag: %s\r\n' % (
+                    len(body), self.etag)
+                if self.cut:
+                    # the connection drops part way through
+                    body, self.cut = body[:self.cut], None
+                response = urllib.addinfourl(StringIO(body),
+                    httplib.HTTPMessage(StringIO(headers)),
+                    req.get_full_url())
+                response.code, response.msg = 200, 'OK'
+                if start:
+                    response.code, response.msg = 206, 'Partial Content'
+                return response
+        connection = studioapi.BaseConnection('http://www.nostudio.com',
+            'api/v1', transport=studioapi.ReplayHandler(self.resdir))
+        connection.opener.add_handler(FileHandler())
+        studio = studioapi.StudioAPI(connection)
+        studio.download_chunk_size = 4096
+        url = 'http://www.nostudio.com/download/blob'
+        md5 = {'md5': hashlib.md5(blob).hexdigest()}
+        directory = tempfile.mkdtemp()
+        def interrupted(data, validator='"v1"'):
+            open(dest + '.part', 'wb').write(data)
+            open(dest + '.parts', 'w').write(
+                '{"source": "%s", "validator": %s}' % (
+                url, json.dumps(validator)))
+        try:
+            dest = os.path.join(directory, 'blob')
+            # an interrupted download is continued with a Range request
+            interrupted(blob[:30000])
+            self.assertEqual(studio._download(url, dest, md5), len(blob))
+            self.assertEqual(FileHandler.requests, [('bytes=30000-', '"v1"')])
+            self.assertEqual(open(dest, 'rb').read(), blob)
+            self.assertEqual(os.listdir(directory), ['blob'])
+
+            # a transfer that drops picks up where it stopped
+            del FileHandler.requests[:]
+            FileHandler.cut = 20000
+            self.assertEqual(studio._download(url, dest, md5, resume=False),
+                             len(blob))
+            self.assertEqual(FileHandler.requests,
+                             [(None, None), ('bytes=20000-', '"v1"')])
+            self.assertEqual(open(dest, 'rb').read(), blob)
+
+            # a stale file at dest is replaced, not taken as done
+            del FileHandler.requests[:]
+            open(dest, 'wb').write('old' * 30000)
+            self.assertEqual(studio._download(url, dest), len(blob))
+            self.assertEqual(FileHandler.requests, [(None, None)])
+            self.assertEqual(open(dest, 'rb').read(), blob)
+            # so is a partial one nothing is known about
+            open(dest + '.part', 'wb').write('old' * 100)
+            self.assertEqual(studio._download(url, dest), len(blob))
+            self.assertEqual(open(dest, 'rb').read(), blob)
+
+            # the file changed since the interruption, it comes whole
+            del FileHandler.requests[:]
+            interrupted('old' * 100, '"v0"')
+            self.assertEqual(studio._download(url, dest), len(blob))
+            self.assertEqual(FileHandler.requests, [('bytes=300-', '"v0"')])
+            self.assertEqual(open(dest, 'rb').read(), blob)
+
+            # the server ignores Range and sends the whole file again
+            del FileHandler.requests[:]
+            FileHandler.ranges = False
+            interrupted(blob[:30000])
+            self.assertEqual(studio._download(url, dest, md5), len(blob))
+            self.assertEqual(open(dest, 'rb').read(), blob)
+            # ... which can't be restarted in a file object that can't seek
+            class Pipe:
+                def write(self, data):
+                    pass
+            self.assertRaises(studioapi.StudioError, studio._download_to,
+                              url, Pipe(), 30000, {}, 0, {})
+            FileHandler.ranges = True
+
+            # a mismatch removes the partial file, the next try starts over
+            interrupted('x' * 30000)
+            self.assertRaises(studioapi.StudioError, studio._download,
+                              url, dest, md5)
+            self.assertEqual(os.listdir(directory), ['blob'])
+            del FileHandler.requests[:]
+            self.assertEqual(studio._download(url, dest, md5), len(blob))
+            self.assertEqual(FileHandler.requests, [(None, None)])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_download_build(self):
+        image = ''.join(chr(i % 251) for i in range(100000))
+        class ImageHandler(urllib2.BaseHandler):
+            handler_order = 350
+            requests = []
+            body = StringIO
+            def http_open(self, req):
+                if '/download/' not in req.get_full_url():
+                    return None
+                start, end = req.get_header('Range')[6:].split('-')
+                body = image[int(start):int(end) + 1]
+                self.requests.append(req.get_header('Range'))
+                response = urllib.addinfourl(self.body(body),
+                    httplib.HTTPMessage(StringIO(
+                        'Content-Range: bytes %s-%s/%d\r\n' % (
+                        start, end, len(image)))), req.get_full_url())
+                response.code, response.msg = 206, 'Partial Content'
+                return response
+        connection = studioapi.BaseConnection('http://www.nostudio.com',
+            'api/v1', transport=studioapi.ReplayHandler(self.resdir))
+        connection.opener.add_handler(ImageHandler())
+        studio = studioapi.StudioAPI(connection)
+        studio.download_range_size = 16384
+        directory = tempfile.mkdtemp()
+        try:
+            dest = os.path.join(directory, 'image.tar.gz')
+            self.assertEqual(studio.download_build(509559, dest, verify=False),
+                             len(image))
+            self.assertEqual(open(dest, 'rb').read(), image)
+            # a probe and 7 ranges
+            self.assertEqual(len(ImageHandler.requests), 8)
+            self.assertFalse(os.path.exists(dest + '.parts'))
+            self.assertRaises(studioapi.StudioError, studio.download_build,
+                              509559, dest)
+            self.assertFalse(os.path.exists(dest))
+
+            # verified, while the ranges trickle in
+            build = studio.get_build_info(509559)
+            build.find('checksum/md5').text = hashlib.md5(image).hexdigest()
+            build.find('checksum/sha1').text = hashlib.sha1(image).hexdigest()
+            studio.get_build_info = lambda build_id: build
+            studio.download_chunk_size = 1024
+            class SlowBody(StringIO):
+                def read(self, size=-1):
+                    time.sleep(0.0002)
+                    return StringIO.read(self, size)
+            ImageHandler.body = SlowBody
+            for i in range(4):
+                self.assertEqual(studio.download_build(509559, dest,
+                    resume=False), len(image))
+                self.assertEqual(open(dest, 'rb').read(), image)
+
+            # ranges landing in order are hashed without reading them back
+            state = {'source': 'x', 'size': len(image), 'validator': None,
+                     'url': 'http://www.nostudio.com/download/image',
+                     'ranges': [[start, min(start + 16384, len(image)), 0]
+                                for start in range(0, len(image), 16384)]}
+            hashes = {'md5': hashlib.md5()}
+            download = studioapi._RangeDownload(studio, dest, state, hashes,
+                                                1, 0)
+            download.run()
+            self.assertEqual(hashes['md5'].hexdigest(),
+                             hashlib.md5(image).hexdigest())
+            self.assertEqual(download.read_back, 0)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_daemon(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'studiod.sock')
+        daemon = studiod.StudioDaemon(self.studio, path)
+        thread = threading.Thread(target=daemon.serve_forever)
+        thread.start()
+        client = studiod.DaemonClient(path)
+        try:
+            appliances = client.get_appliances()
+            self.assertEqual(appliances.findtext('appliance/id'), '266657')
+            self.assertEqual(client.get_build_status(529783).findtext('state'),
+                             'running')
+            try:
+                client.get_account()
+            except urllib2.HTTPError, e:
+                self.assertEqual(e.code, 404)
+            else:
+                self.fail('expected a 404')
+            self.assertRaises(AttributeError, getattr, client, '_opener')
+            self.assertRaises(studioapi.StudioError, client.call, '_opener')
+            methods = client.methods()
+            self.assertTrue('add_build' in methods)
+            for name in ('batch', 'set_appliance_software', 'upload_rpm'):
+                self.assertFalse(name in methods)
+            self.assertRaises(studioapi.StudioError, studiod.StudioDaemon,
+                              self.studio, path)
+
+            # command line arguments reach the API as strings
+            calls = []
+            def add_build(*args, **kwargs):
+                calls.append((args, kwargs))
+                return {'ok': 1}
+            self.studio.add_build = add_build
+            stdout = sys.stdout
+            sys.stdout = StringIO()
+            try:
+                self.assertEqual(studiod.main(['--socket', path, 'add_build',
+                    '266657', 'force=true', 'multi=false']), 0)
+                self.assertEqual(sys.stdout.getvalue(), '{"ok": 1}\n')
+            finally:
+                sys.stdout = stdout
+            self.assertEqual(calls, [(('266657',),
+                                      {'force': 'true', 'multi': 'false'})])
+        finally:
+            client.close()
+            daemon.shutdown()
+            thread.join()
+            daemon.server_close()
+            shutil.rmtree(directory)
+
+    def test_overlay_sync(self):
+        directory = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(directory, 'etc'))
+            os.makedirs(os.path.join(directory, 'usr', 'bin'))
+            def write(name, data, mode):
+                filename = os.path.join(directory, *name.split('/'))
+                with open(filename, 'w') as fd:
+                    fd.write(data)
+                os.chmod(filename, mode)
+            write('etc/suseRegister.conf', 'x' * 448, 0644)
+            write('usr/bin/tool', '#!/bin/sh\n', 0755)
+
+            observed = []
+            studio = studioapi.StudioAPI(self.connection,
+                instrumentation=studioapi.Instrumentation(hooks=[
+                    lambda metric, labels, value: metric == 'requests'
+                        and observed.append(labels['verb'])]))
+            sync = studiosync.OverlaySync(studio)
+            actions = sync.sync(214486, directory)
+            self.assertEqual([a[0] for a in actions], ['replace', 'upload'])
+            self.assertEqual(actions[1][3]['path'], '/usr/bin')
+            self.assertEqual(actions[1][3]['permissions'], '755')
+            self.assertEqual(sorted(observed), ['GET', 'POST', 'PUT'])
+
+            os.chmod(os.path.join(directory, 'etc', 'suseRegister.conf'), 0600)
+            actions = sync.plan(214486, directory, delete=True)
+            self.assertEqual(actions[0][0], 'replace')
+            self.assertEqual(actions[1][0], 'metadata')
+            self.assertEqual(actions[1][3], {'permissions': '600'})
+        finally:
+            shutil.rmtree(directory)
+
+    def test_rpm_sync(self):
+        directory = tempfile.mkdtemp()
+        try:
+            def write(name, data):
+                with open(os.path.join(directory, name), 'wb') as fd:
+                    fd.write(data)
+            # same size as the uploaded one, different content
+            write('josefs_sles_11_sp1_slms_test_guest_i586-update-0.0.1-8'
+                  '.noarch.rpm', 'x' * 4585)
+            write('new-1.0-1.noarch.rpm', 'rpm')
+            write('README', 'not an rpm')
+            # an uploaded archive has no local counterpart to sync with
+            rpms = self.studio.get_base_system_rpms('SLES11_SP1')
+            archive = studioapi.ET.SubElement(rpms, 'rpm')
+            for tag, text in (('id', '30001'), ('filename', 'tools.tar.gz'),
+                              ('archive', 'true')):
+                studioapi.ET.SubElement(archive, tag).text = text
+            self.studio.get_base_system_rpms = lambda base_system: rpms
+            sync = studiosync.RpmSync(self.studio)
+            actions = sync.plan('SLES11_SP1', directory, delete=True)
+            self.assertFalse('30001' in [a[2] for a in actions])
+            self.assertEqual(actions[:2], [
+                ('update', os.path.join(directory, 'josefs_sles_11_sp1_slms_'
+                 'test_guest_i586-update-0.0.1-8.noarch.rpm'), '27653'),
+                ('upload', os.path.join(directory, 'new-1.0-1.noarch.rpm'),
+                 None)])
+            self.assertTrue(actions[2:])
+            self.assertEqual(set(a[0] for a in actions[2:]), set(['delete']))
+            self.assertFalse('27653' in [a[2] for a in actions[2:]])
+            sync.apply('SLES11_SP1', actions[:2])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_account_mirror(self):
+        mirror = studiomirror.AccountMirror(self.studio)
+        stats = mirror.refresh()
+        self.assertEqual((stats['configuration'], stats['builds']), (7, 7))
+        self.assertEqual(mirror.execute('SELECT count(*) FROM appliances')
+                         .fetchone()[0], 7)
+        self.assertEqual(mirror.execute(
+            "SELECT version FROM software WHERE appliance_id = 214486 "
+            "AND name = 'sysvinit'").fetchone()[0], '2.86-200.1')
+        self.assertEqual([c[1] for c in mirror.execute(
+            'PRAGMA table_info(software)')],
+            ['appliance_id', 'type', 'name', 'version'])
+        self.assertEqual(mirror.execute(
+            'SELECT state, md5 FROM builds WHERE id = 509559').fetchone(),
+            ('finished', 'a0f0217f0645099c9e41c42e9bf89976'))
+        # nothing was edited and no builds were added
+        stats = mirror.refresh()
+        self.assertEqual((stats['configuration'], stats['builds']), (0, 0))
+        self.assertEqual(stats['status'], 7)
+
+    def test_build_watcher_errors(self):
+        answers = {'1': [socket.timeout('timed out'),
+                         httplib.BadStatusLine(''),
+                         SyntaxError('not xml'),
+                         '<running_build><state>finished</state>'
+                         '</running_build>'],
+                   '2': [ValueError('broken')]}
+        def get_build_status(build_id):
+            answer = answers[build_id].pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+            return studioapi.ET.fromstring(answer)
+        self.studio.get_build_status = get_build_status
+        self.studio.get_build_info = lambda build_id: \
+            studioapi.ET.fromstring('<build><id>%s</id></build>' % build_id)
+        watcher = studiobuilds.BuildWatcher(self.studio, min_interval=0.01)
+        futures = [watcher.watch(1), watcher.watch(2)]
+        watcher.start()
+        try:
+            # transient errors are polled again, others fail the build
+            self.assertEqual(futures[0].result(10).findtext('id'), '1')
+            self.assertRaises(ValueError, futures[1].result, 10)
+            self.assertTrue(watcher.alive())
+        finally:
+            watcher.stop()
+
+    def test_build_orchestrator(self):
+        exists = open(os.path.join(self.resdir,
+            'running_build_image_already_exists.xml')).read()
+        submitted = []
+        refuse = [('1', 'iso'), ('2', 'oem')]
+        def add_build(appliance_id, force='', version='', image_type='',
+            multi=''):
+            submitted.append((appliance_id, version, image_type, multi))
+            if (appliance_id, image_type) in refuse:
+                refuse.remove((appliance_id, image_type))
+                return studioapi.ET.fromstring(exists)
+            return studioapi.ET.fromstring(
+                '<running_build><id>%d</id></running_build>' % len(submitted))
+        self.studio.add_build = add_build
+        self.studio.get_running_appliance_builds = lambda appliance_id: \
+            studioapi.ET.fromstring('<running_builds/>')
+        self.studio.get_build_status = lambda build_id: \
+            studioapi.ET.fromstring('<running_build><state>finished</state>'
+                                    '</running_build>')
+        watcher = studiobuilds.BuildWatcher(self.studio, min_interval=0)
+        orchestrator = studiobuilds.BuildOrchestrator(self.studio,
+            max_per_appliance=1, retry_delay=0, watcher=watcher)
+        orchestrator.matrix(['1', '2'], ['1.0'], ['oem', 'iso'])
+        jobs = orchestrator.run(timeout=30)
+        self.assertEqual([j.state for j in jobs],
+                         ['finished', 'finished', 'failed', 'failed'])
+        # the extra format refused after our first build was retried, the
+        # existing first image of appliance 2 failed at once
+        self.assertEqual(jobs[1].attempts, 2)
+        self.assertEqual(jobs[2].attempts, 1)
+        self.assertTrue('image_already_exists' in str(jobs[2].error))
+        self.assertEqual(sorted(submitted), [
+            ('1', '1.0', 'iso', 'true'), ('1', '1.0', 'iso', 'true'),
+            ('1', '1.0', 'oem', ''), ('2', '1.0', 'oem', '')])
+        self.assertTrue(submitted.index(('1', '1.0', 'oem', '')) <
+                        submitted.index(('1', '1.0', 'iso', 'true')))
+
+        # a watcher whose thread died doesn't leave run() waiting forever
+        def die(due):
+            raise SystemExit
+        watcher = studiobuilds.BuildWatcher(self.studio, min_interval=0)
+        watcher._poll = die
+        orchestrator = studiobuilds.BuildOrchestrator(self.studio,
+            watcher=watcher)
+        orchestrator.check_interval = 0.05
+        orchestrator.matrix(['3'], ['1.0'], ['oem', 'iso'])
+        started = time.time()
+        jobs = orchestrator.run()
+        self.assertTrue(time.time() - started < 5)
+        self.assertEqual([j.state for j in jobs], ['failed', 'failed'])
+        self.assertTrue('watcher' in str(jobs[0].error))
+
+    def test_async_concurrency(self):
+        server = FixtureServer(self.resdir)
+        server.delay = 0.2
+        try:
+            studio = studioasync.AsyncStudioAPI(
+                studioapi.BaseConnection(server.url(), 'api/v1'))
+            started = time.time()
+            futures = [studio.get_appliance_status(i) for i in range(20)]
+            statuses = studio.wait(futures)
+            self.assertTrue(time.time() - started < 2)
+            self.assertTrue(server.max_concurrent > 10)
+            self.assertEqual([s.findtext('state') for s in statuses],
+                             ['ok'] * 20)
+            # callbacks run on the loop and can queue more requests
+            chained = []
+            studio.get_appliances().add_done_callback(lambda f: chained.append(
+                studio.get_appliance_status(f.result().findtext(
+                    'appliance/id'))))
+            studio.run()
+            self.assertEqual(chained[0].result().findtext('state'), 'ok')
+            results = sorted(studio.batch('get_appliance_status', range(6),
+                                          max_workers=2))
+            self.assertEqual([r[0] for r in results], range(6))
+            rpms = studio.iter_base_system_rpms('SLES11_SP1').result()
+            self.assertEqual(rpms[0].findtext('filename'), studioapi.ET.parse(
+                os.path.join(self.resdir, 'rpms.xml')).findtext('rpm/filename'))
+            server.script['/rpms/\\d+/data'] = [(200, 'rpm data')]
+            dest = StringIO()
+            future = studio.download_rpm(27653, dest, verify=False)
+            self.assertEqual(future.result(5), 8)
+            self.assertEqual(dest.getvalue(), 'rpm data')
+
+            # the connections of earlier requests are reused
+            server.delay = 0
+            connections = server.connections
+            for i in range(5):
+                studio.get_appliance_status(i).result(5)
+            self.assertEqual(server.connections, connections)
+            # a GET the server dropped without answering is sent again
+            count = len(server.requests)
+            server.script['/status$'] = [(None, '')]
+            self.assertEqual(studio.get_appliance_status(1).result(5)
+                             .findtext('state'), 'ok')
+            self.assertEqual(len(server.requests), count + 2)
+            # chunked responses keep the connection too
+            status = open(os.path.join(self.resdir, 'status.xml')).read()
+            server.script['/status$'] = [(200, [status[:10], status[10:]])]
+            self.assertEqual(studio.get_appliance_status(1).result(5)
+                             .findtext('state'), 'ok')
+            connections = server.connections
+            studio.get_appliance_status(1).result(5)
+            self.assertEqual(server.connections, connections)
+        finally:
+            studio.close()
+            server.shutdown()
+            server.server_close()
+
+    def test_async_errors(self):
+        server = FixtureServer(self.resdir)
+        try:
+            instrumentation = studioapi.Instrumentation()
+            studio = studioasync.AsyncStudioAPI(
+                studioapi.BaseConnection(server.url(), 'api/v1'),
+                cache=studioapi.ResponseCache(),
+                retry=studioapi.RetryPolicy(backoff=0.01),
+                breaker=studioapi.CircuitBreaker(threshold=3),
+                instrumentation=instrumentation,
+                limiter=studioapi.RateLimiter(rate=1000))
+            try:
+                studio.get_account().result()
+            except urllib2.HTTPError, e:
+                self.assertEqual(e.code, 404)
+            else:
+                self.fail('expected a 404')
+            # retried until the fixture is served
+            server.script['/status$'] = [(503, ''), (502, '')]
+            self.assertEqual(studio.get_appliance_status(1).result()
+                             .findtext('state'), 'ok')
+            self.assertTrue('studio_retries_total' in instrumentation.export())
+            # cached repositories aren't fetched again
+            count = len(server.requests)
+            studio.get_repositories().result()
+            studio.get_repositories().result()
+            self.assertEqual(len(server.requests), count + 1)
+            server.script['/status$'] = [(500, '')] * 4
+            self.assertRaises(studioapi.StudioError,
+                              studio.get_appliance_status(1).result)
+            # the failures opened the circuit
+            count = len(server.requests)
+            self.assertRaises(studioapi.StudioError,
+                              studio.get_appliance_status(1).result)
+            self.assertEqual(len(server.requests), count)
+            # the trial request survives being held back by the limiter
+            server.script.clear()
+            studio.breaker.reset_timeout = 0
+            studio.limiter = studioapi.RateLimiter(rate=20, burst=1)
+            studio.limiter.reserve(urllib2.Request(server.url()))
+            self.assertEqual(studio.get_appliance_status(1).result()
+                             .findtext('state'), 'ok')
+            self.assertEqual(len(server.requests), count + 1)
+            # nothing listens on a closed server's port
+            refused = studioasync.AsyncStudioAPI(
+                studioapi.BaseConnection(server.url(), 'api/v1'))
+        finally:
+            studio.close()
+            server.shutdown()
+            server.server_close()
+        self.assertRaises(urllib2.URLError,
+                          refused.get_appliance_status(1).result, 5)
+
+    def test_response_cache(self):
+        cache = studioapi.ResponseCache(maxsize=2, ttl=60)
+        headers = httplib.HTTPMessage(StringIO('ETag: "1"\r\n\r\n'))
+        for url in ['a', 'b', 'c']:
+            cache.store(url, '<%s/>' % url, headers)
+        self.assertEqual(cache.lookup('a'), (None, False))
+        entry, fresh = cache.lookup('c')
+        self.assertTrue(fresh)
+        self.assertEqual(entry[:2], ('<c/>', '"1"'))
+        cache.expire_all()
+        self.assertFalse(cache.lookup('c')[1])
+        self.assertEqual(cache.stats, {'hits': 1, 'misses': 1,
+                                       'revalidated': 0})
+        # storing a response that was looked up isn't another miss
+        self.assertEqual(cache.lookup('d'), (None, False))
+        cache.store('d', '<d/>', headers)
+        self.assertEqual(cache.stats['misses'], 2)
+
+    def test_iter_appliance_installed_software(self):
+        self.studio._urlopen = lambda req: open(
+            '%s/software_installed.xml' % self.resdir)
+        records = [(repo.get('id'), pkg.text, pkg.get('arch'))
+                   for repo, pkg in
+                   self.studio.iter_appliance_installed_software(214486)]
+        root = studioapi.ET.parse(
+            '%s/software_installed.xml' % self.resdir).getroot()
+        self.assertEqual(len(records),
+            len(root.findall('repository/software/package')) +
+            len(root.findall('repository/software/pattern')))
+        self.assertEqual(records[0], ('6347', '3ddiag', 'i586'))
+
+    def test_typed_records(self):
+        root = studioapi.ET.parse('%s/appliances.xml' % self.resdir).getroot()
+        appliance = studiotypes.records(studiotypes.Appliance, root)[0]
+        self.assertEqual(appliance.id, 266657)
+        self.assertEqual(appliance.builds[0].size, 695)
+        root = studioapi.ET.parse('%s/build.xml' % self.resdir).getroot()
+        build = studiotypes.Build.from_element(root)
+        self.assertEqual(build.completed_at.year, 2010)
+        self.assertTrue(build.expired)
+        root = studioapi.ET.parse('%s/running_builds.xml' % self.resdir).getroot()
+        running = studiotypes.records(studiotypes.RunningBuild, root)
+        self.assertEqual([b.percent for b in running], [10, 10, 35])
+        self.assertTrue(running[0].state is running[1].state)
+
+    def test_reconciler_plan(self):
+        resdir = self.resdir
+        class FixtureStudio:
+            def get_appliance_software(self, id):
+                return studioapi.ET.parse('%s/software.xml' % resdir).getroot()
+            def get_appliance_repositories(self, id):
+                return studioapi.ET.parse(
+                    '%s/repositories.xml' % resdir).getroot()
+        reconciler = studioreconcile.ApplianceReconciler(FixtureStudio())
+        software = FixtureStudio().get_appliance_software(218318)
+        packages = [p.text for p in software.findall('package')]
+        patterns = [p.text for p in software.findall('pattern')]
+
+        self.assertEqual(reconciler.plan(218318, {'packages': packages,
+                                                  'patterns': patterns}), [])
+        self.assertEqual(reconciler.plan(218318,
+            {'packages': packages + ['emacs']}),
+            [('add_appliance_software_package', (218318, 'emacs', ''))])
+        actions = reconciler.plan(218318,
+            {'packages': packages[1:] + ['emacs'], 'patterns': []})
+        self.assertEqual([a[0] for a in actions], ['set_appliance_software'])
+        root = actions[0][1][1]
+        self.assertEqual(len(root.findall('package')), len(packages))
+        self.assertEqual(root.findall('pattern'), [])
+        self.assertEqual(root.get('appliance_id'), '218318')
+
+        # the PUT keeps what the reconciler doesn't know about
+        extra = studioapi.ET.SubElement(software, 'locked')
+        extra.text = 'kernel-default'
+        software.find('package').set('arch', 'i586')
+        software.find('package').set('version', '0.0.8-1')
+        root = reconciler._plan_software(218318, software,
+            {'packages': packages + ['emacs', 'joe']})[0][1][1]
+        self.assertEqual(root.findtext('locked'), 'kernel-default')
+        self.assertEqual(root.find('package').get('arch'), 'i586')
+        self.assertEqual(root.find('package').get('version'), '0.0.8-1')
+        self.assertEqual([p.text for p in root.findall('pattern')], patterns)
+        self.assertEqual([p.text for p in root.findall('package')],
+                         packages + ['emacs', 'joe'])
+        root = reconciler._plan_software(218318, software,
+            {'packages': [(packages[0], '0.0.9-1')] + packages[2:]})[0][1][1]
+        self.assertEqual(root.find('package').get('version'), '0.0.9-1')
+        self.assertEqual(root.find('package').get('arch'), 'i586')
+        self.assertEqual(len(root.findall('package')), len(packages) - 1)
+
+        # ban state can't be read back, so listed packages are always sent
+        self.assertEqual(reconciler.plan(218318,
+            {'banned': ['nano', 'nano'], 'unbanned': ['emacs']}),
+            [('ban_appliance_software_package', (218318, 'nano')),
+             ('unban_appliance_software_package', (218318, 'emacs'))])
+
+        repositories = FixtureStudio().get_appliance_repositories(218318)
+        ids = [r.findtext('id') for r in repositories.findall('repository')]
+        self.assertEqual(reconciler.plan(218318,
+            {'repositories': ids[:-1]}),
+            [('remove_appliance_repository', (218318, ids[-1]))])
+
     #def test_get_account(self):
-    #def test_get_api_version(self):
+    def test_get_api_version(self):
+        self.assertEqual(self.studio.get_api_version().text, '1.0')
+
     #def test_get_template_sets(self):
-    #def test_get_appliances(self):
-    #def test_get_appliance_status(self):
+    def test_get_appliances(self):
+        appliances = self.studio.get_appliances()
+        self.assertEqual(appliances.tag, 'appliances')
+        self.assertEqual(appliances.findtext('appliance/id'), '266657')
+
+    def test_get_appliance_status(self):
+        status = self.studio.get_appliance_status(266657)
+        self.assertEqual(status.findtext('state'), 'ok')
+
     #def test_create_appliance(self):
     #def test_delete_appliance(self):
     #def test_get_appliance_repositories(self):
@@ -68,12 +1194,21 @@ class StudioTest(mox.MoxTestBase):
     #def test_get_overlay_file_metadata(self):
     #def test_add_overlay_file_metadata(self):
     #def test_delete_overlay_file(self):
-    #def test_get_running_appliance_builds(self):
-    #def test_get_build_status(self):
+    def test_get_running_appliance_builds(self):
+        builds = self.studio.get_running_appliance_builds(266657)
+        self.assertEqual(builds.findtext('running_build/id'), '529783')
+
+    def test_get_build_status(self):
+        status = self.studio.get_build_status(529783)
+        self.assertEqual(status.findtext('percent'), '69')
+
     #def test_add_build(self):
     #def test_cancel_build(self):
     #def test_get_completed_builds(self):
-    #def test_get_build_info(self):
+    def test_get_build_info(self):
+        build = self.studio.get_build_info(509559)
+        self.assertEqual(build.findtext('state'), 'finished')
+
     #def test_delete_build(self):
     #def test_get_base_system_rpms(self):
     #def test_get_rpm_info(self):
@@ -88,6 +1223,28 @@ class StudioTest(mox.MoxTestBase):
     #def test_start_testdrive(self):
     #def test_version(self):
 
+    def test_record_replay(self):
+        directory = tempfile.mkdtemp()
+        try:
+            urllib2.install_opener(urllib2.build_opener(
+                studioapi.ReplayHandler(self.resdir),
+                studioapi.RecordingHandler(directory)))
+            self.studio.get_appliance_status(266657)
+            self.assertRaises(urllib2.HTTPError, self.studio.get_account)
+
+            connection = studioapi.BaseConnection('http://www.nostudio.com',
+                'api/v1', transport=studioapi.ReplayHandler(directory, ()))
+            studio = studioapi.StudioAPI(connection)
+            status = studio.get_appliance_status(266657)
+            self.assertEqual(status.findtext('state'), 'ok')
+            try:
+                studio.get_account()
+            except urllib2.HTTPError, e:
+                self.assertEqual(e.code, 404)
+            self.assertRaises(urllib2.HTTPError, studio.get_appliances)
+        finally:
+            shutil.rmtree(directory)
+
 
 
 if __name__ == '__main__':
@@ -18,17 +18,43 @@ __license__ = 'GPL v.2 http://www.gnu.org/licenses/gpl.txt'
 __author__ = "Chris Horler <cshorler@googlemail.com>"
 __version__ = '1.0-pre1'
 
+import os
+import re
 import sys
+import time
+import errno
+import base64
+import copy
+import random
+import hashlib
+import select
+import socket
+import threading
+import httplib
+import Queue
 import urllib
 import urllib2
 import urlparse
+import zlib
 from contextlib import closing
+from collections import OrderedDict
+from email.utils import parsedate_tz, mktime_tz
+
+try:
+    import json
+except ImportError:
+    json = None
 
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 try:
     import lxml.etree as ET
 except ImportError:
@@ -63,10 +89,465 @@ class HTTPGetRequest(urllib2.Request):
         return 'GET'
 
 
+class ConnectionPool:
+    """Bounded pool of persistent HTTP/1.1 connections
+
+    Connections are keyed by (scheme, host).  At most maxsize connections
+    per key are open at any time, callers block until one is returned.
+    Idle connections are discarded after idle_timeout seconds, or when a
+    health check shows the server has closed (or written to) the socket.
+    """
+    def __init__(self, maxsize=4, idle_timeout=60):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+
+    def _slot(self, key):
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.maxsize)
+            return self._slots[key]
+
+    @staticmethod
+    def _alive(conn):
+        """an idle keep-alive socket must not be readable - if it is the
+        server has either closed it or sent something we didn't ask for
+        """
+        if conn.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+    def acquire(self, key, factory):
+        """returns (connection, reused) - reused is True when the connection
+        came from the idle list rather than from factory()
+        """
+        self._slot(key).acquire()
+        try:
+            while True:
+                with self._lock:
+                    idle = self._idle.get(key)
+                    if not idle:
+                        break
+                    conn, since = idle.pop()
+                if (time.time() - since < self.idle_timeout
+                    and self._alive(conn)):
+                    return conn, True
+                conn.close()
+            return factory(), False
+        except:
+            self._slot(key).release()
+            raise
+
+    def release(self, key, conn, reuse=True):
+        if reuse and conn.sock is not None:
+            with self._lock:
+                self._idle.setdefault(key, []).append((conn, time.time()))
+        else:
+            conn.close()
+        self._slot(key).release()
+
+    def close(self):
+        """close all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, since in conns:
+                conn.close()
+
+
+class _PooledResponse:
+    """Socket-like wrapper around httplib.HTTPResponse, hands the connection
+    back to the pool when closed
+
+    Small unread bodies (e.g. from 401 responses) are drained so the
+    connection can still be reused.
+    """
+    drain_limit = 65536
+
+    def __init__(self, pool, key, conn, response):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+
+    def recv(self, amt=-1):
+        if amt is None or amt < 0:
+            return self._response.read()
+        return self._response.read(amt)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        response = self._response
+        if (not response.isclosed() and response.length is not None
+            and response.length <= self.drain_limit):
+            try:
+                response.read()
+            except (socket.error, httplib.HTTPException):
+                pass
+        reuse = response.isclosed() and not response.will_close
+        if not reuse:
+            response.close()
+        self._pool.release(self._key, conn, reuse)
+
+
+class _KeepAliveMixin:
+    """Sends requests over pooled keep-alive connections
+
+    A GET or HEAD that fails on a reused connection because the server
+    dropped it before answering (it may have timed it out while idle) is
+    retried on a fresh connection.  Other methods, and timeouts, are never
+    sent twice - the server may already have acted on them.
+    """
+    replayable = ('GET', 'HEAD')
+
+    @staticmethod
+    def _dropped(err):
+        """the connection was closed or reset before any response"""
+        if isinstance(err, httplib.BadStatusLine):
+            return True
+        return (isinstance(err, socket.error)
+                and not isinstance(err, socket.timeout)
+                and err.errno in (errno.ECONNRESET, errno.EPIPE,
+                                  errno.ECONNABORTED))
+
+    def _keepalive_open(self, http_class, req):
+        if req._tunnel_host:
+            return self.do_open(http_class, req)
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        key = (req.get_type(), host)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers['Connection'] = 'keep-alive'
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        factory = lambda: http_class(host, timeout=req.timeout)
+        while True:
+            conn, reused = self.pool.acquire(key, factory)
+            conn.set_debuglevel(self._debuglevel)
+            if reused:
+                # the pooled socket still has the timeout of its first request
+                conn.timeout = req.timeout
+                if req.timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+                    conn.sock.settimeout(socket.getdefaulttimeout())
+                else:
+                    conn.sock.settimeout(req.timeout)
+            if hasattr(req.data, 'seek'):
+                req.data.seek(0)
+            try:
+                req.timings = {}
+                started = time.time()
+                if conn.sock is None:
+                    conn.connect()
+                    req.timings['connect_seconds'] = time.time() - started
+                    started = time.time()
+                conn.request(req.get_method(), req.get_selector(), req.data,
+                             headers)
+                r = conn.getresponse(buffering=True)
+                req.timings['first_byte_seconds'] = time.time() - started
+            except (socket.error, httplib.HTTPException), err:
+                self.pool.release(key, conn, reuse=False)
+                if (reused and req.get_method() in self.replayable
+                    and self._dropped(err)):
+                    continue
+                raise urllib2.URLError(err)
+            break
+
+        fp = socket._fileobject(_PooledResponse(self.pool, key, conn, r),
+                                close=True)
+        resp = urllib.addinfourl(fp, r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
+
+class KeepAliveHandler(_KeepAliveMixin, urllib2.HTTPHandler):
+    def __init__(self, pool=None, debuglevel=0):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        self.pool = pool or ConnectionPool()
+
+    def http_open(self, req):
+        return self._keepalive_open(httplib.HTTPConnection, req)
+
+
+class HTTPSKeepAliveHandler(_KeepAliveMixin, urllib2.HTTPSHandler):
+    def __init__(self, pool=None, debuglevel=0):
+        urllib2.HTTPSHandler.__init__(self, debuglevel)
+        self.pool = pool or ConnectionPool()
+
+    def https_open(self, req):
+        return self._keepalive_open(httplib.HTTPSConnection, req)
+
+
+class _DecodedReader:
+    """File-like object that decompresses a gzip or deflate body while it
+    is read
+    """
+    blocksize = 16384
+
+    def __init__(self, fp, encoding):
+        self._fp = fp
+        self._encoding = encoding
+        if encoding == 'gzip':
+            self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._zlib = zlib.decompressobj()
+        self._first = True
+        self._buffer = ''
+        self._eof = False
+
+    def _fill(self):
+        data = self._fp.read(self.blocksize)
+        if not data:
+            self._buffer += self._zlib.flush()
+            self._eof = True
+            return
+        if self._first and self._encoding == 'deflate':
+            self._first = False
+            try:
+                self._buffer += self._zlib.decompress(data)
+                return
+            except zlib.error:
+                # some servers send a raw deflate stream, without zlib header
+                self._zlib = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._buffer += self._zlib.decompress(data)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while not self._eof:
+                self._fill()
+            size = len(self._buffer)
+        while len(self._buffer) < size and not self._eof:
+            self._fill()
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        while '\n' not in self._buffer and not self._eof:
+            self._fill()
+        end = self._buffer.find('\n') + 1 or len(self._buffer)
+        if size is not None and size >= 0:
+            end = min(end, size)
+        data, self._buffer = self._buffer[:end], self._buffer[end:]
+        return data
+
+    def close(self):
+        self._fp.close()
+
+
+class DecompressionHandler(urllib2.BaseHandler):
+    """Asks for gzip / deflate compressed responses and decompresses them
+    as they are read, so the XML parser is fed straight from the socket
+
+    Requests that already have an Accept-Encoding header are left alone.
+    """
+    handler_order = 300
+    encodings = ('gzip', 'deflate')
+
+    def http_request(self, req):
+        if not req.has_header('Accept-encoding'):
+            req.add_unredirected_header('Accept-Encoding',
+                                        ', '.join(self.encodings))
+        return req
+
+    def http_response(self, req, response):
+        headers = response.info()
+        encoding = (headers.getheader('Content-Encoding') or '').strip().lower()
+        if encoding not in self.encodings:
+            return response
+        del headers['Content-Encoding']
+        del headers['Content-Length']
+        decoded = urllib.addinfourl(_DecodedReader(response, encoding),
+                                    headers, response.geturl())
+        decoded.code = response.code
+        decoded.msg = response.msg
+        return decoded
+
+    https_request = http_request
+    https_response = http_response
+
+
+def _replayed_response(url, status, reason, headers, body):
+    headers = [h for h in headers if h.split(':', 1)[0].strip().lower()
+               not in ('content-length', 'transfer-encoding', 'connection',
+                       'keep-alive')]
+    headers.append('Content-Length: %d\r\n' % len(body))
+    response = urllib.addinfourl(StringIO(body),
+        httplib.HTTPMessage(StringIO(''.join(headers))), url)
+    response.code = status
+    response.msg = reason
+    return response
+
+
+class RecordingHandler(urllib2.BaseHandler):
+    """Saves every response to directory, for ReplayHandler
+
+    Each body is written to its own file, and a line describing the
+    request and response is appended to the index file (JSON lines).
+    """
+    handler_order = 400
+    index_name = 'recorded.json'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        index = os.path.join(directory, self.index_name)
+        self._count = 0
+        if os.path.exists(index):
+            with open(index) as fd:
+                self._count = sum(1 for line in fd)
+
+    def http_response(self, req, response):
+        with closing(response):
+            body = response.read()
+        parts = urlparse.urlsplit(req.get_full_url())
+        path = parts.path + (parts.query and '?' + parts.query)
+        with self._lock:
+            self._count += 1
+            filename = '%04d-%s%s.xml' % (self._count, req.get_method(),
+                re.sub(r'[^A-Za-z0-9.]+', '_', parts.path)[:80])
+            with open(os.path.join(self.directory, filename), 'wb') as fd:
+                fd.write(body)
+            with open(os.path.join(self.directory, self.index_name), 'a') as fd:
+                fd.write(json.dumps({'method': req.get_method(), 'path': path,
+                    'status': response.code, 'reason': response.msg,
+                    'headers': response.info().headers,
+                    'file': filename}) + '\n')
+        return _replayed_response(response.geturl(), response.code,
+            response.msg, response.info().headers, body)
+
+    https_response = http_response
+
+
+class ReplayHandler(urllib2.BaseHandler):
+    """Answers requests from files instead of the network
+
+    Requests saved by a RecordingHandler in directory are answered first,
+    in the order they were recorded (the last response of a request is
+    repeated).  Other requests are matched against routes - (method, path
+    regex, file name) - whose defaults map the endpoints to the fixtures in
+    test/responses.  Anything else gets a 404.  Files are read once.
+    """
+    handler_order = 400
+    routes = (
+        ('GET', r'/user/api_version', 'api_version.xml'),
+        ('GET', r'/user/template_sets(/[^/]+)?', 'template_sets.xml'),
+        ('GET', r'/user/appliances', 'appliances.xml'),
+        ('POST', r'/user/appliances', 'appliance.xml'),
+        ('GET', r'/user/appliances/\d+', 'appliance.xml'),
+        ('GET', r'/user/appliances/\d+/status', 'status.xml'),
+        ('GET|PUT', r'/user/appliances/\d+/repositories', 'repositories.xml'),
+        ('POST', r'/user/appliances/\d+/cmd/(add|remove)_repository',
+         'repositories.xml'),
+        ('POST', r'/user/appliances/\d+/cmd/add_user_repository',
+         'repositories.xml'),
+        ('GET|PUT', r'/user/appliances/\d+/software', 'software.xml'),
+        ('POST', r'/user/appliances/\d+/cmd/'
+                 r'((add|remove)_(package|pattern)|(ban|unban)_package)',
+         'software_fake_response.xml'),
+        ('GET', r'/user/appliances/\d+/installed', 'software_installed.xml'),
+        ('GET', r'/user/appliances/\d+/software/search', 'software_search.xml'),
+        ('GET', r'/user/appliances/\d+/gpg_keys', 'gpg_keys.xml'),
+        ('POST', r'/user/appliances/\d+/gpg_keys', 'gpg_key.xml'),
+        ('GET', r'/user/appliances/\d+/gpg_keys/\d+', 'gpg_key.xml'),
+        ('GET', r'/user/files', 'files.xml'),
+        ('POST', r'/user/files', 'file.xml'),
+        ('GET', r'/user/files/\d+', 'file.xml'),
+        ('PUT', r'/user/files/\d+(/data)?', 'file.xml'),
+        ('GET', r'/user/running_builds', 'running_builds.xml'),
+        ('POST', r'/user/running_builds', 'running_build.xml'),
+        ('GET', r'/user/running_builds/\d+', 'running_build.xml'),
+        ('GET', r'/user/builds', 'builds.xml'),
+        ('GET', r'/user/builds/\d+', 'build.xml'),
+        ('GET', r'/user/rpms', 'rpms.xml'),
+        ('POST', r'/user/rpms', 'rpm.xml'),
+        ('GET|PUT', r'/user/rpms/\d+', 'rpm.xml'),
+        ('GET', r'/user/repositories', 'repositories.xml'),
+        ('POST', r'/user/repositories', 'repository.xml'),
+        ('GET', r'/user/repositories/\d+', 'repository.xml'),
+        ('GET', r'/user/testdrives', 'testdrives.xml'),
+        ('POST', r'/user/testdrives', 'testdrive.xml'),
+    )
+
+    def __init__(self, directory, routes=None):
+        self.directory = directory
+        if routes is not None:
+            self.routes = routes
+        self._routes = [(re.compile('(%s)$' % method),
+                         re.compile('(%s)$' % path), filename)
+                        for method, path, filename in self.routes]
+        self._lock = threading.Lock()
+        self._bodies = {}
+        self._recorded = {}
+        index = os.path.join(directory, RecordingHandler.index_name)
+        if os.path.exists(index):
+            with open(index) as fd:
+                for line in fd:
+                    entry = json.loads(line)
+                    self._recorded.setdefault(
+                        (entry['method'], entry['path']), []).append(entry)
+
+    def http_open(self, req):
+        method = req.get_method()
+        parts = urlparse.urlsplit(req.get_full_url())
+        path = parts.path + (parts.query and '?' + parts.query)
+        with self._lock:
+            entries = self._recorded.get((method, path))
+            if entries:
+                entry = entries.pop(0) if len(entries) > 1 else entries[0]
+                return _replayed_response(req.get_full_url(), entry['status'],
+                    entry['reason'], entry['headers'], self._body(entry['file']))
+            for method_re, path_re, filename in self._routes:
+                if method_re.match(method) and path_re.search(parts.path):
+                    return _replayed_response(req.get_full_url(), 200, 'OK',
+                        ['Content-Type: application/xml\r\n'],
+                        self._body(filename))
+        return _replayed_response(req.get_full_url(), 404, 'Not Found',
+                                  [], '')
+
+    https_open = http_open
+
+    def _body(self, filename):
+        body = self._bodies.get(filename)
+        if body is None:
+            with open(os.path.join(self.directory, filename), 'rb') as fd:
+                body = self._bodies[filename] = fd.read()
+        return body
+
+
 class BaseConnection:
-    def __init__(self, host, api_path):
+    """Connection details and OpenerDirector
+
+    transport (optional) - an extra urllib2 handler, e.g. a ReplayHandler
+                           to answer requests from files, or a
+                           RecordingHandler to save the responses
+    """
+    def __init__(self, host, api_path, pool=None, transport=None):
         self.addr = urlparse.urljoin(host, api_path)
-        self.opener = urllib2.build_opener()
+        self.pool = pool or ConnectionPool()
+        self.transport = transport
+        self.opener = urllib2.build_opener(*self._handlers())
+
+    def _handlers(self, extra=(), debuglevel=0):
+        handlers = [KeepAliveHandler(self.pool, debuglevel=debuglevel),
+                    HTTPSKeepAliveHandler(self.pool), DecompressionHandler()]
+        handlers.extend(extra)
+        if self.transport is not None:
+            handlers.append(self.transport)
+        return handlers
                 
     def api_addr(self):
         return self.addr
@@ -74,20 +555,47 @@ class BaseConnection:
     def api_opener(self):
         return self.opener
 
+    def api_auth_manager(self):
+        return None
+
+    def close(self):
+        """close idle pooled connections"""
+        self.pool.close()
+
+
+class PreemptiveBasicAuthHandler(urllib2.HTTPBasicAuthHandler):
+    """Sends the credentials with every request, instead of waiting for a
+    401 and repeating the request
+    """
+    def http_request(self, req):
+        if not req.has_header(self.auth_header):
+            user, password = self.passwd.find_user_password(None,
+                req.get_full_url())
+            if user is not None:
+                req.add_unredirected_header(self.auth_header, 'Basic %s' %
+                    base64.b64encode('%s:%s' % (user, password)))
+        return req
+
+    https_request = http_request
+
 
 class AuthConnection(BaseConnection):
     """Wrapper for connection details and OpenerDirector
     """
     def __init__(self, username, password, host='http://susestudio.com',
-        api_path='api/v1'):
-        BaseConnection.__init__(self, host, api_path)
+        api_path='api/v1', pool=None, transport=None, debuglevel=0):
+        BaseConnection.__init__(self, host, api_path, pool, transport)
 
         auth_manager = urllib2.HTTPPasswordMgrWithDefaultRealm()
         auth_manager.add_password(None, host, username, password)
-        auth_handler = urllib2.HTTPBasicAuthHandler(auth_manager)
+        auth_handler = PreemptiveBasicAuthHandler(auth_manager)
+        self.auth_manager = auth_manager
         
         self.opener = urllib2.build_opener(
-             urllib2.HTTPHandler(debuglevel=1), auth_handler)
+            *self._handlers([auth_handler], debuglevel=debuglevel))
+
+    def api_auth_manager(self):
+        return self.auth_manager
 
 
 class StudioError(Exception):
@@ -98,28 +606,1189 @@ class StudioError(Exception):
         self.wrapped_exc = sys.exc_info()
         
         
+class ResponseCache:
+    """Client side cache of GET responses, keyed by URL
+
+    Entries younger than ttl seconds are served without contacting the
+    server, older ones are revalidated with If-None-Match/If-Modified-Since
+    and served again on a 304.  At most maxsize entries are kept in memory
+    (least recently used are evicted), with directory set entries are also
+    kept on disk and survive the process.  Use one cache per account.
+
+    stats counts 'hits' (served without a request), 'revalidated' (served
+    after a 304) and 'misses' (lookups of a URL that isn't cached).
+    """
+    def __init__(self, maxsize=128, ttl=300, directory=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.directory = directory
+        self.stats = {'hits': 0, 'misses': 0, 'revalidated': 0}
+        self._entries = OrderedDict()
+        self._stale_before = 0
+        self._lock = threading.Lock()
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url).hexdigest())
+
+    def _load(self, url):
+        try:
+            with open(self._path(url), 'rb') as fd:
+                meta = json.loads(fd.readline())
+                if meta['url'] != url:
+                    return None
+                return (fd.read(), meta['etag'], meta['last_modified'],
+                        meta['stored_at'])
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def _save(self, url, entry):
+        body, etag, last_modified, stored_at = entry
+        path = self._path(url)
+        tmp = '%s.%d.%d' % (path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'wb') as fd:
+            fd.write(json.dumps({'url': url, 'etag': etag,
+                'last_modified': last_modified, 'stored_at': stored_at}))
+            fd.write('\n')
+            fd.write(body)
+        os.rename(tmp, path)
+
+    def _remember(self, url, entry):
+        self._entries.pop(url, None)
+        self._entries[url] = entry
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def lookup(self, url):
+        """returns (entry, fresh) - entry is None when url isn't cached
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None and self.directory:
+                entry = self._load(url)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None, False
+            self._remember(url, entry)
+            stored_at = entry[3]
+            fresh = (stored_at > self._stale_before
+                     and time.time() - stored_at < self.ttl)
+            if fresh:
+                self.stats['hits'] += 1
+            return entry, fresh
+
+    def store(self, url, body, headers):
+        """cache a 200 response, headers is its mimetools.Message
+        """
+        with self._lock:
+            if 'no-store' in (headers.getheader('Cache-Control') or ''):
+                return
+            entry = (body, headers.getheader('ETag'),
+                     headers.getheader('Last-Modified'), time.time())
+            self._remember(url, entry)
+            if self.directory:
+                self._save(url, entry)
+
+    def refresh(self, url, entry):
+        """the server answered 304 for entry - it is fresh again
+        """
+        with self._lock:
+            self.stats['revalidated'] += 1
+            entry = entry[:3] + (time.time(),)
+            self._remember(url, entry)
+            if self.directory:
+                self._save(url, entry)
+            return entry
+
+    def expire_all(self):
+        """mark every entry stale, they are revalidated on next use
+        """
+        with self._lock:
+            self._stale_before = time.time()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self.directory:
+                for name in os.listdir(self.directory):
+                    os.remove(os.path.join(self.directory, name))
+
+
+class SingleFlight:
+    """Shares the result of a call between threads that make it at once
+
+    do(key, fn) runs fn, unless a call with the same key is already
+    running - then it waits for that call and returns its result (or
+    raises its exception).  With share, every thread that joined gets
+    share(result) instead, made by the calling thread before anyone sees
+    the result - nothing is copied if nobody joined.  Results aren't kept
+    once the call is done.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}    # key -> [event, result, exc_info, followers]
+        self.stats = {'calls': 0, 'shared': 0}
+
+    def do(self, key, fn, share=None):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = [threading.Event(), None, None, 0]
+                self.stats['calls'] += 1
+            else:
+                call[3] += 1
+                self.stats['shared'] += 1
+        if leader:
+            try:
+                call[1] = fn()
+            except:
+                call[2] = sys.exc_info()
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                if call[2] is None and share is not None:
+                    try:
+                        call[1] = [share(call[1]) for i in range(call[3])
+                                   ] + [call[1]]
+                    except:
+                        call[2] = sys.exc_info()
+                call[0].set()
+        else:
+            call[0].wait()
+        if call[2] is not None:
+            raise call[2][0], call[2][1], call[2][2]
+        if share is not None:
+            with self._lock:
+                return call[1].pop()
+        return call[1]
+
+
+def _retry_after(headers):
+    """seconds to wait from a Retry-After header (delay or HTTP date)"""
+    value = headers.getheader('Retry-After') if headers else None
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, mktime_tz(date) - time.time())
+
+
+class RetryPolicy:
+    """Which failed requests StudioAPI retries, and how long it waits
+
+    Idempotent requests (methods) that fail with a connection error, a
+    timeout or one of statuses are retried up to retries times.  The wait
+    is a random delay of up to backoff * 2**attempt seconds (capped at
+    max_backoff), so clients that failed together don't retry together.
+    A Retry-After header is respected, unless it asks for more than
+    max_backoff - then the error is raised.
+    """
+    def __init__(self, retries=3, backoff=0.5, max_backoff=30,
+        statuses=(429, 500, 502, 503, 504),
+        methods=('GET', 'HEAD', 'PUT', 'DELETE')):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = statuses
+        self.methods = methods
+
+    def delay(self, request, attempt, error):
+        """seconds to wait before retrying request, None to give up
+        """
+        if attempt >= self.retries or request.get_method() not in self.methods:
+            return None
+        if isinstance(error, urllib2.HTTPError):
+            if error.code not in self.statuses:
+                return None
+            retry_after = _retry_after(error.info())
+            if retry_after is not None:
+                if retry_after > self.max_backoff:
+                    return None
+                return retry_after
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """Per host circuit breaker
+
+    After threshold consecutive failures (5xx responses, connection errors
+    and timeouts) requests to a host fail straight away with a StudioError.
+    After reset_timeout seconds one trial request is let through, if it
+    succeeds the circuit closes again.
+    """
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._hosts = {}    # host -> [failures, opened_at, trial_running]
+
+    def check(self, host):
+        """raises a StudioError while the circuit for host is open
+
+        Returns True if the request is the trial, the caller must then
+        resolve it with success, failure or release.
+        """
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None or state[1] is None:
+                return False
+            if time.time() - state[1] < self.reset_timeout or state[2]:
+                raise StudioError, "%s is failing, not sending request" % host
+            state[2] = True
+            return True
+
+    def release(self, host):
+        """gives up a trial without a verdict, the next request is the
+        trial instead
+        """
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is not None:
+                state[2] = False
+
+    def success(self, host):
+        with self._lock:
+            self._hosts.pop(host, None)
+
+    def failure(self, host):
+        with self._lock:
+            state = self._hosts.setdefault(host, [0, None, False])
+            state[0] += 1
+            if state[0] >= self.threshold:
+                state[1] = time.time()
+                state[2] = False
+
+
+class RateLimiter:
+    """Token bucket rate limits per host and HTTP verb
+
+        Arguments:
+
+            rate (optional) - requests per second to a host, None for no
+                              limit by default
+            burst (optional) - requests that may be sent at once after an
+                               idle period, default rate (at least 1)
+            limits (optional) - {(host, verb): (rate, burst)} overriding the
+                                default, host or verb None for any
+            path (optional) - state file shared with the other processes
+                              using the same path, default this process only
+
+    Every request takes a token from the bucket of its host and, if a
+    limit for its verb is configured, from the bucket of that verb at the
+    host; it waits until both have one.  Tokens are reserved, so waiting
+    requests are let through one after the other at the configured rate
+    instead of all at once.  A 429 response empties the buckets of the
+    host for the Retry-After time.  With path the buckets live in that
+    file, guarded by an flock, and a pool of worker processes shares one
+    budget.
+    """
+    def __init__(self, rate=None, burst=None, limits=None, path=None):
+        if path is not None and (fcntl is None or json is None):
+            raise StudioError, "a shared RateLimiter needs fcntl and json"
+        self.limits = {}
+        if rate is not None:
+            self.limits[(None, None)] = (rate, burst)
+        self.limits.update(limits or {})
+        self.path = path
+        self._lock = threading.Lock()
+        self._buckets = {}  # 'host verb' -> [tokens, updated]
+
+    def _rules(self, host, verb):
+        """[(bucket, rate, burst)] that apply to a request"""
+        rules = []
+        for key, bucket in ((((host, None), (None, None)), host + ' *'),
+                            (((host, verb), (None, verb)), host + ' ' + verb)):
+            for candidate in key:
+                if candidate in self.limits:
+                    rate, burst = self.limits[candidate]
+                    if burst is None:
+                        burst = max(1, rate)
+                    rules.append((bucket, rate, burst))
+                    break
+        return rules
+
+    def reserve(self, request):
+        """take the tokens for request, returns the seconds to wait first
+        """
+        rules = self._rules(request.get_host(), request.get_method())
+        if not rules:
+            return 0
+        def take(buckets, now):
+            wait = 0
+            for bucket, rate, burst in rules:
+                tokens, updated = buckets.get(bucket, (burst, now))
+                tokens = min(burst, tokens + (now - updated) * rate) - 1
+                buckets[bucket] = [tokens, now]
+                if tokens < 0:
+                    wait = max(wait, -tokens / float(rate))
+            return wait
+        return self._update(take)
+
+    def acquire(self, request):
+        """wait until request may be sent, returns the seconds waited
+        """
+        wait = self.reserve(request)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self, request, delay=None):
+        """the server asked to slow down: nothing more is sent to the host
+        for delay seconds (by default one token's worth)
+        """
+        host = request.get_host()
+        rules = self._rules(host, request.get_method())
+        def drain(buckets, now):
+            for bucket, rate, burst in rules:
+                tokens = -rate * (delay if delay is not None else 1.0 / rate)
+                current = buckets.get(bucket, (burst, now))[0]
+                buckets[bucket] = [min(current, tokens), now]
+        self._update(drain)
+
+    def _update(self, change):
+        """run change(buckets, now) on the buckets, in the state file if
+        they are shared
+        """
+        with self._lock:
+            if self.path is None:
+                return change(self._buckets, time.time())
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                data = ''
+                while True:
+                    block = os.read(fd, 65536)
+                    if not block:
+                        break
+                    data += block
+                try:
+                    buckets = json.loads(data) if data else {}
+                except ValueError:
+                    buckets = {}
+                result = change(buckets, time.time())
+                data = json.dumps(buckets)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, data)
+                return result
+            finally:
+                os.close(fd)    # releases the flock
+
+
+def _endpoint(url):
+    """endpoint label for url - the path below the API root, ids replaced"""
+    path = urlparse.urlsplit(url).path
+    index = path.find('/user/')
+    if index >= 0:
+        path = path[index:]
+    return re.sub(r'/\d+(?=/|$)', '/:id', path)
+
+
+class Instrumentation:
+    """Timings, sizes and status codes of StudioAPI requests
+
+    Histograms (seconds, or bytes) per endpoint and HTTP verb:
+
+        connect_seconds - opening a new connection (reused ones are skipped)
+        first_byte_seconds - sending the request until the response headers
+        request_seconds - the whole request, until the response is closed
+        response_bytes - size of the response body
+        parse_seconds - building the XML tree
+
+    and counters: requests (per status, 'error' for transport errors) and
+    retries.  Hooks are called as hook(metric, labels, value) for every
+    observation.  export() renders everything in the Prometheus text format.
+    """
+    second_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                      10, 30, 60)
+    byte_buckets = (1024, 10240, 102400, 1048576, 10485760, 104857600,
+                    1073741824)
+    prefix = 'studio_'
+
+    def __init__(self, hooks=()):
+        self.hooks = list(hooks)
+        self._lock = threading.Lock()
+        self._histograms = OrderedDict()  # (metric, labels) -> [counts, sum, n]
+        self._counters = OrderedDict()    # (metric, labels) -> value
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def observe(self, metric, request, value):
+        labels = (('endpoint', _endpoint(request.get_full_url())),
+                  ('verb', request.get_method()))
+        buckets = self._buckets(metric)
+        with self._lock:
+            histogram = self._histograms.get((metric, labels))
+            if histogram is None:
+                histogram = [[0] * len(buckets), 0, 0]
+                self._histograms[(metric, labels)] = histogram
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+        self._call_hooks(metric, labels, value)
+
+    def count(self, metric, request, status=None):
+        labels = (('endpoint', _endpoint(request.get_full_url())),
+                  ('verb', request.get_method()))
+        if status is not None:
+            labels += (('status', str(status)),)
+        with self._lock:
+            self._counters[(metric, labels)] = (
+                self._counters.get((metric, labels), 0) + 1)
+        self._call_hooks(metric, labels, 1)
+
+    def _call_hooks(self, metric, labels, value):
+        for hook in self.hooks:
+            hook(metric, dict(labels), value)
+
+    def _buckets(self, metric):
+        if metric.endswith('_bytes'):
+            return self.byte_buckets
+        return self.second_buckets
+
+    def export(self):
+        """all metrics in the Prometheus text exposition format
+        """
+        def label_text(labels):
+            return ','.join('%s="%s"' % (k, v.replace('\\', '\\\\')
+                            .replace('"', '\\"')) for k, v in labels)
+        lines = []
+        typed = set()
+        with self._lock:
+            for (metric, labels), (counts, total, n) in sorted(
+                self._histograms.items()):
+                name = self.prefix + metric
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE %s histogram' % name)
+                for bound, count in zip(self._buckets(metric), counts):
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (
+                        name, label_text(labels), bound, count))
+                lines.append('%s_bucket{%s,le="+Inf"} %d' % (
+                    name, label_text(labels), n))
+                lines.append('%s_sum{%s} %r' % (name, label_text(labels),
+                                                total))
+                lines.append('%s_count{%s} %d' % (name, label_text(labels), n))
+            for (metric, labels), value in sorted(self._counters.items()):
+                name = self.prefix + metric + '_total'
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE %s counter' % name)
+                lines.append('%s{%s} %d' % (name, label_text(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+class _InstrumentedResponse:
+    """Counts the bytes read from a response, reports them (and the total
+    request time) when it is closed
+    """
+    def __init__(self, response, instrumentation, request, started):
+        self._response = response
+        self._instrumentation = instrumentation
+        self._request = request
+        self._started = started
+        self._bytes = 0
+
+    def read(self, *args):
+        data = self._response.read(*args)
+        self._bytes += len(data)
+        return data
+
+    def readline(self, *args):
+        data = self._response.readline(*args)
+        self._bytes += len(data)
+        return data
+
+    def close(self):
+        if self._instrumentation is not None:
+            instrumentation, self._instrumentation = self._instrumentation, None
+            instrumentation.observe('response_bytes', self._request,
+                                    self._bytes)
+            instrumentation.observe('request_seconds', self._request,
+                                    time.time() - self._started)
+        self._response.close()
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+def _checksums(element):
+    """returns {algorithm: hexdigest} from a checksum element - both the
+    <checksum type="md5">...</checksum> (rpms, files) and the
+    <checksum><md5>...</md5><sha1>...</sha1></checksum> (builds) forms
+    """
+    checksums = {}
+    node = element.find('checksum')
+    if node is None:
+        return checksums
+    if len(node):
+        for child in node:
+            if child.text and child.text.strip():
+                checksums[child.tag.lower()] = child.text.strip()
+    elif node.text and node.text.strip():
+        checksums[node.get('type', 'md5').lower()] = node.text.strip()
+    return checksums
+
+
+def _validator(headers):
+    """the If-Range validator of a response - a strong ETag, else its
+    Last-Modified date, else None
+    """
+    etag = headers.getheader('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.getheader('Last-Modified')
+
+def _load_state(path):
+    """the download state saved at path, None if there is none"""
+    if json is None or not os.path.exists(path):
+        return None
+    try:
+        with open(path) as fd:
+            return json.load(fd)
+    except ValueError:
+        return None
+
+def _save_state(path, state):
+    if json is None:
+        return
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fd:
+        fd.write(json.dumps(state))
+    os.rename(tmp, path)
+
+
+class _RangeDownload:
+    """Fetches the ranges of a file with concurrent Range requests, and
+    hashes it while they land
+
+    state is {'source', 'url', 'size', 'validator', 'ranges'}, each range
+    being [start, end, bytes done].  It is saved next to the file while the
+    download runs, so an interrupted download can be resumed.
+
+    The hashes follow a frontier, the end of the data complete from the
+    start of the file.  A block written right at the frontier is hashed as
+    it arrives, data that landed ahead of it is read back once the gap
+    before it has been filled - read_back counts those bytes.
+    """
+    save_interval = 5
+
+    def __init__(self, studio, dest, state, hashes, workers, retries):
+        self.studio = studio
+        self.dest = dest
+        self.state = state
+        self.state_path = dest + '.parts'
+        self.hashes = hashes
+        self.workers = workers
+        self.retries = retries
+        self.error = None
+        self.changed = False    # the server no longer has the same file
+        self.read_back = 0
+        self._cond = threading.Condition()
+        self._todo = Queue.Queue()
+        self._hashed = 0        # the hashes cover the file up to here
+        self._hash_lock = threading.Lock()
+        self._reader = None
+
+    def run(self):
+        ranges = self.state['ranges']
+        for r in ranges:
+            if r[2] < r[1] - r[0]:
+                self._todo.put(r)
+        threads = [threading.Thread(target=self._worker)
+                   for i in range(min(self.workers, self._todo.qsize()))]
+        for t in threads:
+            t.start()
+        try:
+            try:
+                self._wait()
+            finally:
+                with self._cond:
+                    if (self.error is None
+                        and self._frontier() < self.state['size']):
+                        self.error = sys.exc_info()
+                    self._cond.notify_all()
+                for t in threads:
+                    t.join()
+                if self._frontier() < self.state['size']:
+                    self._save()
+            if self.error is not None:
+                raise self.error[0], self.error[1], self.error[2]
+            self._hash_to(self.state['size'])
+        finally:
+            if self._reader is not None:
+                self._reader.close()
+
+    def _frontier(self):
+        """end of the data that is complete from the start of the file"""
+        for start, end, done in self.state['ranges']:
+            if done < end - start:
+                return start + done
+        return self.state['size']
+
+    def _wait(self):
+        """wait for the workers, hashing up to the frontier as it moves and
+        saving the state every save_interval
+        """
+        size = self.state['size']
+        saved = time.time()
+        while True:
+            with self._cond:
+                if self.error is not None or self._frontier() == size:
+                    return
+                self._cond.wait(self.save_interval)
+                frontier = self._frontier()
+            self._hash_to(frontier)
+            if time.time() - saved > self.save_interval:
+                self._save()
+                saved = time.time()
+
+    def _hash_to(self, frontier):
+        """hash the data between the hashed part and frontier, read back
+        from the file
+
+        Only flushed blocks are below the frontier, the read is unbuffered
+        so it can't hold data read ahead of the workers.
+        """
+        if not self.hashes:
+            return
+        with self._hash_lock:
+            if self._hashed >= frontier:
+                return
+            if self._reader is None:
+                self._reader = open(self.dest, 'rb', 0)
+            self._reader.seek(self._hashed)
+            while self._hashed < frontier:
+                block = self._reader.read(min(self.studio.download_chunk_size,
+                                              frontier - self._hashed))
+                if not block:
+                    raise StudioError, "%s is shorter than expected" % (
+                        self.dest)
+                for h in self.hashes.values():
+                    h.update(block)
+                self._hashed += len(block)
+                self.read_back += len(block)
+
+    def _hash_block(self, offset, block):
+        """hash a block just written at offset if it is next in line, it
+        is read back later otherwise
+        """
+        if not self.hashes or not self._hash_lock.acquire(False):
+            return
+        try:
+            if self._hashed == offset:
+                for h in self.hashes.values():
+                    h.update(block)
+                self._hashed += len(block)
+        finally:
+            self._hash_lock.release()
+
+    def _worker(self):
+        with open(self.dest, 'r+b') as fd:
+            while self.error is None:
+                try:
+                    r = self._todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self._fetch(fd, r)
+                except Exception:
+                    with self._cond:
+                        if self.error is None:
+                            self.error = sys.exc_info()
+                        self._cond.notify_all()
+                    return
+
+    def _fetch(self, fd, r):
+        start, end = r[0], r[1]
+        attempt = 0
+        while r[2] < end - start and self.error is None:
+            req = HTTPGetRequest(self.state['url'])
+            req.add_header('Accept-Encoding', 'identity')
+            req.add_header('Range', 'bytes=%d-%d' % (start + r[2], end - 1))
+            if self.state.get('validator'):
+                req.add_header('If-Range', self.state['validator'])
+            try:
+                with closing(self.studio._urlopen(req)) as response:
+                    if response.getcode() != 206:
+                        self.changed = True
+                        raise StudioError, ("%s ignored the Range request or "
+                                            "changed" % self.state['url'])
+                    fd.seek(start + r[2])
+                    while r[2] < end - start and self.error is None:
+                        block = response.read(min(
+                            self.studio.download_chunk_size,
+                            end - start - r[2]))
+                        if not block:
+                            raise httplib.IncompleteRead('', end - start - r[2])
+                        fd.write(block)
+                        fd.flush()
+                        self._hash_block(start + r[2], block)
+                        with self._cond:
+                            r[2] += len(block)
+                            self._cond.notify_all()
+            except urllib2.HTTPError:
+                raise
+            except (socket.error, httplib.HTTPException, urllib2.URLError):
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+
+    def _save(self):
+        with self._cond:
+            state = copy.deepcopy(self.state)
+        _save_state(self.state_path, state)
+
+
 class StudioAPI:
     """SUSE Studio REST API client implementation
     """
-    def __init__(self, studio_connection):
+    download_chunk_size = 65536
+    download_range_size = 8 * 1024 * 1024
+
+    def __init__(self, studio_connection, cache=None, retry=None,
+        breaker=None, coalesce=True, instrumentation=None, limiter=None):
+        self.cache = cache
+        self.retry = retry
+        self.breaker = breaker
+        self.limiter = limiter
+        self.instrumentation = instrumentation
+        self.inflight = SingleFlight() if coalesce else None
         self.opener = studio_connection.api_opener()
-        self.opener.add_handler(MultipartPostHandler())
+        if not [h for h in self.opener.handlers
+                if isinstance(h, MultipartPostHandler)]:
+            self.opener.add_handler(MultipartPostHandler())
         self.api_addr = studio_connection.api_addr()
         urllib2.install_opener(self.opener)
 
-    def _opener(self, request, raw=False):
-        with closing(urllib2.urlopen(request)) as response:
+    def _urlopen(self, request):
+        """urllib2.urlopen, with self.retry, self.breaker, self.limiter and
+        self.instrumentation applied
+
+        An HTTP 500 that isn't resolved by retrying is raised as a
+        StudioError.
+        """
+        host = request.get_host()
+        instrumentation = self.instrumentation
+        attempt = 0
+        while True:
+            trial = False
+            if self.breaker is not None:
+                trial = self.breaker.check(host)
             try:
-                if raw:
-                    return response.read()
+                if self.limiter is not None:
+                    self.limiter.acquire(request)
+                started = time.time()
+                try:
+                    response = urllib2.urlopen(request)
+                except (urllib2.URLError, socket.error, httplib.HTTPException):
+                    exc_info = sys.exc_info()
+                    error = exc_info[1]
                 else:
-                    return ET.parse(response).getroot()
+                    error = None
+                if self.breaker is not None:
+                    if error is None or (isinstance(error, urllib2.HTTPError)
+                                         and error.code < 500):
+                        self.breaker.success(host)
+                    else:
+                        self.breaker.failure(host)
+            finally:
+                # an unexpected exception mustn't leave the host open
+                if trial:
+                    self.breaker.release(host)
+
+            if error is None:
+                if instrumentation is None:
+                    return response
+                self._observe_timings(request)
+                instrumentation.count('requests', request, response.code)
+                return _InstrumentedResponse(response, instrumentation,
+                                             request, started)
+
+            if instrumentation is not None:
+                self._observe_timings(request)
+                instrumentation.count('requests', request,
+                    getattr(error, 'code', 'error'))
+            if (self.limiter is not None
+                and isinstance(error, urllib2.HTTPError) and error.code == 429):
+                self.limiter.throttled(request, _retry_after(error.info()))
+            delay = None
+            if self.retry is not None:
+                delay = self.retry.delay(request, attempt, error)
+            if delay is None:
+                if isinstance(error, urllib2.HTTPError):
+                    if error.code in [500,]: # TODO: list of HTTP Errors to wrap
+                        raise StudioError, "report error to the library maintainer"
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if isinstance(error, urllib2.HTTPError):
+                error.close()
+            if instrumentation is not None:
+                instrumentation.count('retries', request)
+            time.sleep(delay)
+            attempt += 1
+
+    def _observe_timings(self, request):
+        timings = getattr(request, 'timings', None)
+        if timings:
+            for metric, value in timings.items():
+                self.instrumentation.observe(metric, request, value)
+            request.timings = {}
+
+    def _parse(self, request, body):
+        if self.instrumentation is None:
+            return ET.fromstring(body)
+        started = time.time()
+        root = ET.fromstring(body)
+        self.instrumentation.observe('parse_seconds', request,
+                                     time.time() - started)
+        return root
+
+    def _download(self, url, dest, checksums=None, resume=True, retries=3):
+        """Stream url into dest in download_chunk_size blocks
+
+            Arguments:
+
+                url - url to fetch
+                dest - file name, or a writable file object
+                checksums (optional) - {algorithm: hexdigest} to verify
+                resume (optional) - continue an interrupted download of url
+                                    to dest (file names only)
+                retries (optional) - how often an interrupted transfer is
+                                     resumed with an HTTP Range request
+
+            A file name is downloaded into dest.part, which only replaces
+            dest once it is complete.  The ETag or Last-Modified of the
+            first response is kept in dest.parts, a resumed download sends
+            it as If-Range so a file that changed meanwhile is fetched
+            whole again; without one the download starts over.
+
+            Returns the size of the downloaded file.  A StudioError is raised
+            if the content doesn't match checksums, in which case dest.part
+            is removed so the next attempt starts from scratch.
+        """
+        hashes = dict((name, hashlib.new(name)) for name in checksums or {})
+        if not isinstance(dest, basestring):
+            size = self._download_to(url, dest, 0, hashes, retries, {})
+            self._verify(url, hashes, checksums)
+            return size
+
+        part = dest + '.part'
+        state_path = dest + '.parts'
+        state = _load_state(state_path) if resume else None
+        if (state is None or state.get('source') != url
+            or not state.get('validator') or not os.path.exists(part)):
+            state = {'source': url, 'validator': None}
+        save = lambda: _save_state(state_path, state)
+        with open(part, 'r+b' if state['validator'] else 'wb') as fd:
+            offset = 0
+            if state['validator']:
+                for block in iter(
+                    lambda: fd.read(self.download_chunk_size), ''):
+                    for h in hashes.values():
+                        h.update(block)
+                    offset += len(block)
+                fd.seek(offset)
+            size = self._download_to(url, fd, offset, hashes, retries, state,
+                                     save)
+        try:
+            self._verify(url, hashes, checksums)
+        except StudioError:
+            os.remove(part)
+            raise
+        finally:
+            if os.path.exists(state_path):
+                os.remove(state_path)
+        os.rename(part, dest)
+        return size
+
+    @staticmethod
+    def _verify(url, hashes, checksums):
+        for name, h in hashes.items():
+            if h.hexdigest() != checksums[name].lower():
+                raise StudioError, "%s checksum mismatch for %s" % (name, url)
+
+    def _download_ranges(self, url, dest, checksums=None, resume=True,
+        workers=4, retries=3):
+        """Download url into the file dest with concurrent Range requests
+
+            Arguments:
+
+                url - url to fetch
+                dest - file name
+                checksums (optional) - {algorithm: hexdigest} to verify
+                resume (optional) - continue an interrupted download of url
+                                    to dest
+                workers (optional) - number of ranges fetched at once
+                retries (optional) - how often each range is resumed after
+                                     a broken transfer
+
+            The file is preallocated (sparse) and split into ranges of about
+            download_range_size bytes, it is hashed while they land.
+            Servers that don't support ranges get a single stream download.
+            Ranges are sent with the probe's ETag or Last-Modified as
+            If-Range, a download is only resumed if the server gave one.
+            Returns the size of the downloaded file, see _download for the
+            checksum handling.
+        """
+        state_path = dest + '.parts'
+        state = None
+        if resume and os.path.exists(dest):
+            state = _load_state(state_path)
+            if (state is None or state.get('source') != url
+                or 'ranges' not in state or not state.get('validator')):
+                state = None
+        if state is None:
+            final_url, size, validator = self._probe_ranges(url)
+            if size is None:
+                return self._download(url, dest, checksums, False, retries)
+            step = max(self.download_range_size, -(-size // (workers * 4)))
+            state = {'source': url, 'url': final_url, 'size': size,
+                     'validator': validator,
+                     'ranges': [[start, min(start + step, size), 0]
+                                for start in xrange(0, size, step)]}
+            with open(dest, 'wb') as fd:
+                fd.truncate(size)
+
+        hashes = dict((name, hashlib.new(name)) for name in checksums or {})
+        download = _RangeDownload(self, dest, state, hashes, workers, retries)
+        try:
+            download.run()
+        except StudioError:
+            # the saved ranges belong to the old file, start over next time
+            if download.changed and os.path.exists(state_path):
+                os.remove(state_path)
+            raise
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        for name, h in hashes.items():
+            if h.hexdigest() != checksums[name].lower():
+                os.remove(dest)
+                raise StudioError, "%s checksum mismatch for %s" % (name, url)
+        return state['size']
+
+    def _probe_ranges(self, url):
+        """returns (url after redirects, size, If-Range validator) - size is
+        None if the server doesn't support Range requests
+        """
+        req = HTTPGetRequest(url)
+        req.add_header('Accept-Encoding', 'identity')
+        req.add_header('Range', 'bytes=0-0')
+        with closing(self._urlopen(req)) as response:
+            if response.getcode() != 206:
+                return response.geturl(), None, None
+            total = (response.info().getheader('Content-Range') or ''
+                     ).rpartition('/')[2].strip()
+            return (response.geturl(), int(total) if total.isdigit() else None,
+                    _validator(response.info()))
+
+    def _download_to(self, url, fd, offset, hashes, retries, state,
+        save=None):
+        """stream url into fd from offset, resuming with Range requests
+
+        state['validator'] is sent as If-Range and set from the response
+        that starts the file, save() is called when it changes.
+        """
+        try:
+            start = fd.tell() - offset
+        except (AttributeError, IOError):
+            start = None
+
+        attempt = 0
+        while True:
+            req = HTTPGetRequest(url)
+            # offsets and checksums are for the file as stored
+            req.add_header('Accept-Encoding', 'identity')
+            if offset:
+                req.add_header('Range', 'bytes=%d-' % offset)
+                if state.get('validator'):
+                    req.add_header('If-Range', state['validator'])
+            try:
+                with closing(self._urlopen(req)) as response:
+                    if offset and response.getcode() != 206:
+                        # Range was ignored or the file changed, the whole
+                        # file is coming again
+                        if start is None:
+                            raise StudioError, "can't restart download of %s" % url
+                        fd.seek(start)
+                        fd.truncate()
+                        for name in hashes:
+                            hashes[name] = hashlib.new(name)
+                        offset = 0
+                    if not offset:
+                        state['validator'] = _validator(response.info())
+                        if save is not None:
+                            save()
+                    length = response.info().getheader('Content-Length')
+                    expected = offset + int(length) if length else None
+                    for block in iter(
+                        lambda: response.read(self.download_chunk_size), ''):
+                        fd.write(block)
+                        for h in hashes.values():
+                            h.update(block)
+                        offset += len(block)
+                    if expected is not None and offset < expected:
+                        raise httplib.IncompleteRead('', expected - offset)
+                return offset
             except urllib2.HTTPError, e:
-                if e.code in [500,]: # TODO: list of HTTP Errors to wrap
-                    raise StudioError, "report error to the library maintainer"
-                else:
+                if e.code == 416 and offset:
+                    return offset   # nothing left to fetch
+                raise
+            except (socket.error, httplib.HTTPException, urllib2.URLError):
+                attempt += 1
+                if attempt > retries:
                     raise
-                
+
+    def _fetch(self, request, raw=False):
+        with closing(self._urlopen(request)) as response:
+            if raw:
+                return response.read()
+            elif self.instrumentation is not None:
+                return self._parse(request, response.read())
+            else:
+                return ET.parse(response).getroot()
+
+    def _cached_open(self, request, raw):
+        url = request.get_full_url()
+        entry, fresh = self.cache.lookup(url)
+        if not fresh:
+            if entry is not None:
+                body, etag, last_modified, stored_at = entry
+                if etag:
+                    request.add_header('If-None-Match', etag)
+                if last_modified:
+                    request.add_header('If-Modified-Since', last_modified)
+            try:
+                with closing(self._urlopen(request)) as response:
+                    body = response.read()
+                    self.cache.store(url, body, response.info())
+                entry = None
+            except urllib2.HTTPError, e:
+                if e.code != 304 or entry is None:
+                    raise
+                e.close()
+                entry = self.cache.refresh(url, entry)
+        if entry is not None:
+            body = entry[0]
+        return body if raw else self._parse(request, body)
+
+    def _iterparse(self, request, tags, context=None):
+        """Parse the response incrementally, yielding each element with a
+        tag in tags as soon as it is complete
+
+        With context set, yields (ancestor, element) where ancestor is the
+        nearest enclosing element with that tag.  An element is cleared and
+        dropped from the tree when the next one is requested, so memory use
+        doesn't grow with the size of the response - copy what you need.
+        """
+        if isinstance(tags, basestring):
+            tags = (tags,)
+        with closing(self._urlopen(request)) as response:
+            stack = []
+            for event, elem in ET.iterparse(response, events=('start', 'end')):
+                if event == 'start':
+                    stack.append(elem)
+                    continue
+                stack.pop()
+                if elem.tag not in tags:
+                    continue
+                if context is None:
+                    yield elem
+                else:
+                    ancestor = None
+                    for node in reversed(stack):
+                        if node.tag == context:
+                            ancestor = node
+                            break
+                    yield ancestor, elem
+                elem.clear()
+                if stack:
+                    stack[-1].remove(elem)
+
+    def _opener(self, request, raw=False, cacheable=False):
+        """cacheable GET requests go through self.cache (if there is one),
+        any other request marks cached responses as stale
+
+        Threads that GET the same URL at the same time share one request
+        (unless the instance was created with coalesce=False).  The
+        response is still parsed as it streams in, the threads that joined
+        get their own copy of the tree.
+        """
+        if request.get_method() == 'GET':
+            if cacheable and self.cache is not None:
+                fetch = self._cached_open
+            else:
+                fetch = self._fetch
+            if self.inflight is None:
+                return fetch(request, raw)
+            return self.inflight.do((request.get_full_url(), raw),
+                lambda: fetch(request, raw),
+                None if raw else copy.deepcopy)
+        if self.cache is None:
+            return self._fetch(request, raw)
+        try:
+            return self._fetch(request, raw)
+        finally:
+            self.cache.expire_all()
+
+    def batch(self, method, ids, max_workers=4):
+        """Call method once per id on a pool of max_workers threads
+
+            Arguments:
+
+                method - a StudioAPI method, or its name
+                         e.g. 'get_appliance_status'
+                ids - the first argument for each call, a tuple is passed
+                      as the argument list
+                max_workers (optional) - number of concurrent calls
+
+            Yields (id, result, error) as the calls complete, error is the
+            exception raised by that call (result is then None).  A failing
+            call doesn't stop the batch.  Calls to one host are also bounded
+            by the connection pool size.  Closing the generator early lets
+            the calls already running finish but starts no new ones.
+        """
+        if isinstance(method, basestring):
+            method = getattr(self, method)
+        ids = list(ids)
+        todo = Queue.Queue()
+        done = Queue.Queue()
+        stop = threading.Event()
+        for item in ids:
+            todo.put(item)
+
+        def worker():
+            while not stop.is_set():
+                try:
+                    item = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                args = item if isinstance(item, tuple) else (item,)
+                try:
+                    done.put((item, method(*args), None))
+                except Exception, e:
+                    done.put((item, None, e))
+
+        for i in range(min(max_workers, len(ids))):
+            thread = threading.Thread(target=worker)
+            # a batch that is closed early doesn't keep the process alive
+            thread.daemon = True
+            thread.start()
+        try:
+            for i in range(len(ids)):
+                yield done.get()
+        finally:
+            stop.set()
+
     ###############################################################
     # GENERAL INFORMATION
     ###############################################################
@@ -150,7 +1819,7 @@ class StudioAPI:
             Returns the running API version including the minor version.
         """
         req = HTTPGetRequest(self.api_addr+'/user/api_version')
-        return self._opener(req)
+        return self._opener(req, cacheable=True)
 
     ############################################################
     # Template sets
@@ -176,7 +1845,7 @@ class StudioAPI:
         else:
             url = self.api_addr + '/user/template_sets'
         req = HTTPGetRequest(url)
-        return self._opener(req)
+        return self._opener(req, cacheable=True)
 
     ############################################################
     # Appliances
@@ -190,6 +1859,16 @@ class StudioAPI:
         req = HTTPGetRequest(url)
         return self._opener(req)
 
+    def iter_appliances(self):
+        """GET /api/v1/user/appliances
+
+        Yields the appliances of the current user one at a time, as they
+        are parsed.
+        """
+        url = self.api_addr+'/user/appliances'
+        req = HTTPGetRequest(url)
+        return self._iterparse(req, 'appliance')
+
     def get_appliance_status(self, id):
         """GET /api/v1/user/appliances/<id>/status
             
@@ -248,7 +1927,7 @@ class StudioAPI:
         """
         url = self.api_addr+'/user/appliances/%s/repositories' % id
         req = HTTPGetRequest(url)
-        return self._opener(req)
+        return self._opener(req, cacheable=True)
 
     def _set_appliance_repositories(self, appliance_id, xml_root=None):
         """PUT /api/v1/user/appliances/<appliance_id>/repositories
@@ -372,6 +2051,22 @@ class StudioAPI:
         req = HTTPGetRequest(url)
         return self._opener(req)
 
+    def iter_appliance_installed_software(self, id, build_id=''):
+        """GET /api/v1/user/appliances/<id>/software/installed?build_id=<build>
+
+        Arguments:
+
+            id - Id of the appliance
+            build_id (optional) - Id of the build.
+
+        Streaming get_appliance_installed_software, yields
+        (repository, package_or_pattern) one at a time as they are parsed.
+        """
+        query = urllib.urlencode({'buildid':build_id})
+        url = self.api_addr+'/user/appliances/%s/installed?%s' % (id, query)
+        req = HTTPGetRequest(url)
+        return self._iterparse(req, ('package', 'pattern'), 'repository')
+
     def add_appliance_software_package(self, id, name, version='', repository_id=''):
         """POST /api/v1/user/appliances/<id>/cmd/add_package?name=<name>
         &version=<version>&repository_id=<repo_id>
@@ -496,6 +2191,27 @@ class StudioAPI:
         req = HTTPGetRequest(url)
         return self._opener(req)
 
+    def iter_appliance_software_search(self, id, q, all_fields=False,
+        all_repos=False):
+        """GET /api/v1/user/appliances/<id>/software/search?q=<search_string>&all_fields=<all_fields>&all_repos=<all_repos>
+
+            Arguments:
+
+                id - Id of the appliance
+                q - The search string
+                all_fields (optional) - Search all fields, not just the name.
+                all_repos (optional) - Search all repositories.
+
+            Streaming search_appliance_software, yields
+            (repository, package_or_pattern) one at a time as they are
+            parsed.
+        """
+        query = urllib.urlencode({'q':q, 'all_fields':all_fields,
+            'all_repos':all_repos})
+        url = self.api_addr+'/user/appliances/%s/software/search?%s' % (id, query)
+        req = HTTPGetRequest(url)
+        return self._iterparse(req, ('package', 'pattern'), 'repository')
+
     #########################################################################
     # Image files
     #########################################################################
@@ -515,6 +2231,26 @@ class StudioAPI:
         req = HTTPGetRequest(url)
         return self._opener(req)
 
+    def download_appliance_image_file(self, id, build_id, path, dest,
+        resume=True):
+        """GET /api/v1/user/appliances/<id>/image_files?build_id=<build_id>&path=<path_to_file>
+
+            Arguments:
+
+                id - Id of the appliance.
+                build_id - Id of the build.
+                path - Path to the file in the built appliance.
+                dest - File name or writable file object to write to.
+                resume (optional) - Continue an interrupted download to dest,
+                                    if the file hasn't changed since.
+
+            Streams the file with the given path from an image to dest,
+            returns the size of the file.
+        """
+        query = urllib.urlencode({'build_id':build_id, 'path':path})
+        url = self.api_addr+'/user/appliances/%s/image_files?%s' % (id, query)
+        return self._download(url, dest, resume=resume)
+
     ############################################################################
     # GPG Keys
     ############################################################################
@@ -529,7 +2265,7 @@ class StudioAPI:
         """
         url = self.api_addr+'/user/appliances/%s/gpg_keys' % id
         req = HTTPGetRequest(url)
-        return self._opener(req)
+        return self._opener(req, cacheable=True)
 
     def get_appliance_gpg_key(self, id, key_id):
         """GET /api/v1/user/appliances/<id>/gpg_keys/<key_id>
@@ -543,7 +2279,7 @@ class StudioAPI:
         """
         url = self.api_addr+'/user/appliances/%s/gpg_keys/%s' % (id, key_id)
         req = HTTPGetRequest(url)
-        return self._opener(req)
+        return self._opener(req, cacheable=True)
 
     def upload_appliance_gpg_key(self, id, name, target, key='', key_file=None):
         """POST /api/v1/user/appliances/<id>/gpg_keys?name=<name>&target=<target>&key=<the_key>
@@ -633,7 +2369,7 @@ class StudioAPI:
         if overlay_file and file_url:
             raise ValueError, "use overlay_file or file_url, not both"
         
-        data = {'appliance_id':id,
+        data = {'appliance_id':appliance_id,
             'filename':filename,
             'path':path,
             'owner':owner,
@@ -665,6 +2401,27 @@ class StudioAPI:
         req = HTTPGetRequest(url)
         return self._opener(req)
 
+    def download_overlay_file(self, file_id, dest, verify=True, resume=True):
+        """GET /api/v1/user/files/<file_id>/data
+
+            Arguments:
+
+                file_id - Id of the file.
+                dest - File name or writable file object to write to.
+                verify (optional) - Check the download against the checksum
+                                    in the file meta data.
+                resume (optional) - Continue an interrupted download to dest,
+                                    if the file hasn't changed since.
+
+            Streams the file with id file_id to dest, returns the size of the
+            file.
+        """
+        checksums = None
+        if verify:
+            checksums = _checksums(self.get_overlay_file_metadata(file_id))
+        url = self.api_addr+'/user/files/%s/data' % file_id
+        return self._download(url, dest, checksums, resume)
+
     def replace_overlay_file(self, file_id, input_file):
         """PUT /api/v1/user/files/<file_id>/data
 
@@ -677,7 +2434,7 @@ class StudioAPI:
             in HTML (RFC 1867) in the body of the PUT request as the file
             parameter.
         """
-        url = self.api_addr + 'user/files/%s/data' % file_id
+        url = self.api_addr + '/user/files/%s/data' % file_id
         data = { 'file': input_file }
         req = HTTPPutRequest(url, data)
         return self._opener(req)
@@ -710,9 +2467,9 @@ class StudioAPI:
         else:
             raise ValueError, "expecting ET.Element (e.g. xml.etree.Element)"
 
-        data = {'file': urllib2.StringIO(xml_string)}
-        url = self.api_addr+'/user/files/%s/data' % file_id
-        req = HTTPPutRequest(url, data)
+        url = self.api_addr+'/user/files/%s' % file_id
+        req = HTTPPutRequest(url, data=xml_string,
+            headers={'Content-Type': 'application/xml'})
         return self._opener(req)
 
     def delete_overlay_file(self, id):
@@ -758,7 +2515,8 @@ class StudioAPI:
         req = HTTPGetRequest(url)
         return self._opener(req)
 
-    def add_build(self, appliance_id, force='', version='', image_type=''):
+    def add_build(self, appliance_id, force='', version='', image_type='',
+        multi=''):
         """POST /api/v1/user/running_builds?appliance_id=<id>&force=<force>&version=<version>&image_type=<type>&multi=<multi>
 
             Arguments:
@@ -783,8 +2541,8 @@ class StudioAPI:
             trigger the other formats with the multi parameter set to true.
         """
         url = self.api_addr+'/user/running_builds'
-        data = urllib.urlencode({'appliance_id':id, 'force':force,
-            'version':version, 'image_type':image_type})
+        data = urllib.urlencode({'appliance_id':appliance_id, 'force':force,
+            'version':version, 'image_type':image_type, 'multi':multi})
         req = HTTPPostRequest(url, data)
         return self._opener(req)
 
@@ -813,22 +2571,50 @@ class StudioAPI:
 
             List all completed builds for the appliance with id id.
         """
-        url = self.api_addr+'/user/builds?%s' % urllib.urlencode({"appliance_id":id})
+        url = self.api_addr+'/user/builds?%s' % urllib.urlencode({"appliance_id":appliance_id})
         req = HTTPGetRequest(url)
         return self._opener(req)
 
-    def get_build_info(self, build_id):
+    def get_build_info(self, build_id, cached=True):
         """GET /api/v1/user/builds/<build_id>
 
             Arguments:
 
                 build_id - Id of the build.
+                cached (optional) - Answer from the response cache, False
+                                    asks the server (e.g. for the state).
 
             Show build info of the build with id build_id.
         """
         url = self.api_addr+'/user/builds/%s' % build_id
         req = HTTPGetRequest(url)
-        return self._opener(req)
+        return self._opener(req, cacheable=cached)
+
+    def download_build(self, build_id, dest, verify=True, resume=True,
+        workers=4):
+        """GET <download_url of the build>
+
+            Arguments:
+
+                build_id - Id of the build.
+                dest - File name to write the image to.
+                verify (optional) - Check the download against the md5 / sha1
+                                    from get_build_info.
+                resume (optional) - Continue an interrupted download to dest,
+                                    if the file hasn't changed since.
+                workers (optional) - Number of parts downloaded at once.
+
+            Downloads the image of a finished build in parallel parts,
+            returns the size of the file.
+        """
+        build = self.get_build_info(build_id)
+        url = build.findtext('download_url', '').strip()
+        if not url:
+            raise StudioError, "build %s has no download_url" % build_id
+        checksums = None
+        if verify:
+            checksums = _checksums(build)
+        return self._download_ranges(url, dest, checksums, resume, workers)
 
     def delete_build(self, build_id):
         """DELETE /api/v1/user/builds/<build_id>
@@ -861,6 +2647,22 @@ class StudioAPI:
         req = HTTPGetRequest(url)
         return self._opener(req)
 
+    def iter_base_system_rpms(self, base_system):
+        """GET /api/v1/user/rpms?base_system=<base>
+
+            Arguments:
+
+                base_system - Base system of the RPM or archive, e.g. 11.1 or
+                              SLED11.
+
+            Yields the uploaded RPMs for the base system one at a time, as
+            they are parsed.
+        """
+        query = urllib.urlencode({'base_system':base_system})
+        url = self.api_addr+'/user/rpms?%s' % query
+        req = HTTPGetRequest(url)
+        return self._iterparse(req, 'rpm')
+
     def get_rpm_info(self, rpm_id):
         """GET /api/v1/user/rpms/<rpm_id>
 
@@ -872,7 +2674,7 @@ class StudioAPI:
         """
         url = self.api_addr+'/user/rpms/%s' % rpm_id
         req = HTTPGetRequest(url)
-        return self._opener(req)
+        return self._opener(req, cacheable=True)
 
     def get_rpm(self, rpm_id):
         """GET /api/v1/user/rpms/<rpm_id>/data
@@ -887,6 +2689,27 @@ class StudioAPI:
         req = HTTPGetRequest(url)
         return self._opener(req)
 
+    def download_rpm(self, rpm_id, dest, verify=True, resume=True):
+        """GET /api/v1/user/rpms/<rpm_id>/data
+
+            Arguments:
+
+                rpm_id - ID of the uploaded RPM.
+                dest - File name or writable file object to write to.
+                verify (optional) - Check the download against the checksum
+                                    from get_rpm_info.
+                resume (optional) - Continue an interrupted download to dest,
+                                    if the file hasn't changed since.
+
+            Streams the RPM with id rpm_id to dest, returns the size of the
+            file.
+        """
+        checksums = None
+        if verify:
+            checksums = _checksums(self.get_rpm_info(rpm_id))
+        url = self.api_addr+'/user/rpms/%s/data' % rpm_id
+        return self._download(url, dest, checksums, resume)
+
     def upload_rpm(self, base_system, rpm_file):
         """POST /api/v1/user/rpms?base_system=<base>
 
@@ -903,7 +2726,7 @@ class StudioAPI:
         url = self.api_addr+'/user/rpms'
         data = { 'base_system':base_system, 'file':rpm_file }
         req = HTTPPostRequest(url, data)
-        return self._opener(url, data)
+        return self._opener(req)
 
     def update_rpm(self, rpm_id, rpm_file):
         """PUT /api/v1/user/rpms/<rpm_id>
@@ -963,7 +2786,7 @@ class StudioAPI:
         query = urllib.urlencode(criteria)
         url = self.api_addr+'/user/repositories?%s' % query
         req = HTTPGetRequest(url)
-        return self._opener(req)
+        return self._opener(req, cacheable=True)
 
     def import_repository(self, repo_url, name):
         """POST /api/v1/user/repositories?url=<url>&name=<name>
@@ -992,7 +2815,7 @@ class StudioAPI:
         """
         url = self.api_addr+'/user/repositories/%s' % repo_id
         req = HTTPGetRequest(url)
-        return self._opener(req)
+        return self._opener(req, cacheable=True)
 
     ####################################################################
     # Testdrives
@@ -1034,15 +2857,40 @@ class StudioUtils:
             packages - a list of packages to add
             patterns - a list of patterns to add
 
-        if packages need to be versioned, you need to amend the returned tree
+        packages and patterns can be given as (name, version) tuples to pin
+        a version
         """
-        root = ET.Element("software", type="array", appliance_id=appliance_id)
-        for p in packages:
-            ET.SubElement(root, "package").text = p
-        for p in patterns:
-            ET.SubElement(root, "patterns").text = p
+        root = ET.Element("software", type="array",
+                          appliance_id=str(appliance_id))
+        for tag, items in (("package", packages), ("pattern", patterns)):
+            for p in items:
+                version = None
+                if isinstance(p, tuple):
+                    p, version = p
+                node = ET.SubElement(root, tag)
+                node.text = p
+                if version:
+                    node.set("version", version)
         return root
             
+    @staticmethod
+    def overlay_file_xml(filename='', path='', owner='', group='',
+        permissions='', enabled=''):
+        """
+        arguments:
+            the overlay file meta data, empty values are left out
+        """
+        root = ET.Element("file")
+        for tag, value in (("filename", filename), ("path", path),
+                           ("owner", owner), ("group", group),
+                           ("permissions", permissions),
+                           ("enabled", enabled)):
+            if value != '':
+                if isinstance(value, bool):
+                    value = str(value).lower()
+                ET.SubElement(root, tag).text = str(value)
+        return root
+
     @staticmethod
     def rpm_xml(id, filename, size, archive, base_system, checksum):
         """
@@ -1108,6 +2956,60 @@ import os, stat
 #  assigning a sequence.
 doseq = 1
 
+class MultipartBody:
+    """File-like multipart/form-data request body
+
+    The body is a sequence of string and file parts, file contents are only
+    read as httplib asks for the next block, so memory use stays flat
+    however large the files are.  len() gives the Content-Length, seek(0)
+    rewinds the body so the request can be resent (e.g. after a 401).
+    """
+    def __init__(self, parts):
+        self._parts = parts
+        self._length = sum(MultipartBody._part_size(p) for p in parts)
+        self.seek(0)
+
+    @staticmethod
+    def _part_size(part):
+        if isinstance(part, str):
+            return len(part)
+        try:
+            return os.fstat(part.fileno()).st_size
+        except (AttributeError, IOError, OSError, ValueError):
+            part.seek(0, 2)
+            return part.tell()
+
+    def __len__(self):
+        return self._length
+
+    def seek(self, offset, whence=0):
+        if offset or whence:
+            raise IOError, "MultipartBody can only be rewound"
+        self._index = 0
+        self._offset = 0
+
+    def read(self, size=-1):
+        chunks = []
+        while self._index < len(self._parts) and size != 0:
+            part = self._parts[self._index]
+            if isinstance(part, str):
+                end = len(part) if size < 0 else self._offset + size
+                data = part[self._offset:end]
+            else:
+                if self._offset == 0:
+                    part.seek(0)
+                data = part.read(size)
+            if not data:
+                self._index += 1
+                self._offset = 0
+                continue
+            self._offset += len(data)
+            chunks.append(data)
+            if size > 0:
+                size -= len(data)
+        return ''.join(chunks)
+
+
 class MultipartPostHandler(urllib2.BaseHandler):
     """MultipartPostHandler(urllib2.BaseHandler)
 
@@ -1134,12 +3036,12 @@ Example:
 
     def http_request(self, request):
         data = request.get_data()
-        if data and not isinstance(data, str):
+        if data and not isinstance(data, (str, MultipartBody)):
             v_files = []
             v_vars = []
             try:
                 for (key, value) in data.items():
-                    if isinstance(value, file):
+                    if hasattr(value, 'read'):
                         v_files.append((key, value))
                     else:
                         v_vars.append((key, value))
@@ -1163,25 +3065,33 @@ Example:
         return request
 
     @staticmethod
-    def multipart_encode(vars, files, boundary = None, buf = None):
+    def multipart_encode(vars, files, boundary = None):
+        """returns (boundary, MultipartBody) - file contents are streamed
+        from the file objects when the request is sent
+        """
         if not boundary:
             boundary = mimetools.choose_boundary()
-        if not buf:
-            buf = StringIO()
+        parts = []
+        buf = StringIO()
         for(key, value) in vars:
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
             buf.write('--%s\r\n' % boundary)
             buf.write('Content-Disposition: form-data; name="%s"' % key)
             buf.write('\r\n\r\n%s\r\n' % value)
         for(key, fd) in files:
-            filename = fd.name.split('/')[-1]
+            filename = getattr(fd, 'name', key).split('/')[-1]
+            if isinstance(filename, unicode):
+                filename = filename.encode('utf-8')
             contenttype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
             buf.write('--%s\r\n' % boundary)
             buf.write('Content-Disposition: form-data; name="%s"; filename="%s"\r\n' % (key, filename))
-            buf.write('Content-Type: %s\r\n' % contenttype)
-            fd.seek(0)
-            buf.write('\r\n' + fd.read() + '\r\n')
+            buf.write('Content-Type: %s\r\n\r\n' % contenttype)
+            parts.extend([buf.getvalue(), fd])
+            buf = StringIO()
+            buf.write('\r\n')
         buf.write('--' + boundary + '--\r\n\r\n')
-        buf = buf.getvalue()
-        return boundary, buf
+        parts.append(buf.getvalue())
+        return boundary, MultipartBody(parts)
 
     https_request = http_request
@@ -0,0 +1,787 @@
+#!/usr/bin/env python
+
+"""
+Event loop client for the SUSE Studio API.
+
+AsyncStudioAPI has the same endpoint methods as studioapi.StudioAPI, but
+each call returns a StudioFuture straight away.  All requests are driven
+by a single asyncore loop over non-blocking sockets, so one thread can keep
+hundreds of requests in flight.  (The library targets Python 2, so the
+loop is asyncore rather than asyncio.)
+
+The loop runs whenever the caller waits - StudioFuture.result(),
+AsyncStudioAPI.wait() or AsyncStudioAPI.run() - and done callbacks run
+inside it, so they can issue further requests.
+
+Requests go through the same cache, retry policy, circuit breaker, rate
+limiter and instrumentation as with StudioAPI; waits for retries and rate
+limits are timers on the loop, not sleeps.  Connections are kept alive
+per host.  Responses are read into memory, which suits the API's XML
+answers: the iter_* methods return a future of the list of items the
+StudioAPI generator would yield, and the download_* methods - the large
+transfers - run the streaming StudioAPI download on a helper thread, so
+the loop stays free while the file goes to disk.
+
+Basic Usage:
+import studioapi, studioasync
+
+connection = studioapi.AuthConnection(username, password)
+studio = studioasync.AsyncStudioAPI(connection)
+
+appliances = studio.get_appliances().result()
+statuses = studio.wait([studio.get_appliance_status(a.find('id').text)
+                        for a in appliances])
+
+"""
+__all__ = ['AsyncStudioAPI', 'StudioFuture']
+__license__ = 'GPL v.2 http://www.gnu.org/licenses/gpl.txt'
+
+import sys
+import time
+import heapq
+import errno
+import select
+import socket
+import asyncore
+import base64
+import httplib
+import threading
+import urllib
+import urllib2
+import Queue
+from collections import deque
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+import studioapi
+from studioapi import ET
+
+
+class StudioFuture:
+    """Result of an AsyncStudioAPI call
+    """
+    def __init__(self, client):
+        self._client = client
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self, timeout=None):
+        """returns the result, running the event loop until it is available
+
+        Raises the exception of a failed request.
+        """
+        if not self._done:
+            self._client._poll_until(self.done, timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done:
+            self._client._poll_until(self.done, timeout)
+        if self._exc_info:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, fn):
+        """fn(future) is called from the event loop once the future is done
+        """
+        if self._done:
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+
+    def set_result(self, result):
+        self._result = result
+        self._set_done()
+
+    def set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._set_done()
+
+    def _set_done(self):
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+
+class _SocketResponse:
+    """lets httplib.HTTPResponse parse a response that was already received
+    """
+    def __init__(self, data):
+        self._fp = StringIO(data)
+
+    def makefile(self, *args):
+        return self._fp
+
+
+class _HTTPChannel(asyncore.dispatcher):
+    """A keep-alive HTTP connection on a non-blocking socket, serving one
+    exchange at a time
+
+    Responses are framed by their Content-Length or chunked encoding, the
+    connection then waits on the client's idle list for the next request
+    to the same host.  A response with neither is read until the server
+    closes the socket.  Bodies are collected in memory - the API answers
+    with small XML documents, large downloads go through StudioAPI on a
+    helper thread.
+    """
+    blocksize = 65536
+
+    def __init__(self, client, key):
+        asyncore.dispatcher.__init__(self, map=client._map)
+        self.client = client
+        self.key = key
+        self.call = None
+        self.reused = False
+        self.idle_since = None
+        self._https = key[0] == 'https'
+        self._handshaking = False
+        self._completing = False
+
+        host, port = urllib.splitport(key[1])
+        self.hostname = host
+        port = int(port or (443 if self._https else 80))
+        family, address = client._resolve(host, port)
+        self.create_socket(family, socket.SOCK_STREAM)
+        self.connect(address)
+
+    def start(self, call):
+        """send call's request, its outcome goes to client._complete"""
+        self.call = call
+        self.request = call.request
+        self.deadline = time.time() + self.client.timeout
+        self._buffer = ''
+        self._received = False
+        self._response = None
+        self._chunk = None      # bytes left in the chunk, -1 for trailers
+        self._parts = []
+
+        self._out = self._request_head()
+        self._body = self.request.get_data()
+        if isinstance(self._body, str):
+            self._out += self._body
+            self._body = None
+        elif self._body is not None:
+            self._body.seek(0)
+
+    def _request_head(self):
+        req = self.request
+        headers = dict(req.header_items())
+        if req.has_data():
+            headers.setdefault('Content-type',
+                               'application/x-www-form-urlencoded')
+            headers.setdefault('Content-length', '%d' % len(req.get_data()))
+        headers.setdefault('User-agent', 'Python-studioasync/%s' %
+                           studioapi.__version__)
+        headers['Host'] = req.get_host()
+        headers['Connection'] = 'keep-alive'
+        authorization = self.client._authorization(req.get_full_url())
+        if authorization:
+            headers['Authorization'] = authorization
+        lines = ['%s %s HTTP/1.1' % (req.get_method(), req.get_selector())]
+        lines.extend('%s: %s' % (k.title(), v) for k, v in headers.items())
+        return '\r\n'.join(lines) + '\r\n\r\n'
+
+    def alive(self):
+        """an idle connection must not be readable - if it is the server
+        has closed it or sent something nobody asked for
+        """
+        try:
+            readable = select.select([self.socket], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+    def handle_connect(self):
+        if self._https:
+            context = ssl.create_default_context()
+            sock = context.wrap_socket(self.socket,
+                server_hostname=self.hostname, do_handshake_on_connect=False)
+            self.del_channel()
+            self.set_socket(sock, self.client._map)
+            self._handshaking = True
+
+    def _handshake(self):
+        try:
+            self.socket.do_handshake()
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        self._handshaking = False
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return (self.connecting or self._handshaking
+                or (self.call is not None
+                    and (bool(self._out) or self._body is not None)))
+
+    def handle_write(self):
+        if self._handshaking:
+            return self._handshake()
+        if not self._out and self._body is not None:
+            self._out = self._body.read(self.blocksize)
+            if not self._out:
+                self._body = None
+                return
+        try:
+            sent = self.socket.send(self._out)
+        except socket.error, e:
+            if self._would_block(e):
+                return
+            raise
+        self._out = self._out[sent:]
+
+    def handle_read(self):
+        if self._handshaking:
+            return self._handshake()
+        self._read(False)
+
+    def handle_close(self):
+        self._read(True)
+
+    def _read(self, closed):
+        if self.call is None:
+            # all an idle connection can hear is the server hanging up
+            return self._drop()
+        try:
+            closed = self._receive() or closed
+            body = self._parse(closed)
+        except Exception:
+            return self._fail(sys.exc_info())
+        if body is not None:
+            self._done(body, closed)
+
+    def _receive(self):
+        """read what is available, returns True once the server has closed
+        """
+        while True:
+            try:
+                data = self.socket.recv(self.blocksize)
+            except socket.error, e:
+                if self._would_block(e):
+                    return False
+                raise
+            if not data:
+                return True
+            self._received = True
+            self._buffer += data
+
+    def _parse(self, closed):
+        """the body once the response is complete, else None"""
+        if self._response is None:
+            end = self._buffer.find('\r\n\r\n')
+            if end < 0:
+                if closed:
+                    raise httplib.BadStatusLine(self._buffer[:80] or "''")
+                return None
+            head, self._buffer = (self._buffer[:end + 4],
+                                  self._buffer[end + 4:])
+            self._response = httplib.HTTPResponse(_SocketResponse(head),
+                method=self.request.get_method())
+            self._response.begin()
+        response = self._response
+
+        if response.chunked:
+            return self._parse_chunks(closed)
+        if response.length is not None:
+            if len(self._buffer) >= response.length:
+                body = self._buffer[:response.length]
+                self._buffer = self._buffer[response.length:]
+                return body
+        elif closed:
+            body, self._buffer = self._buffer, ''
+            return body
+        if closed:
+            raise httplib.IncompleteRead(self._buffer)
+        return None
+
+    def _parse_chunks(self, closed):
+        buf = self._buffer
+        pos = 0
+        body = None
+        while body is None:
+            if self._chunk is None or self._chunk == -1:
+                end = buf.find('\r\n', pos)
+                if end < 0:
+                    break
+                line, pos = buf[pos:end], end + 2
+                if self._chunk == -1:
+                    if not line:
+                        body = ''.join(self._parts)
+                elif int(line.split(';')[0], 16) == 0:
+                    self._chunk = -1
+                else:
+                    self._chunk = int(line.split(';')[0], 16)
+            elif len(buf) - pos >= self._chunk + 2:
+                self._parts.append(buf[pos:pos + self._chunk])
+                pos += self._chunk + 2
+                self._chunk = None
+            else:
+                break
+        self._buffer = buf[pos:]
+        if body is None and closed:
+            raise httplib.IncompleteRead(''.join(self._parts))
+        return body
+
+    @staticmethod
+    def _would_block(e):
+        if ssl and isinstance(e, (ssl.SSLWantReadError,
+                                  ssl.SSLWantWriteError)):
+            return True
+        return e.args and e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN)
+
+    def handle_error(self):
+        if self._completing:
+            raise   # from a done callback, let it reach the loop's caller
+        if self.call is None:
+            return self._drop()
+        self._fail(sys.exc_info())
+
+    def expire(self):
+        self.close()
+        self._finish(exc_info=(urllib2.URLError,
+            urllib2.URLError(socket.timeout('timed out')), None))
+
+    def _done(self, body, closed):
+        response = self._response
+        if closed or response.will_close or self._buffer:
+            self.close()
+        else:
+            self.client._idle_channel(self)
+        self._finish(response=response, body=body)
+
+    def _fail(self, exc_info):
+        self.close()
+        error = exc_info[1]
+        if (self.reused and not self._received
+            and self.request.get_method() in studioapi.KeepAliveHandler.replayable
+            and studioapi.KeepAliveHandler._dropped(error)):
+            # the server dropped the idle connection, try a fresh one
+            call, self.call = self.call, None
+            self.client._active.discard(self)
+            self.client._release(call)
+            self.client._queue.appendleft(call)
+            return
+        if not isinstance(error, (urllib2.URLError, httplib.HTTPException)):
+            exc_info = (urllib2.URLError, urllib2.URLError(error), exc_info[2])
+        self._finish(exc_info=exc_info)
+
+    def _drop(self):
+        self.close()
+        idle = self.client._idle.get(self.key, [])
+        if self in idle:
+            idle.remove(self)
+
+    def _finish(self, response=None, body=None, exc_info=None):
+        call, self.call = self.call, None
+        self.client._active.discard(self)
+        self._completing = True
+        try:
+            self.client._complete(call, response, body, exc_info)
+        finally:
+            self._completing = False
+
+
+class _Call:
+    """A request queued on the loop, with what is needed to retry it"""
+    def __init__(self, request, future, raw, cacheable=False, cached=None):
+        self.request = request
+        self.future = future
+        self.raw = raw
+        self.cacheable = cacheable
+        self.cached = cached    # the stale cache entry being revalidated
+        self.attempt = 0
+        self.reserved = False   # the rate limiter token is already taken
+        self.trial = False      # the circuit breaker trial for the host
+        self.started = None
+
+
+def _items(body, tags, context=None):
+    """what StudioAPI._iterparse yields for body, without clearing"""
+    items = []
+    stack = []
+    for event, elem in ET.iterparse(StringIO(body), events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            continue
+        stack.pop()
+        if elem.tag not in tags:
+            continue
+        if context is None:
+            items.append(elem)
+        else:
+            ancestor = None
+            for node in reversed(stack):
+                if node.tag == context:
+                    ancestor = node
+                    break
+            items.append((ancestor, elem))
+    return items
+
+
+class AsyncStudioAPI(studioapi.StudioAPI):
+    """SUSE Studio REST API client on an event loop
+
+    Every endpoint method of StudioAPI returns a StudioFuture instead of
+    the parsed response.  At most max_in_flight requests are on the wire,
+    the rest are queued.  cache, retry, breaker, instrumentation and
+    limiter are the StudioAPI policies.  Redirects are not followed.
+
+    Connections are kept alive and reused for the next request to the same
+    host, idle ones are closed after idle_timeout seconds or by close().
+    A GET or HEAD the server dropped on a reused connection before
+    answering is sent again on a new one.
+    """
+    idle_timeout = 60
+
+    def __init__(self, studio_connection, max_in_flight=100, timeout=60,
+        cache=None, retry=None, breaker=None, instrumentation=None,
+        limiter=None):
+        studioapi.StudioAPI.__init__(self, studio_connection, cache=cache,
+            retry=retry, breaker=breaker, coalesce=False,
+            instrumentation=instrumentation, limiter=limiter)
+        self.auth_manager = studio_connection.api_auth_manager()
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        # for the downloads, run on helper threads
+        self._sync = studioapi.StudioAPI(studio_connection, cache=cache,
+            retry=retry, breaker=breaker, instrumentation=instrumentation,
+            limiter=limiter)
+        self._multipart = studioapi.MultipartPostHandler()
+        self._map = {}
+        self._queue = deque()
+        self._delayed = []      # heap of (due, sequence, call)
+        self._sequence = 0
+        self._active = set()
+        self._threads = 0
+        self._results = Queue.Queue()
+        self._addresses = {}
+        self._idle = {}         # (scheme, host) -> [idle _HTTPChannel]
+
+    def _opener(self, request, raw=False, cacheable=False):
+        self._multipart.http_request(request)
+        future = StudioFuture(self)
+        cached = None
+        if request.get_method() == 'GET' and cacheable and self.cache:
+            url = request.get_full_url()
+            cached, fresh = self.cache.lookup(url)
+            if fresh:
+                try:
+                    future.set_result(cached[0] if raw
+                                      else self._parse(request, cached[0]))
+                except Exception:
+                    future.set_exception(sys.exc_info())
+                return future
+            if cached is not None:
+                if cached[1]:
+                    request.add_header('If-None-Match', cached[1])
+                if cached[2]:
+                    request.add_header('If-Modified-Since', cached[2])
+        self._queue.append(_Call(request, future, raw, cacheable, cached))
+        return future
+
+    def _iterparse(self, request, tags, context=None):
+        if isinstance(tags, basestring):
+            tags = (tags,)
+        future = StudioFuture(self)
+        def parsed(body):
+            if body.exception() is not None:
+                return future.set_exception(body._exc_info)
+            try:
+                future.set_result(_items(body.result(), tags, context))
+            except Exception:
+                future.set_exception(sys.exc_info())
+        self._opener(request, raw=True).add_done_callback(parsed)
+        return future
+
+    def download_appliance_image_file(self, *args, **kwargs):
+        """StudioAPI.download_appliance_image_file on a helper thread"""
+        return self._in_thread(self._sync.download_appliance_image_file,
+                               *args, **kwargs)
+
+    def download_overlay_file(self, *args, **kwargs):
+        """StudioAPI.download_overlay_file on a helper thread"""
+        return self._in_thread(self._sync.download_overlay_file,
+                               *args, **kwargs)
+
+    def download_build(self, *args, **kwargs):
+        """StudioAPI.download_build on a helper thread"""
+        return self._in_thread(self._sync.download_build, *args, **kwargs)
+
+    def download_rpm(self, *args, **kwargs):
+        """StudioAPI.download_rpm on a helper thread"""
+        return self._in_thread(self._sync.download_rpm, *args, **kwargs)
+
+    def batch(self, method, ids, max_workers=4):
+        """Call method once per id, with max_workers calls in flight
+
+        Like StudioAPI.batch, yields (id, result, error) as the calls
+        complete - the loop runs while the generator is consumed.
+        """
+        if isinstance(method, basestring):
+            method = getattr(self, method)
+        todo = deque(ids)
+        running = {}
+        done = deque()     # (id, result, error)
+        def finished(future):
+            item = running.pop(future)
+            if future.exception() is not None:
+                done.append((item, None, future.exception()))
+            else:
+                done.append((item, future.result(), None))
+        while todo or running or done:
+            while todo and len(running) < max_workers:
+                item = todo.popleft()
+                args = item if isinstance(item, tuple) else (item,)
+                try:
+                    future = method(*args)
+                except Exception, e:
+                    done.append((item, None, e))
+                    continue
+                running[future] = item
+                future.add_done_callback(finished)
+            if not done:
+                self._poll_until(lambda: bool(done))
+                if not done:
+                    raise studioapi.StudioError, "batch calls left unanswered"
+            while done:
+                yield done.popleft()
+
+    def _in_thread(self, fn, *args, **kwargs):
+        """run fn on a helper thread, its outcome resolves the returned
+        future from the loop
+        """
+        future = StudioFuture(self)
+        def run():
+            try:
+                self._results.put((future, fn(*args, **kwargs), None))
+            except:
+                self._results.put((future, None, sys.exc_info()))
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        self._threads += 1
+        thread.start()
+        return future
+
+    def _thread_results(self, timeout=0):
+        """resolve the futures of finished helper threads"""
+        while self._threads:
+            try:
+                future, result, exc_info = self._results.get(timeout > 0,
+                                                             timeout or None)
+            except Queue.Empty:
+                return
+            timeout = 0
+            self._threads -= 1
+            if exc_info:
+                future.set_exception(exc_info)
+            else:
+                future.set_result(result)
+
+    def _authorization(self, url):
+        if self.auth_manager is None:
+            return None
+        user, password = self.auth_manager.find_user_password(None, url)
+        if user is None:
+            return None
+        return 'Basic ' + base64.b64encode('%s:%s' % (user, password))
+
+    def _resolve(self, host, port):
+        key = (host, port)
+        if key not in self._addresses:
+            family, _, _, _, address = socket.getaddrinfo(
+                host, port, 0, socket.SOCK_STREAM)[0]
+            self._addresses[key] = family, address
+        return self._addresses[key]
+
+    def _channel(self, request):
+        """an idle connection to the request's host, or a new one"""
+        key = (request.get_type(), request.get_host())
+        idle = self._idle.get(key)
+        while idle:
+            channel = idle.pop()
+            if (time.time() - channel.idle_since < self.idle_timeout
+                and channel.alive()):
+                channel.reused = True
+                return channel
+            channel.close()
+        return _HTTPChannel(self, key)
+
+    def _idle_channel(self, channel):
+        channel.idle_since = time.time()
+        self._idle.setdefault(channel.key, []).append(channel)
+
+    def close(self):
+        """close the idle connections"""
+        idle, self._idle = self._idle, {}
+        for channels in idle.values():
+            for channel in channels:
+                channel.close()
+
+    def _later(self, call, delay):
+        self._sequence += 1
+        heapq.heappush(self._delayed, (time.time() + delay, self._sequence,
+                                       call))
+
+    def _start_queued(self):
+        now = time.time()
+        while self._delayed and self._delayed[0][0] <= now:
+            self._queue.append(heapq.heappop(self._delayed)[2])
+        while self._queue and len(self._active) < self.max_in_flight:
+            call = self._queue.popleft()
+            request = call.request
+            try:
+                if self.breaker is not None:
+                    call.trial = self.breaker.check(request.get_host())
+                if self.limiter is not None and not call.reserved:
+                    call.reserved = True
+                    wait = self.limiter.reserve(request)
+                    if wait > 0:
+                        self._release(call)
+                        self._later(call, wait)
+                        continue
+                call.started = time.time()
+                channel = self._channel(request)
+                channel.start(call)
+            except Exception:
+                self._release(call)
+                call.future.set_exception(sys.exc_info())
+                continue
+            self._active.add(channel)
+
+    def _release(self, call):
+        if call.trial:
+            call.trial = False
+            self.breaker.release(call.request.get_host())
+
+    def _complete(self, call, response, body, exc_info):
+        """the policies of StudioAPI._urlopen and _opener, for a finished
+        exchange
+        """
+        request = call.request
+        host = request.get_host()
+        instrumentation = self.instrumentation
+        error = None
+        if exc_info is None and not 200 <= response.status < 300:
+            error = urllib2.HTTPError(request.get_full_url(), response.status,
+                response.reason, response.msg, StringIO(body))
+            exc_info = (urllib2.HTTPError, error, None)
+        elif exc_info is not None:
+            error = exc_info[1]
+        try:
+            if self.breaker is not None:
+                if error is None or (isinstance(error, urllib2.HTTPError)
+                                     and error.code < 500):
+                    self.breaker.success(host)
+                else:
+                    self.breaker.failure(host)
+        finally:
+            self._release(call)
+        if instrumentation is not None:
+            instrumentation.count('requests', request,
+                response.status if response is not None else 'error')
+            instrumentation.observe('request_seconds', request,
+                                    time.time() - call.started)
+            if body is not None:
+                instrumentation.observe('response_bytes', request, len(body))
+        if (self.limiter is not None
+            and isinstance(error, urllib2.HTTPError) and error.code == 429):
+            self.limiter.throttled(request,
+                                   studioapi._retry_after(error.info()))
+
+        if error is not None:
+            if isinstance(error, urllib2.HTTPError) and error.code == 304 \
+                and call.cached is not None:
+                body = self.cache.refresh(request.get_full_url(),
+                                          call.cached)[0]
+            else:
+                delay = None
+                if self.retry is not None:
+                    delay = self.retry.delay(request, call.attempt, error)
+                if delay is not None:
+                    if instrumentation is not None:
+                        instrumentation.count('retries', request)
+                    call.attempt += 1
+                    call.reserved = False
+                    self._later(call, delay)
+                    return
+                if isinstance(error, urllib2.HTTPError) and error.code == 500:
+                    try:
+                        raise studioapi.StudioError, \
+                            "report error to the library maintainer"
+                    except studioapi.StudioError:
+                        exc_info = sys.exc_info()
+                return call.future.set_exception(exc_info)
+        elif self.cache is not None:
+            if request.get_method() != 'GET':
+                self.cache.expire_all()
+            elif call.cacheable:
+                self.cache.store(request.get_full_url(), body, response.msg)
+        try:
+            result = body if call.raw else self._parse(request, body)
+        except Exception:
+            return call.future.set_exception(sys.exc_info())
+        call.future.set_result(result)
+
+    def _expire(self):
+        now = time.time()
+        for channel in [c for c in self._active if c.deadline < now]:
+            channel.expire()
+
+    def _poll_until(self, predicate, timeout=None):
+        deadline = timeout is not None and time.time() + timeout
+        while not predicate():
+            self._start_queued()
+            self._thread_results()
+            if predicate():
+                break
+            if not self._active:
+                if self._queue:
+                    continue
+                if self._delayed:
+                    wait = self._delayed[0][0] - time.time()
+                    if self._threads:
+                        self._thread_results(min(max(wait, 0.001), 0.1))
+                    elif wait > 0:
+                        time.sleep(min(wait, 0.1))
+                elif self._threads:
+                    self._thread_results(0.1)
+                else:
+                    break
+            else:
+                asyncore.loop(timeout=0.1 if not self._threads else 0.02,
+                              use_poll=hasattr(asyncore, 'poll2'),
+                              map=self._map, count=1)
+                self._expire()
+            if deadline and time.time() > deadline:
+                raise socket.timeout('timed out')
+
+    def run(self, timeout=None):
+        """run the event loop until all queued requests are answered
+        """
+        self._poll_until(lambda: not self._queue and not self._active
+                         and not self._delayed and not self._threads, timeout)
+
+    def wait(self, futures, timeout=None):
+        """run the event loop until all futures are done, returns their
+        results in order
+        """
+        futures = list(futures)
+        self._poll_until(lambda: all(f.done() for f in futures), timeout)
+        return [f.result() for f in futures]
@@ -0,0 +1,587 @@
+#!/usr/bin/env python
+
+"""
+Build tracking for the SUSE Studio API.
+
+BuildWatcher follows any number of running builds from one scheduler.  Each
+build is polled at an interval derived from its reported percent and
+time_elapsed, and builds of the same appliance are refreshed together with
+a single get_running_appliance_builds call.  Progress, completion and
+failure are reported through callbacks and per-build futures.
+
+BuildOrchestrator runs a matrix of appliances x versions x image types.
+The first image type of a version is built on its own, the other formats
+of that version follow in multi mode once it has finished.  Builds start
+as soon as their dependencies are done, with at most max_per_appliance
+running per appliance and max_running in the account - builds that were
+already running on an appliance count too.  An extra format refused
+with image_already_exists, right after the orchestrator built the first
+format of its version, is submitted again after a delay; anywhere else
+that code means the image really exists, and the build fails.
+
+Basic Usage:
+import studioapi, studiobuilds
+
+studio = studioapi.StudioAPI(connection)
+watcher = studiobuilds.BuildWatcher(studio)
+build = studio.add_build(appliance_id, image_type='oem')
+future = watcher.watch(build.find('id').text, appliance_id)
+watcher.run()
+info = future.result()
+
+orchestrator = studiobuilds.BuildOrchestrator(studio, max_running=8)
+orchestrator.matrix([appliance_id, other_id], ['1.0.0'], ['oem', 'iso'])
+for job in orchestrator.run():
+    print job, job.state
+
+"""
+__all__ = ['BuildWatcher', 'BuildFuture', 'BuildOrchestrator', 'BuildJob']
+__license__ = 'GPL v.2 http://www.gnu.org/licenses/gpl.txt'
+
+import time
+import socket
+import httplib
+import threading
+import urllib2
+
+from studioapi import ET, StudioError
+
+FINISHED_STATES = ('finished',)
+FAILED_STATES = ('error', 'failed', 'cancelled')
+IMAGE_TYPES = ('xen', 'oem', 'vmx', 'iso')
+# poll errors worth another try later, SyntaxError covers ET.ParseError
+TRANSIENT_ERRORS = (urllib2.URLError, StudioError, socket.error,
+                    httplib.HTTPException, SyntaxError)
+
+
+def _text(elem, tag, default=''):
+    value = elem.findtext(tag)
+    if value is None:
+        return default
+    return value.strip()
+
+
+class BuildFuture:
+    """Outcome of a watched build
+
+    status is the latest running_build element.  result() returns the
+    build info (get_build_info) once the build has finished, or raises a
+    StudioError if it failed.
+    """
+    def __init__(self, build_id, appliance_id=None):
+        self.build_id = build_id
+        self.appliance_id = appliance_id
+        self.status = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise StudioError, "build %s still running" % self.build_id
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def add_done_callback(self, fn):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self, result=None, error=None):
+        with self._lock:
+            self._result = result
+            self._error = error
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+
+class _Tracked:
+    def __init__(self, future, interval):
+        self.future = future
+        self.interval = interval
+        self.percent = None
+        self.due = time.time()
+
+
+class BuildWatcher:
+    """Polls running builds and resolves their BuildFutures
+
+        Arguments:
+
+            studio - StudioAPI instance
+            min_interval, max_interval (optional) - bounds for the per build
+                                                    polling interval (seconds)
+            on_progress (optional) - on_progress(future, status)
+            on_complete (optional) - on_complete(future, build_info)
+            on_failure (optional) - on_failure(future, error)
+
+    A build is polled about four times over its estimated remaining time;
+    queued or stalled builds back off towards max_interval, and so do
+    builds whose poll failed with a network, HTTP or parse error.  Any
+    other error fails the build's future.  Call run() to poll until every
+    watched build is done, or start() to poll from a background thread.
+    """
+    def __init__(self, studio, min_interval=5, max_interval=300,
+        on_progress=None, on_complete=None, on_failure=None):
+        self.studio = studio
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.on_progress = on_progress
+        self.on_complete = on_complete
+        self.on_failure = on_failure
+        self._builds = {}
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def watch(self, build_id, appliance_id=None):
+        """Start tracking build_id, returns its BuildFuture
+
+        Builds with a known appliance_id can be polled per appliance.
+        """
+        build_id = str(build_id).strip()
+        if appliance_id is not None:
+            appliance_id = str(appliance_id).strip()
+        with self._cond:
+            tracked = self._builds.get(build_id)
+            if tracked is None:
+                tracked = _Tracked(BuildFuture(build_id, appliance_id),
+                                   self.min_interval)
+                self._builds[build_id] = tracked
+                self._cond.notify()
+            return tracked.future
+
+    def pending(self):
+        with self._cond:
+            return len(self._builds)
+
+    def run(self, timeout=None):
+        """poll until every watched build is done (or timeout expires)
+        """
+        deadline = timeout is not None and time.time() + timeout
+        while True:
+            with self._cond:
+                if not self._builds or self._stopped:
+                    return
+                now = time.time()
+                due = [t for t in self._builds.values() if t.due <= now]
+                if not due:
+                    wait = min(t.due for t in self._builds.values()) - now
+                    if deadline:
+                        if now >= deadline:
+                            return
+                        wait = min(wait, deadline - now)
+                    self._cond.wait(wait)
+                    continue
+            self._poll(due)
+
+    def start(self):
+        """poll from a daemon thread, until stop()
+        """
+        def loop():
+            while not self._stopped:
+                self.run()
+                with self._cond:
+                    if not self._builds and not self._stopped:
+                        self._cond.wait()
+        self._stopped = False
+        self._thread = threading.Thread(target=loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def alive(self):
+        """whether the thread of start() is still polling"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def _poll(self, due):
+        groups = {}
+        with self._cond:
+            for tracked in self._builds.values():
+                appliance_id = tracked.future.appliance_id
+                if appliance_id is not None:
+                    groups.setdefault(appliance_id, []).append(tracked)
+        polled = set()
+        for tracked in due:
+            if tracked.future.build_id in polled:
+                continue
+            group = groups.get(tracked.future.appliance_id, ())
+            affected = len(group) > 1 and group or (tracked,)
+            try:
+                if len(group) > 1:
+                    polled.update(t.future.build_id for t in group)
+                    self._poll_appliance(tracked.future.appliance_id, group)
+                else:
+                    self._poll_build(tracked)
+            except TRANSIENT_ERRORS:
+                # the service is having trouble, try again later
+                for t in affected:
+                    self._reschedule(t, t.interval * 2)
+            except Exception, e:
+                # anything else would just repeat, report it
+                for t in affected:
+                    if not t.future.done():
+                        self._failed(t, e)
+
+    def _poll_appliance(self, appliance_id, group):
+        running = self.studio.get_running_appliance_builds(appliance_id)
+        statuses = dict((_text(b, 'id'), b)
+                        for b in running.findall('running_build'))
+        for tracked in group:
+            status = statuses.get(tracked.future.build_id)
+            if status is None:
+                # no longer running - find out how it ended
+                self._poll_build(tracked)
+            else:
+                self._update(tracked, status)
+
+    def _poll_build(self, tracked):
+        try:
+            status = self.studio.get_build_status(tracked.future.build_id)
+        except urllib2.HTTPError, e:
+            if e.code != 404:
+                raise
+            return self._finished(tracked)
+        self._update(tracked, status)
+
+    def _update(self, tracked, status):
+        future = tracked.future
+        future.status = status
+        state = _text(status, 'state')
+        if state in FINISHED_STATES:
+            return self._finished(tracked)
+        if state in FAILED_STATES:
+            return self._failed(tracked, StudioError("build %s %s: %s" % (
+                future.build_id, state, _text(status, 'message'))))
+        if self.on_progress:
+            self.on_progress(future, status)
+        self._reschedule(tracked, self._interval(tracked, status))
+
+    def _interval(self, tracked, status):
+        try:
+            percent = int(_text(status, 'percent', '0') or 0)
+            elapsed = int(_text(status, 'time_elapsed', '0') or 0)
+        except ValueError:
+            percent = elapsed = 0
+        if percent > 0 and elapsed > 0:
+            remaining = elapsed * (100 - percent) / float(percent)
+            interval = remaining / 4
+        else:
+            interval = tracked.interval * 2
+        if tracked.percent is not None and percent <= tracked.percent:
+            interval = max(interval, tracked.interval * 1.5)
+        tracked.percent = percent
+        return interval
+
+    def _reschedule(self, tracked, interval):
+        tracked.interval = max(self.min_interval,
+                               min(self.max_interval, interval))
+        tracked.due = time.time() + tracked.interval
+
+    def _finished(self, tracked):
+        future = tracked.future
+        try:
+            info = self.studio.get_build_info(future.build_id)
+        except urllib2.HTTPError, e:
+            if e.code != 404:
+                raise
+            return self._failed(tracked, StudioError(
+                "build %s disappeared before it finished" % future.build_id))
+        self._forget(tracked)
+        if self.on_complete:
+            self.on_complete(future, info)
+        future._finish(result=info)
+
+    def _failed(self, tracked, error):
+        future = tracked.future
+        self._forget(tracked)
+        if self.on_failure:
+            self.on_failure(future, error)
+        future._finish(error=error)
+
+    def _forget(self, tracked):
+        with self._cond:
+            self._builds.pop(tracked.future.build_id, None)
+
+
+def _error_code(elem):
+    """the code of an <error> response, None for anything else"""
+    if elem is None or elem.tag != 'error':
+        return None
+    return _text(elem, 'code')
+
+
+class BuildJob:
+    """One build of an orchestrator's matrix
+
+    state is 'pending', 'running', 'finished' or 'failed'.  Once running,
+    future is the BuildFuture of the build; info is the build info of a
+    finished build, error what made a failed one fail.  first is the job
+    of the version's first format, None for that job itself.
+    """
+    def __init__(self, appliance_id, version, image_type, depends=(),
+        first=None):
+        self.appliance_id = appliance_id
+        self.version = version
+        self.image_type = image_type
+        self.depends = list(depends)
+        self.first = first
+        self.multi = first is not None
+        self.state = 'pending'
+        self.attempts = 0
+        self.due = 0
+        self.build_id = None
+        self.future = None
+        self.info = None
+        self.error = None
+
+    def __repr__(self):
+        return '<BuildJob %s %s %s>' % (self.appliance_id, self.version,
+                                        self.image_type)
+
+
+class BuildOrchestrator:
+    """Schedules many builds under per appliance and account limits
+
+        Arguments:
+
+            studio - StudioAPI instance
+            max_per_appliance (optional) - running builds per appliance
+            max_running (optional) - running builds in the account
+            retries (optional) - resubmissions of an extra format after
+                                 image_already_exists
+            retry_delay (optional) - seconds before the first resubmission,
+                                     doubled for every further one
+            force (optional) - overwrite existing images of the same
+                               version and type, instead of failing
+            watcher (optional) - BuildWatcher the builds are polled with
+
+    Jobs are added with add() or matrix() and built by run().  Should the
+    watcher's thread die, the jobs that are left fail instead of waiting
+    forever.
+    """
+    # seconds between checks that the watcher is still polling
+    check_interval = 5
+
+    def __init__(self, studio, max_per_appliance=2, max_running=10,
+        retries=3, retry_delay=60, force=False, watcher=None):
+        self.studio = studio
+        self.max_per_appliance = max_per_appliance
+        self.max_running = max_running
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.force = force
+        self.watcher = watcher or BuildWatcher(studio)
+        self.jobs = []
+        self._cond = threading.Condition()
+        self._foreign = {}  # appliance id -> ids of builds we didn't start
+
+    def add(self, appliance_id, version, image_types, after=()):
+        """add the builds of one appliance version, returns their jobs
+
+            Arguments:
+
+                appliance_id - Id of the appliance
+                version - version to build
+                image_types - formats, the first one is built before the
+                              others
+                after (optional) - jobs that have to finish first
+        """
+        appliance_id = str(appliance_id).strip()
+        jobs = []
+        for image_type in image_types:
+            if image_type not in IMAGE_TYPES:
+                raise StudioError, "unknown image type %s" % image_type
+            first = jobs and jobs[0] or None
+            jobs.append(BuildJob(appliance_id, version, image_type,
+                                 list(after) + jobs[:1], first))
+        with self._cond:
+            self.jobs.extend(jobs)
+        return jobs
+
+    def matrix(self, appliance_ids, versions, image_types):
+        """add every combination, versions of an appliance in order
+        """
+        jobs = []
+        for appliance_id in appliance_ids:
+            previous = ()
+            for version in versions:
+                previous = self.add(appliance_id, version, image_types,
+                                    after=previous)
+                jobs.extend(previous)
+        return jobs
+
+    def run(self, timeout=None):
+        """build every pending job, returns the jobs once none is left
+        running (or timeout expires)
+        """
+        deadline = timeout is not None and time.time() + timeout
+        self.watcher.start()
+        try:
+            while True:
+                with self._cond:
+                    appliances = set(j.appliance_id for j in self.jobs
+                                     if j.state == 'pending') - set(self._foreign)
+                for appliance_id in sorted(appliances):
+                    self._adopt(appliance_id)
+                with self._cond:
+                    if not self.watcher.alive():
+                        self._abandon(StudioError(
+                            "the build watcher stopped polling"))
+                    self._skip_failed()
+                    if not [j for j in self.jobs
+                            if j.state in ('pending', 'running')]:
+                        break
+                    now = time.time()
+                    if deadline and now >= deadline:
+                        break
+                    ready = self._ready(now)
+                    if not ready:
+                        waits = [j.due - now for j in self.jobs
+                                 if j.state == 'pending' and j.due > now]
+                        if deadline:
+                            waits.append(deadline - now)
+                        self._cond.wait(min(waits + [self.check_interval]))
+                        continue
+                    for job in ready:
+                        job.state = 'running'
+                self._submit(ready)
+        finally:
+            self.watcher.stop()
+        return list(self.jobs)
+
+    def _ready(self, now):
+        """jobs to submit now, within the limits"""
+        running = {}
+        total = 0
+        for appliance_id, builds in self._foreign.items():
+            running[appliance_id] = len(builds)
+            total += len(builds)
+        for job in self.jobs:
+            if job.state == 'running':
+                running[job.appliance_id] = running.get(job.appliance_id,
+                                                        0) + 1
+                total += 1
+        ready = []
+        for job in self.jobs:
+            if total >= self.max_running:
+                break
+            if (job.state != 'pending' or job.due > now
+                or running.get(job.appliance_id, 0) >= self.max_per_appliance
+                or [d for d in job.depends if d.state != 'finished']):
+                continue
+            ready.append(job)
+            running[job.appliance_id] = running.get(job.appliance_id, 0) + 1
+            total += 1
+        return ready
+
+    def _adopt(self, appliance_id):
+        """count the builds already running on appliance_id"""
+        builds = set()
+        with self._cond:
+            self._foreign[appliance_id] = builds
+        running = self.studio.get_running_appliance_builds(appliance_id)
+        for status in running.findall('running_build'):
+            build_id = _text(status, 'id')
+            with self._cond:
+                builds.add(build_id)
+            self.watcher.watch(build_id, appliance_id).add_done_callback(
+                lambda future, builds=builds: self._released(builds, future))
+
+    def _released(self, builds, future):
+        with self._cond:
+            builds.discard(future.build_id)
+            self._cond.notify_all()
+
+    def _submit(self, jobs):
+        for job, build, error in self.studio.batch(self._add_build,
+            [(job,) for job in jobs], len(jobs)):
+            job = job[0]
+            if error is None and _error_code(build) is None:
+                job.build_id = _text(build, 'id')
+                job.future = self.watcher.watch(job.build_id, job.appliance_id)
+                job.future.add_done_callback(
+                    lambda future, job=job: self._done(job, future))
+                continue
+            if error is None:
+                code, error = _error_code(build), StudioError(
+                    "%s: %s" % (_error_code(build), _text(build, 'message')))
+            else:
+                code = getattr(error, 'studio_code', None)
+            with self._cond:
+                if (code == 'image_already_exists' and self._retryable(job)):
+                    # the version's first image may not be registered yet
+                    job.state = 'pending'
+                    job.due = time.time() + self.retry_delay * 2 ** (
+                        job.attempts - 1)
+                else:
+                    job.state = 'failed'
+                    job.error = error
+                self._cond.notify_all()
+
+    def _retryable(self, job):
+        """only an extra format whose first format this orchestrator just
+        built can be refused by mistake - otherwise the image exists
+        """
+        return (job.first is not None and job.first.build_id is not None
+                and job.first.state == 'finished'
+                and job.attempts <= self.retries)
+
+    def _add_build(self, job):
+        job.attempts += 1
+        try:
+            return self.studio.add_build(job.appliance_id,
+                force=self.force and 'true' or '', version=job.version,
+                image_type=job.image_type, multi=job.multi and 'true' or '')
+        except urllib2.HTTPError, e:
+            try:
+                e.studio_code = _error_code(ET.fromstring(e.read()))
+            except Exception:
+                e.studio_code = None
+            raise e
+
+    def _done(self, job, future):
+        with self._cond:
+            try:
+                job.info = future.result(0)
+                job.state = 'finished'
+            except Exception, e:
+                job.state = 'failed'
+                job.error = e
+            self._cond.notify_all()
+
+    def _abandon(self, error):
+        """fail every job that is pending or running"""
+        for job in self.jobs:
+            if job.state in ('pending', 'running'):
+                job.state = 'failed'
+                job.error = error
+
+    def _skip_failed(self):
+        """fail the pending jobs whose dependencies failed"""
+        changed = True
+        while changed:
+            changed = False
+            for job in self.jobs:
+                if job.state != 'pending':
+                    continue
+                for depend in job.depends:
+                    if depend.state == 'failed':
+                        job.state = 'failed'
+                        job.error = StudioError("%r failed" % depend)
+                        changed = True
+                        break
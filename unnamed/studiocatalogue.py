@@ -0,0 +1,514 @@
+#!/usr/bin/env python
+
+"""
+Local package catalogue for the SUSE Studio API.
+
+PackageCatalogue keeps the packages and patterns seen in software maps
+(get_appliance_installed_software / search_appliance_software and their
+iter_* forms) per repository, so "is package X available in repository Y"
+is a dict lookup instead of a round trip.  Name, version, arch and checksum
+are indexed for exact, prefix and substring queries.  The catalogue can be
+saved to disk and is refreshed one repository at a time: loading a
+software map replaces only the repositories it contains.
+
+RepositoryCatalogue does the same for the repository list: it is fetched
+once per base system (get_repositories), kept for ttl seconds, saved to
+disk and indexed by id, name and URL.  search() replaces the server side
+filter of get_repositories, and info() answers get_repository_info from
+the catalogue.
+
+Basic Usage:
+import studioapi, studiocatalogue
+
+studio = studioapi.StudioAPI(connection)
+catalogue = studiocatalogue.PackageCatalogue('/var/cache/studio/packages.json')
+catalogue.refresh_installed(studio, appliance_id)
+catalogue.refresh_search(studio, appliance_id, 'vim', all_repos=True)
+catalogue.save()
+
+catalogue.available('vim', repository_id=6347)
+catalogue.prefix('name', 'python-')
+
+repositories = studiocatalogue.RepositoryCatalogue(studio,
+    '/var/cache/studio/repositories.json', ttl=86400)
+repositories.search('updates', base_system='SLES11_SP1')
+repositories.info(6343)
+
+"""
+__all__ = ['PackageCatalogue', 'RepositoryCatalogue']
+__license__ = 'GPL v.2 http://www.gnu.org/licenses/gpl.txt'
+
+import os
+import json
+import time
+import bisect
+import threading
+
+from studiotypes import Package, Repository, records
+
+INDEXED = ('name', 'version', 'arch', 'checksum')
+# repository fields searched, the same the server side filter looked at
+REPOSITORY_INDEXED = ('name', 'base_url', 'repotag')
+
+
+def _trigrams(value):
+    return set(value[i:i + 3] for i in range(len(value) - 2))
+
+
+class _FieldIndex:
+    """value -> package ids, with a sorted value list for prefix queries and
+    a trigram index for substring queries
+    """
+    def __init__(self):
+        self.values = {}
+        self.trigrams = {}
+        self._sorted = None
+
+    def add(self, value, pid):
+        if value is None:
+            return
+        pids = self.values.get(value)
+        if pids is None:
+            pids = self.values[value] = set()
+            for trigram in _trigrams(value):
+                self.trigrams.setdefault(trigram, set()).add(value)
+            self._sorted = None
+        pids.add(pid)
+
+    def remove(self, value, pid):
+        pids = self.values.get(value)
+        if pids is None:
+            return
+        pids.discard(pid)
+        if not pids:
+            del self.values[value]
+            for trigram in _trigrams(value):
+                values = self.trigrams[trigram]
+                values.discard(value)
+                if not values:
+                    del self.trigrams[trigram]
+            self._sorted = None
+
+    def exact(self, value):
+        return self.values.get(value, ())
+
+    def prefix(self, prefix):
+        if self._sorted is None:
+            self._sorted = sorted(self.values)
+        pids = set()
+        i = bisect.bisect_left(self._sorted, prefix)
+        while i < len(self._sorted) and self._sorted[i].startswith(prefix):
+            pids.update(self.values[self._sorted[i]])
+            i += 1
+        return pids
+
+    def substring(self, text):
+        if len(text) < 3:
+            candidates = self.values
+        else:
+            sets = []
+            for trigram in _trigrams(text):
+                values = self.trigrams.get(trigram)
+                if not values:
+                    return set()
+                sets.append(values)
+            sets.sort(key=len)
+            candidates = sets[0].intersection(*sets[1:])
+        pids = set()
+        for value in candidates:
+            if text in value:
+                pids.update(self.values[value])
+        return pids
+
+
+class PackageCatalogue:
+    """Packages and patterns per repository, indexed for local lookups
+
+        Arguments:
+
+            path (optional) - file the catalogue is loaded from and saved to
+
+    Entries are studiotypes.Package records.  Queries take an optional
+    repository_id (and type - 'package' or 'pattern') to narrow the result.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.RLock()
+        self._packages = {}     # package id -> Package
+        self._repositories = {} # repository id -> {'name', 'updated', 'pids'}
+        self._indexes = dict((field, _FieldIndex()) for field in INDEXED)
+        self._next_pid = 0
+        if path and os.path.exists(path):
+            self.load()
+
+    def add(self, software, replace=True):
+        """Add the packages of a software map
+
+            Arguments:
+
+                software - a software_map element, or the (repository,
+                           package) pairs from an iter_* call
+                replace (optional) - drop what was known about each
+                                     repository in software first
+
+        Returns the ids of the repositories that were updated.
+        """
+        if hasattr(software, 'findall'):
+            software = [(repository, elem)
+                        for repository in software.findall('repository')
+                        for elem in repository.findall('software/*')]
+        records = {}
+        names = {}
+        for repository, elem in software:
+            record = Package.from_element(elem, repository)
+            records.setdefault(record.repository_id, []).append(record)
+            names[record.repository_id] = record.repository_name
+        now = time.time()
+        with self._lock:
+            for repository_id, packages in records.items():
+                if replace:
+                    self.remove_repository(repository_id)
+                repository = self._repositories.setdefault(repository_id,
+                    {'name': names[repository_id], 'pids': set()})
+                repository['updated'] = now
+                known = set((p.type, p.name, p.version, p.arch)
+                            for p in self._repository_packages(repository_id))
+                for record in packages:
+                    key = (record.type, record.name, record.version,
+                           record.arch)
+                    if key not in known:
+                        known.add(key)
+                        self._insert(record)
+        return sorted(records)
+
+    def refresh_installed(self, studio, appliance_id, build_id=''):
+        """replace the repositories listed in the installed software of an
+        appliance (build), returns their ids
+        """
+        return self.add(studio.iter_appliance_installed_software(appliance_id,
+                                                                 build_id))
+
+    def refresh_search(self, studio, appliance_id, q, all_fields=False,
+        all_repos=False):
+        """add the results of a software search, returns the repository ids
+        """
+        return self.add(studio.iter_appliance_software_search(appliance_id, q,
+            all_fields, all_repos), replace=False)
+
+    def remove_repository(self, repository_id):
+        with self._lock:
+            repository = self._repositories.pop(repository_id, None)
+            if repository is None:
+                return
+            for pid in repository['pids']:
+                record = self._packages.pop(pid)
+                for field, index in self._indexes.items():
+                    index.remove(getattr(record, field), pid)
+
+    def repositories(self):
+        """{repository id: (name, updated)}"""
+        with self._lock:
+            return dict((repository_id, (r['name'], r['updated']))
+                        for repository_id, r in self._repositories.items())
+
+    def stale(self, max_age):
+        """ids of the repositories last refreshed more than max_age seconds
+        ago
+        """
+        limit = time.time() - max_age
+        with self._lock:
+            return sorted(repository_id for repository_id, r
+                          in self._repositories.items() if r['updated'] < limit)
+
+    def available(self, name, repository_id=None, version=None, arch=None,
+        type='package'):
+        """True if the catalogue has name (in repository_id, with version
+        and arch if given)
+        """
+        with self._lock:
+            for pid in self._indexes['name'].exact(name):
+                record = self._packages[pid]
+                if ((repository_id is None
+                     or record.repository_id == repository_id)
+                    and (version is None or record.version == version)
+                    and (arch is None or record.arch == arch)
+                    and (type is None or record.type == type)):
+                    return True
+        return False
+
+    def find(self, repository_id=None, type=None, **fields):
+        """packages whose fields match exactly, e.g. find(name='vim')
+        """
+        with self._lock:
+            pids = None
+            for field, value in fields.items():
+                found = self._indexes[field].exact(value)
+                pids = set(found) if pids is None else pids & set(found)
+            if pids is None:
+                pids = self._packages
+            return self._select(pids, repository_id, type)
+
+    def prefix(self, field, prefix, repository_id=None, type=None):
+        """packages whose field (name, version, arch, checksum) starts with
+        prefix
+        """
+        with self._lock:
+            return self._select(self._indexes[field].prefix(prefix),
+                                repository_id, type)
+
+    def search(self, field, text, repository_id=None, type=None):
+        """packages whose field (name, version, arch, checksum) contains text
+        """
+        with self._lock:
+            return self._select(self._indexes[field].substring(text),
+                                repository_id, type)
+
+    def save(self, path=None):
+        """write the catalogue to path (default self.path)
+        """
+        path = path or self.path
+        with self._lock:
+            data = {'repositories': [
+                {'id': repository_id, 'name': r['name'],
+                 'updated': r['updated'],
+                 'packages': [self._packages[pid].__getstate__()
+                              for pid in sorted(r['pids'])]}
+                for repository_id, r in self._repositories.items()]}
+        tmp = '%s.tmp' % path
+        with open(tmp, 'w') as fd:
+            json.dump(data, fd)
+        os.rename(tmp, path)
+
+    def load(self, path=None):
+        """replace the catalogue with the one saved in path (default
+        self.path)
+        """
+        with open(path or self.path) as fd:
+            data = json.load(fd)
+        with self._lock:
+            for repository_id in list(self._repositories):
+                self.remove_repository(repository_id)
+            for repository in data['repositories']:
+                self._repositories[repository['id']] = {
+                    'name': repository['name'],
+                    'updated': repository['updated'], 'pids': set()}
+                for state in repository['packages']:
+                    record = Package.__new__(Package)
+                    record.__setstate__([_str(value) for value in state])
+                    self._insert(record)
+
+    def __len__(self):
+        return len(self._packages)
+
+    def _insert(self, record):
+        pid = self._next_pid
+        self._next_pid += 1
+        self._packages[pid] = record
+        self._repositories[record.repository_id]['pids'].add(pid)
+        for field, index in self._indexes.items():
+            index.add(getattr(record, field), pid)
+
+    def _repository_packages(self, repository_id):
+        repository = self._repositories.get(repository_id)
+        if repository is None:
+            return []
+        return [self._packages[pid] for pid in repository['pids']]
+
+    def _select(self, pids, repository_id, type):
+        result = []
+        for pid in pids:
+            record = self._packages[pid]
+            if repository_id is not None and record.repository_id != repository_id:
+                continue
+            if type is not None and record.type != type:
+                continue
+            result.append(record)
+        result.sort(key=lambda r: (r.repository_id, r.name, r.version))
+        return result
+
+
+class RepositoryCatalogue:
+    """Repositories per base system, indexed for local lookups
+
+        Arguments:
+
+            studio - StudioAPI instance the lists are fetched with
+            path (optional) - file the catalogue is loaded from and saved to
+            ttl (optional) - seconds a fetched list is used
+
+    A base system's list is fetched on the first query for it and again
+    once it is older than ttl; fetching all repositories (base_system '')
+    fills every base system.  Entries are studiotypes.Repository records.
+    Name and URL queries ignore case.
+    """
+    def __init__(self, studio, path=None, ttl=86400):
+        self.studio = studio
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._repositories = {} # repository id -> Repository
+        self._partitions = {}   # base system -> {'updated', 'ids'}
+        self._indexes = dict((field, _FieldIndex())
+                             for field in REPOSITORY_INDEXED)
+        if path and os.path.exists(path):
+            self.load()
+
+    def refresh(self, base_system=''):
+        """fetch the repositories of base_system ('' for all) now, returns
+        them
+        """
+        fetched = records(Repository, self.studio.get_repositories(base_system))
+        partitions = {}
+        for record in fetched:
+            partitions.setdefault(record.base_system or '', []).append(record)
+        if base_system:
+            partitions.setdefault(base_system, [])
+        now = time.time()
+        with self._lock:
+            if not base_system:
+                for name in list(self._partitions):
+                    self._remove_partition(name)
+            for name, repositories in partitions.items():
+                self._remove_partition(name)
+                partition = self._partitions[name] = {'updated': now,
+                                                      'ids': set()}
+                for record in repositories:
+                    self._insert(record, partition)
+            if not base_system:
+                self._partitions.setdefault('', {'ids': set()})['updated'] = now
+        return sorted(fetched, key=lambda r: r.id)
+
+    def repositories(self, base_system=''):
+        """the repositories of base_system ('' for all), fetched if the
+        catalogue has no fresh list
+        """
+        self._ensure(base_system)
+        with self._lock:
+            return self._select(self._repositories, base_system)
+
+    def info(self, repo_id):
+        """Repository for repo_id; one the catalogue doesn't know is fetched
+        with get_repository_info (and not kept)
+        """
+        with self._lock:
+            record = self._repositories.get(int(repo_id))
+        if record is not None:
+            return record
+        return Repository.from_element(self.studio.get_repository_info(repo_id))
+
+    def find(self, base_system='', **fields):
+        """repositories whose fields (name, base_url, repotag) match,
+        ignoring case, e.g. find(name='SLES 11 SP1 i386')
+        """
+        self._ensure(base_system)
+        with self._lock:
+            ids = None
+            for field, value in fields.items():
+                found = set(self._indexes[field].exact(value.lower()))
+                ids = found if ids is None else ids & found
+            if ids is None:
+                ids = self._repositories
+            return self._select(ids, base_system)
+
+    def search(self, text, base_system='', fields=REPOSITORY_INDEXED):
+        """repositories whose name or URL (base_url, repotag) contains text
+        """
+        self._ensure(base_system)
+        text = text.lower()
+        with self._lock:
+            ids = set()
+            for field in fields:
+                ids.update(self._indexes[field].substring(text))
+            return self._select(ids, base_system)
+
+    def stale(self):
+        """base systems whose list is older than ttl"""
+        limit = time.time() - self.ttl
+        with self._lock:
+            return sorted(name for name, partition in self._partitions.items()
+                          if partition['updated'] < limit)
+
+    def save(self, path=None):
+        """write the catalogue to path (default self.path)
+        """
+        path = path or self.path
+        with self._lock:
+            data = {'partitions': [
+                {'base_system': name, 'updated': partition['updated'],
+                 'repositories': [self._repositories[repo_id].__getstate__()
+                                  for repo_id in sorted(partition['ids'])]}
+                for name, partition in self._partitions.items()]}
+        tmp = '%s.tmp' % path
+        with open(tmp, 'w') as fd:
+            json.dump(data, fd)
+        os.rename(tmp, path)
+
+    def load(self, path=None):
+        """replace the catalogue with the one saved in path (default
+        self.path)
+        """
+        with open(path or self.path) as fd:
+            data = json.load(fd)
+        with self._lock:
+            for name in list(self._partitions):
+                self._remove_partition(name)
+            for saved in data['partitions']:
+                partition = self._partitions[_str(saved['base_system'])] = {
+                    'updated': saved['updated'], 'ids': set()}
+                for state in saved['repositories']:
+                    record = Repository.__new__(Repository)
+                    record.__setstate__([_str(value) for value in state])
+                    self._insert(record, partition)
+
+    def __len__(self):
+        return len(self._repositories)
+
+    def _fresh(self, base_system):
+        limit = time.time() - self.ttl
+        with self._lock:
+            return any(name in self._partitions
+                       and self._partitions[name]['updated'] >= limit
+                       for name in (base_system, ''))
+
+    def _ensure(self, base_system):
+        if not self._fresh(base_system):
+            self.refresh(base_system)
+
+    def _insert(self, record, partition):
+        self._repositories[record.id] = record
+        partition['ids'].add(record.id)
+        for field, index in self._indexes.items():
+            value = getattr(record, field)
+            if value is not None:
+                index.add(value.lower(), record.id)
+
+    def _remove_partition(self, name):
+        partition = self._partitions.pop(name, None)
+        if partition is None:
+            return
+        for repo_id in partition['ids']:
+            record = self._repositories.get(repo_id)
+            if record is None or (record.base_system or '') != name:
+                continue    # moved to another base system since
+            del self._repositories[repo_id]
+            for field, index in self._indexes.items():
+                value = getattr(record, field)
+                if value is not None:
+                    index.remove(value.lower(), repo_id)
+
+    def _select(self, ids, base_system):
+        result = [self._repositories[repo_id] for repo_id in ids
+                  if not base_system
+                  or self._repositories[repo_id].base_system == base_system]
+        result.sort(key=lambda r: r.id)
+        return result
+
+
+def _str(value):
+    """json gives unicode, records hold str where possible"""
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeEncodeError:
+            return value
+    return value
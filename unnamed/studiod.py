@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+"""
+Local daemon for the SUSE Studio API.
+
+StudioDaemon keeps one StudioAPI session - pooled keep-alive connections,
+credentials and a response cache - in a long running process and serves
+its endpoint methods over a Unix socket.  DaemonClient forwards calls to
+it, so one-shot scripts and shell tools skip interpreter warm up, opener
+construction, TLS/auth handshakes and cold caches.
+
+The protocol is one JSON object per line: {"method", "args", "kwargs"}
+is answered with {"result", "type"} or {"error", "message", "code"}.
+
+Basic Usage:
+$ STUDIO_USER=user STUDIO_API_KEY=key python studiod.py serve &
+$ python studiod.py get_appliances
+$ python studiod.py add_build 266657 image_type=oem
+
+import studiod
+
+studio = studiod.DaemonClient()
+appliances = studio.get_appliances()
+
+"""
+__all__ = ['StudioDaemon', 'DaemonClient', 'DaemonError', 'main']
+__license__ = 'GPL v.2 http://www.gnu.org/licenses/gpl.txt'
+
+import os
+import sys
+import json
+import socket
+import urllib2
+import SocketServer
+from StringIO import StringIO
+
+import studioapi
+from studioapi import ET, StudioError
+
+# methods that don't make sense across a socket: batch takes a callable,
+# the others take ET elements or file objects that JSON can't carry
+EXCLUDED = ('batch', 'set_appliance_software', 'add_overlay_file_metadata',
+            'upload_appliance_overlay_file', 'replace_overlay_file',
+            'upload_rpm', 'update_rpm')
+
+
+def default_socket_path():
+    directory = os.environ.get('XDG_RUNTIME_DIR') or os.path.expanduser('~')
+    return os.path.join(directory, '.studiod.sock')
+
+
+def _str(value):
+    """json gives unicode, StudioAPI expects utf-8 str"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def _methods(studio):
+    return sorted(name for name in dir(studio)
+                  if not name.startswith('_') and not name.startswith('iter_')
+                  and name not in EXCLUDED
+                  and callable(getattr(studio, name)))
+
+
+class DaemonError(StudioError):
+    """An error raised in the daemon that has no local equivalent
+    """
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            self.wfile.write(json.dumps(self.server.call(line)) + '\n')
+            self.wfile.flush()
+
+
+class StudioDaemon(SocketServer.ThreadingMixIn,
+                   SocketServer.UnixStreamServer):
+    """Serves the endpoint methods of studio on the Unix socket path
+
+        Arguments:
+
+            studio - StudioAPI instance shared by all clients
+            path (optional) - socket path, default $XDG_RUNTIME_DIR/.studiod.sock
+                              (or ~/.studiod.sock)
+
+    The socket is only accessible by its owner, the session holds the
+    owner's credentials.
+    """
+    daemon_threads = True
+
+    def __init__(self, studio, path=None):
+        self.studio = studio
+        self.path = path or default_socket_path()
+        self.methods = frozenset(_methods(studio))
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                os.remove(self.path)    # left over from a dead daemon
+            else:
+                raise StudioError, "a daemon is already serving %s" % self.path
+            finally:
+                probe.close()
+        umask = os.umask(0177)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, self.path, _Handler)
+        finally:
+            os.umask(umask)
+
+    def call(self, line):
+        """runs the call described by the JSON line, returns the reply"""
+        try:
+            request = json.loads(line)
+            method = request['method']
+            if method == 'methods':
+                return {'result': sorted(self.methods), 'type': 'json'}
+            if method not in self.methods:
+                raise StudioError, "unknown method %s" % method
+            args = [_str(a) for a in request.get('args', ())]
+            kwargs = dict((str(k), _str(v))
+                          for k, v in request.get('kwargs', {}).items())
+            result = getattr(self.studio, method)(*args, **kwargs)
+        except urllib2.HTTPError, e:
+            return {'error': 'HTTPError', 'code': e.code, 'url': e.geturl(),
+                    'message': e.read().decode('utf-8', 'replace')}
+        except urllib2.URLError, e:
+            return {'error': 'URLError', 'message': str(e.reason)}
+        except Exception, e:
+            return {'error': e.__class__.__name__, 'message': str(e)}
+        if ET.iselement(result):
+            return {'result': ET.tostring(result), 'type': 'xml'}
+        if isinstance(result, str):
+            return {'result': result.encode('base64'), 'type': 'raw'}
+        return {'result': result, 'type': 'json'}
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class DaemonClient:
+    """Calls the StudioAPI methods of a StudioDaemon
+
+    Results are the same as from StudioAPI - elements, strings or numbers -
+    and HTTP errors are raised as urllib2.HTTPError.  One connection is
+    kept open for all calls.
+    """
+    def __init__(self, path=None, timeout=None):
+        self.path = path or default_socket_path()
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+
+    def _connect(self):
+        self._sock = socket.socket(socket.AF_UNIX)
+        self._sock.settimeout(self.timeout)
+        self._sock.connect(self.path)
+        self._file = self._sock.makefile('rb')
+
+    def call(self, method, *args, **kwargs):
+        line = json.dumps({'method': method, 'args': args,
+                           'kwargs': kwargs}) + '\n'
+        if self._sock is None:
+            self._connect()
+        try:
+            self._sock.sendall(line)
+            reply = self._file.readline()
+        except socket.error:
+            self.close()
+            raise
+        if not reply:
+            self.close()
+            raise StudioError, "the daemon closed the connection"
+        reply = json.loads(reply)
+        if 'error' in reply:
+            if reply['error'] == 'HTTPError':
+                message = reply['message'].encode('utf-8')
+                raise urllib2.HTTPError(reply['url'], reply['code'], message,
+                                        None, StringIO(message))
+            if reply['error'] == 'URLError':
+                raise urllib2.URLError(reply['message'])
+            if reply['error'] == 'StudioError':
+                raise StudioError, reply['message']
+            raise DaemonError, '%s: %s' % (reply['error'], reply['message'])
+        if reply['type'] == 'xml':
+            return ET.fromstring(reply['result'].encode('utf-8'))
+        if reply['type'] == 'raw':
+            return reply['result'].decode('base64')
+        return reply['result']
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError, name
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+    def close(self):
+        if self._sock is not None:
+            self._file.close()
+            self._sock.close()
+            self._sock = self._file = None
+
+
+def _serve(options):
+    user = os.environ.get('STUDIO_USER')
+    key = os.environ.get('STUDIO_API_KEY')
+    if not user or not key:
+        sys.stderr.write('set STUDIO_USER and STUDIO_API_KEY\n')
+        return 2
+    connection = studioapi.AuthConnection(user, key, options.host)
+    cache = studioapi.ResponseCache(ttl=options.ttl)
+    studio = studioapi.StudioAPI(connection, cache=cache,
+        retry=studioapi.RetryPolicy(), breaker=studioapi.CircuitBreaker())
+    daemon = StudioDaemon(studio, options.socket)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+        connection.close()
+    return 0
+
+
+def main(argv=None):
+    """studiod.py serve | studiod.py <method> [arg ...] [name=value ...]
+    """
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog serve | %prog METHOD [ARG ...] '
+                                '[NAME=VALUE ...]')
+    parser.add_option('--socket', default=None,
+                      help='socket path (default %s)' % default_socket_path())
+    parser.add_option('--host', default='http://susestudio.com',
+                      help='Studio server, for serve')
+    parser.add_option('--ttl', type='int', default=300,
+                      help='seconds responses are cached, for serve')
+    options, args = parser.parse_args(argv)
+    if not args:
+        parser.print_usage()
+        return 2
+    if args[0] == 'serve':
+        return _serve(options)
+
+    # arguments stay strings, the API takes numbers and true/false as text
+    positional = [a for a in args[1:] if '=' not in a]
+    named = dict(a.split('=', 1) for a in args[1:] if '=' in a)
+    client = DaemonClient(options.socket)
+    try:
+        result = client.call(args[0], *positional, **named)
+    except urllib2.HTTPError, e:
+        sys.stderr.write('HTTP %d: %s\n' % (e.code, e.read()))
+        return 1
+    except (StudioError, urllib2.URLError, socket.error), e:
+        sys.stderr.write('%s\n' % e)
+        return 1
+    finally:
+        client.close()
+    if ET.iselement(result):
+        result = ET.tostring(result)
+    elif not isinstance(result, str):
+        result = json.dumps(result)
+    sys.stdout.write(result)
+    if not result.endswith('\n'):
+        sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
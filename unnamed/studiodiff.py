@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""
+Installed software comparison for SUSE Studio builds.
+
+SoftwareComparer fetches the installed software of several builds at once
+(get_appliance_installed_software, streamed), reduces each to a dict keyed
+by (name, arch) and compares them with set operations.  Finished builds
+don't change, so their package lists are kept and reused by later
+comparisons; builds that are still running or failed are fetched again.
+
+Basic Usage:
+import studioapi, studiodiff
+
+studio = studioapi.StudioAPI(connection)
+comparer = studiodiff.SoftwareComparer(studio)
+diff = comparer.compare(appliance_id, old_build_id, new_build_id)
+for name, arch, old_version, new_version in diff.changed:
+    print name, old_version, '->', new_version
+
+"""
+__all__ = ['SoftwareComparer', 'SoftwareDiff']
+__license__ = 'GPL v.2 http://www.gnu.org/licenses/gpl.txt'
+
+import threading
+from collections import OrderedDict
+
+from studiotypes import Package
+
+
+class SoftwareDiff:
+    """Difference between two package lists
+
+    added and removed are sorted (name, arch, version) tuples, changed is
+    sorted (name, arch, old version, new version) tuples.  A package that
+    is installed in more than one version has them joined by spaces.
+    """
+    def __init__(self, old, new):
+        old_keys = set(old)
+        new_keys = set(new)
+        self.added = sorted(key + (new[key],) for key in new_keys - old_keys)
+        self.removed = sorted(key + (old[key],) for key in old_keys - new_keys)
+        self.changed = sorted(key + (old[key], new[key])
+                              for key in old_keys & new_keys
+                              if old[key] != new[key])
+
+    def __nonzero__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def __repr__(self):
+        return '<SoftwareDiff +%d -%d ~%d>' % (len(self.added),
+            len(self.removed), len(self.changed))
+
+
+class SoftwareComparer:
+    """Compares the installed software of builds
+
+        Arguments:
+
+            studio - StudioAPI instance
+            max_workers (optional) - number of builds fetched concurrently
+            cache_size (optional) - number of finished builds kept
+
+    A build is identified by (appliance id, build id); the build id '' is
+    the current configuration of the appliance, which is never cached.
+    Other builds are only cached once get_build_info (asked without the
+    response cache) reports them finished.
+    """
+    def __init__(self, studio, max_workers=4, cache_size=256):
+        self.studio = studio
+        self.max_workers = max_workers
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    def software(self, builds):
+        """{(appliance id, build id): {(name, arch): version}} for builds,
+        fetching the ones that aren't cached concurrently
+        """
+        builds = [(str(a).strip(), str(b).strip()) for a, b in builds]
+        result = {}
+        missing = []
+        with self._lock:
+            for build in builds:
+                if build in self._cache:
+                    self._cache[build] = self._cache.pop(build)
+                    result[build] = self._cache[build]
+                elif build not in missing:
+                    missing.append(build)
+        for build, fetched, error in self.studio.batch(self._fetch, missing,
+                                                       self.max_workers):
+            if error is not None:
+                raise error
+            packages, finished = fetched
+            result[build] = packages
+            if finished:
+                with self._lock:
+                    self._cache[build] = packages
+                    while len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+        return result
+
+    def compare(self, appliance_id, old_build_id, new_build_id=''):
+        """SoftwareDiff from old_build_id to new_build_id (by default the
+        current configuration)
+        """
+        old = (appliance_id, old_build_id)
+        new = (appliance_id, new_build_id)
+        software = self.software([old, new])
+        return SoftwareDiff(software[self._key(old)], software[self._key(new)])
+
+    def compare_series(self, appliance_id, build_ids):
+        """[(old build id, new build id, SoftwareDiff)] for each consecutive
+        pair of build_ids, e.g. all releases of an appliance
+        """
+        builds = [(appliance_id, b) for b in build_ids]
+        software = self.software(builds)
+        return [(old[1], new[1], SoftwareDiff(software[self._key(old)],
+                                              software[self._key(new)]))
+                for old, new in zip(builds, builds[1:])]
+
+    def compare_appliances(self, releases):
+        """{appliance id: SoftwareDiff} for releases, a list of
+        (appliance id, old build id, new build id), fetched together
+        """
+        builds = []
+        for appliance_id, old_build_id, new_build_id in releases:
+            builds.extend([(appliance_id, old_build_id),
+                           (appliance_id, new_build_id)])
+        software = self.software(builds)
+        return dict((appliance_id, SoftwareDiff(
+                        software[self._key((appliance_id, old_build_id))],
+                        software[self._key((appliance_id, new_build_id))]))
+                    for appliance_id, old_build_id, new_build_id in releases)
+
+    @staticmethod
+    def _key(build):
+        return (str(build[0]).strip(), str(build[1]).strip())
+
+    def _fetch(self, appliance_id, build_id):
+        """({(name, arch): version}, whether the build is finished)"""
+        finished = False
+        if build_id:
+            state = self.studio.get_build_info(build_id, cached=False
+                                               ).findtext('state')
+            finished = (state or '').strip() == 'finished'
+        versions = {}
+        for repository, elem in self.studio.iter_appliance_installed_software(
+            appliance_id, build_id):
+            if elem.tag != 'package':
+                continue
+            package = Package.from_element(elem)
+            key = (package.name, package.arch)
+            version = package.version or ''
+            if key in versions and versions[key] != version:
+                versions[key] = ' '.join(sorted(
+                    set(versions[key].split() + version.split())))
+            else:
+                versions[key] = version
+        return versions, finished
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+"""
+Local SQLite mirror of a SUSE Studio account.
+
+AccountMirror copies appliances, their status, software selection,
+repositories, overlay files, GPG keys, running and completed builds, and
+the uploaded RPMs of their base systems into an SQLite database, so
+reports can be answered with local SQL.
+
+A refresh lists the appliances once.  The configuration of an appliance
+(software, repositories, overlay files, GPG keys) is only fetched again
+when its last_edited changed, completed builds only when the builds the
+appliance lists changed.  Finished builds don't change, a row once stored
+is kept as it is.
+Status, running builds and RPM lists are fetched every time.  Appliances
+are fetched in parallel.
+
+Basic Usage:
+import studioapi, studiomirror
+
+studio = studioapi.StudioAPI(connection)
+mirror = studiomirror.AccountMirror(studio, 'account.db')
+mirror.refresh()
+mirror.execute('SELECT a.name FROM appliances a JOIN software s '
+               'ON s.appliance_id = a.id WHERE s.name = ?', ('vim',))
+
+"""
+__all__ = ['AccountMirror']
+__license__ = 'GPL v.2 http://www.gnu.org/licenses/gpl.txt'
+
+import time
+import sqlite3
+
+import studiotypes
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS appliances (
+    id INTEGER PRIMARY KEY, name TEXT, arch TEXT, type TEXT,
+    last_edited TEXT, estimated_raw_size TEXT,
+    estimated_compressed_size TEXT, edit_url TEXT, icon_url TEXT,
+    basesystem TEXT, uuid TEXT, parent_id INTEGER, parent_name TEXT,
+    build_ids TEXT, refreshed_at REAL);
+CREATE TABLE IF NOT EXISTS appliance_status (
+    appliance_id INTEGER PRIMARY KEY, state TEXT, issues TEXT);
+CREATE TABLE IF NOT EXISTS software (
+    appliance_id INTEGER, type TEXT, name TEXT, version TEXT);
+CREATE INDEX IF NOT EXISTS software_appliance ON software (appliance_id);
+CREATE INDEX IF NOT EXISTS software_name ON software (name);
+CREATE TABLE IF NOT EXISTS appliance_repositories (
+    appliance_id INTEGER, id INTEGER, name TEXT, type TEXT,
+    base_system TEXT, base_url TEXT, PRIMARY KEY (appliance_id, id));
+CREATE INDEX IF NOT EXISTS appliance_repositories_id
+    ON appliance_repositories (id);
+CREATE TABLE IF NOT EXISTS overlay_files (
+    id INTEGER PRIMARY KEY, appliance_id INTEGER, filename TEXT, path TEXT,
+    owner TEXT, "group" TEXT, permissions TEXT, enabled INTEGER,
+    size INTEGER, checksum TEXT, checksum_type TEXT, download_url TEXT);
+CREATE INDEX IF NOT EXISTS overlay_files_appliance
+    ON overlay_files (appliance_id);
+CREATE TABLE IF NOT EXISTS gpg_keys (
+    id INTEGER PRIMARY KEY, appliance_id INTEGER, name TEXT, target TEXT,
+    key TEXT);
+CREATE INDEX IF NOT EXISTS gpg_keys_appliance ON gpg_keys (appliance_id);
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY, appliance_id INTEGER, version TEXT, state TEXT,
+    expired INTEGER, image_type TEXT, size INTEGER,
+    compressed_image_size INTEGER, md5 TEXT, sha1 TEXT, completed_at TEXT,
+    download_url TEXT);
+CREATE INDEX IF NOT EXISTS builds_appliance ON builds (appliance_id);
+CREATE TABLE IF NOT EXISTS running_builds (
+    id INTEGER PRIMARY KEY, appliance_id INTEGER, state TEXT,
+    percent INTEGER, time_elapsed INTEGER, message TEXT);
+CREATE INDEX IF NOT EXISTS running_builds_appliance
+    ON running_builds (appliance_id);
+CREATE TABLE IF NOT EXISTS rpms (
+    id INTEGER PRIMARY KEY, base_system TEXT, filename TEXT, size INTEGER,
+    archive INTEGER, checksum TEXT, checksum_type TEXT);
+CREATE INDEX IF NOT EXISTS rpms_base_system ON rpms (base_system);
+CREATE INDEX IF NOT EXISTS rpms_filename ON rpms (filename);
+"""
+
+# tables with per appliance configuration, replaced when it was edited
+CONFIG_TABLES = ('software', 'appliance_repositories', 'overlay_files',
+                 'gpg_keys')
+APPLIANCE_TABLES = CONFIG_TABLES + ('appliance_status', 'builds',
+                                    'running_builds')
+
+
+def _column(value):
+    if isinstance(value, bool):
+        return int(value)
+    if hasattr(value, 'isoformat'):
+        return value.isoformat(' ')
+    return value
+
+
+def _row(record, names):
+    return tuple(_column(getattr(record, name)) for name in names)
+
+
+def _build_ids(appliance):
+    return ' '.join(str(b.id) for b in appliance.builds)
+
+
+class AccountMirror:
+    """Mirrors the account of studio into the SQLite database path
+
+        Arguments:
+
+            studio - StudioAPI instance
+            path (optional) - database file, default in memory
+            max_workers (optional) - appliances fetched at once
+
+    The database (self.db) can be queried directly, or with execute().
+    """
+    def __init__(self, studio, path=':memory:', max_workers=4):
+        self.studio = studio
+        self.max_workers = max_workers
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def execute(self, sql, parameters=()):
+        return self.db.execute(sql, parameters)
+
+    def refresh(self, force=False):
+        """bring the mirror up to date, returns how many appliances (base
+        systems for 'rpms') each kind was fetched for, e.g.
+        {'appliances': 1, 'configuration': 2, 'builds': 0, ...}
+
+            Arguments:
+
+                force (optional) - fetch everything, as on the first refresh
+        """
+        stats = {'appliances': 1, 'configuration': 0, 'builds': 0,
+                 'status': 0, 'running_builds': 0, 'rpms': 0}
+        appliances = studiotypes.records(studiotypes.Appliance,
+                                         self.studio.get_appliances())
+        known = dict((row[0], row[1:]) for row in self.db.execute(
+            'SELECT id, last_edited, build_ids FROM appliances'))
+
+        work = []
+        for appliance in appliances:
+            last_edited, build_ids = known.get(appliance.id, (None, None))
+            edited = force or last_edited != _column(appliance.last_edited)
+            builds = force or build_ids != _build_ids(appliance)
+            work.append((appliance.id, edited, builds))
+
+        results = {}
+        for key, result, error in self.studio.batch(self._fetch, work,
+                                                    self.max_workers):
+            if error is not None:
+                raise error
+            results[key[0]] = result
+        base_systems = sorted(set(a.basesystem for a in appliances
+                                  if a.basesystem))
+        rpms = {}
+        for base_system, result, error in self.studio.batch(
+            self._fetch_rpms, base_systems, self.max_workers):
+            if error is not None:
+                raise error
+            rpms[base_system] = result
+
+        now = time.time()
+        with self.db:
+            gone = set(known) - set(a.id for a in appliances)
+            for appliance_id in gone:
+                self.db.execute('DELETE FROM appliances WHERE id = ?',
+                                (appliance_id,))
+                for table in APPLIANCE_TABLES:
+                    self.db.execute('DELETE FROM %s WHERE appliance_id = ?'
+                                    % table, (appliance_id,))
+            for appliance in appliances:
+                self._store_appliance(appliance, results[appliance.id], now,
+                                      stats)
+            self.db.execute('DELETE FROM rpms WHERE base_system NOT IN (%s)'
+                            % ','.join('?' * len(base_systems)), base_systems)
+            for base_system, records in rpms.items():
+                stats['rpms'] += 1
+                self.db.execute('DELETE FROM rpms WHERE base_system = ?',
+                                (base_system,))
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO rpms VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(r.id, base_system, r.filename, r.size, _column(r.archive),
+                      r.checksum, r.checksum_type) for r in records])
+        return stats
+
+    def _fetch(self, appliance_id, edited, builds):
+        """everything needed for one appliance, runs in the batch threads"""
+        studio = self.studio
+        result = {'status': studio.get_appliance_status(appliance_id),
+                  'running_builds': studiotypes.records(
+                      studiotypes.RunningBuild,
+                      studio.get_running_appliance_builds(appliance_id))}
+        if edited:
+            result['software'] = studio.get_appliance_software(appliance_id)
+            result['repositories'] = studiotypes.records(
+                studiotypes.Repository,
+                studio.get_appliance_repositories(appliance_id))
+            result['overlay_files'] = studiotypes.records(
+                studiotypes.OverlayFile,
+                studio.get_appliance_overlay_files(appliance_id))
+            result['gpg_keys'] = studiotypes.records(studiotypes.GpgKey,
+                studio.get_appliance_gpg_keys(appliance_id))
+        if builds:
+            result['builds'] = studiotypes.records(studiotypes.Build,
+                studio.get_completed_builds(appliance_id))
+        return result
+
+    def _fetch_rpms(self, base_system):
+        return studiotypes.records(studiotypes.Rpm,
+                                   self.studio.get_base_system_rpms(base_system))
+
+    def _store_appliance(self, appliance, result, now, stats):
+        db = self.db
+        appliance_id = appliance.id
+        fields = [f[0] for f in studiotypes.Appliance.fields]
+        db.execute('INSERT OR REPLACE INTO appliances (%s, build_ids, '
+                   'refreshed_at) VALUES (%s)' % (', '.join(fields),
+                                    ', '.join('?' * (len(fields) + 2))),
+                   _row(appliance, fields) + (_build_ids(appliance), now))
+
+        stats['status'] += 1
+        status = result['status']
+        issues = [i.findtext('text', '').strip()
+                  for i in status.findall('issues/issue')]
+        db.execute('INSERT OR REPLACE INTO appliance_status VALUES (?, ?, ?)',
+                   (appliance_id, status.findtext('state', '').strip(),
+                    '\n'.join(issues)))
+
+        stats['running_builds'] += 1
+        db.execute('DELETE FROM running_builds WHERE appliance_id = ?',
+                   (appliance_id,))
+        db.executemany('INSERT OR REPLACE INTO running_builds '
+                       'VALUES (?, ?, ?, ?, ?, ?)',
+            [(b.id, appliance_id, b.state, b.percent, b.time_elapsed,
+              b.message) for b in result['running_builds']])
+
+        if 'software' in result:
+            stats['configuration'] += 1
+            for table in CONFIG_TABLES:
+                db.execute('DELETE FROM %s WHERE appliance_id = ?' % table,
+                           (appliance_id,))
+            db.executemany('INSERT INTO software (appliance_id, type, name, '
+                           'version) VALUES (?, ?, ?, ?)',
+                [(appliance_id, node.tag, (node.text or '').strip(),
+                  node.get('version'))
+                 for node in result['software']
+                 if node.tag in ('package', 'pattern')])
+            db.executemany('INSERT OR REPLACE INTO appliance_repositories '
+                           'VALUES (?, ?, ?, ?, ?, ?)',
+                [(appliance_id, r.id, r.name, r.type, r.base_system,
+                  r.base_url) for r in result['repositories']])
+            db.executemany('INSERT OR REPLACE INTO overlay_files VALUES '
+                           '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(f.id, appliance_id, f.filename, f.path, f.owner, f.group,
+                  f.permissions, _column(f.enabled), f.size, f.checksum,
+                  f.checksum_type, f.download_url)
+                 for f in result['overlay_files']])
+            db.executemany('INSERT OR REPLACE INTO gpg_keys '
+                           'VALUES (?, ?, ?, ?, ?)',
+                [(k.id, appliance_id, k.name, k.target, k.key)
+                 for k in result['gpg_keys']])
+
+        if 'builds' in result:
+            stats['builds'] += 1
+            fields = [f[0] for f in studiotypes.Build.fields]
+            builds = result['builds']
+            db.execute('DELETE FROM builds WHERE appliance_id = ? '
+                       'AND id NOT IN (%s)' % ','.join('?' * len(builds)),
+                       [appliance_id] + [b.id for b in builds])
+            finished = set(row[0] for row in db.execute(
+                "SELECT id FROM builds WHERE appliance_id = ? "
+                "AND state = 'finished'", (appliance_id,)))
+            db.executemany('INSERT OR REPLACE INTO builds (appliance_id, %s) '
+                           'VALUES (%s)' % (', '.join(fields),
+                                            ', '.join('?' * (len(fields) + 1))),
+                [(appliance_id,) + _row(b, fields) for b in builds
+                 if b.id not in finished])
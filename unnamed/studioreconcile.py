@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+"""
+Desired state reconciliation for SUSE Studio appliances.
+
+ApplianceReconciler compares a spec with the current configuration of an
+appliance - fetched once - and applies the smallest set of API calls that
+makes the appliance match.  Where more than one change is needed, the
+software and repository lists are replaced with a single PUT instead of
+one command per item, the PUT is built from the fetched list so nodes and
+attributes the reconciler doesn't know about are sent back unchanged.
+
+A spec is a dict, each key that is present is authoritative for that part
+of the appliance, keys that are left out are not touched:
+
+spec = {
+    'repositories': [6343, 6345],
+    'packages': ['vim', ('sysvinit', '2.86-200.1')],
+    'patterns': ['base'],
+    'banned': ['nano'],
+    'unbanned': ['emacs'],
+    'gpg_keys': {'C93A9535': ('rpm', key_text)},
+}
+
+packages and patterns may also be a {name: version} dict, a version of
+None accepts whatever version the appliance has.
+
+The API doesn't report which packages are banned, so banned and unbanned
+are not diffed: every listed package gets a ban_package / unban_package
+command (both are harmless to repeat) and packages that aren't listed
+are left as they are.
+
+Basic Usage:
+import studioapi, studioreconcile
+
+studio = studioapi.StudioAPI(connection)
+reconciler = studioreconcile.ApplianceReconciler(studio)
+actions = reconciler.reconcile(appliance_id, spec)
+
+"""
+__all__ = ['ApplianceReconciler']
+__license__ = 'GPL v.2 http://www.gnu.org/licenses/gpl.txt'
+
+import copy
+
+from studioapi import ET
+
+
+def _text(elem, tag):
+    value = elem.findtext(tag)
+    if value is None:
+        return ''
+    return value.strip()
+
+def _versions(items):
+    """{name: version} from a list of names / (name, version) or a dict"""
+    if isinstance(items, dict):
+        return dict(items)
+    versions = {}
+    for item in items:
+        if isinstance(item, tuple):
+            versions[item[0]] = item[1]
+        else:
+            versions[item] = None
+    return versions
+
+def _software_xml(software, wanted):
+    """a copy of the software list with the package / pattern nodes of the
+    tags in wanted made to match it, other nodes and attributes are kept
+    """
+    root = ET.Element(software.tag, dict(software.items()))
+    root.text = software.text
+    seen = set()
+    for node in software:
+        want = wanted.get(node.tag)
+        if want is not None and node.text:
+            name = node.text.strip()
+            if name not in want:
+                continue
+            seen.add((node.tag, name))
+            node = copy.deepcopy(node)
+            if want[name]:
+                node.set('version', want[name])
+        else:
+            node = copy.deepcopy(node)
+        root.append(node)
+    for tag, want in sorted(wanted.items()):
+        for name, version in sorted(want.items()):
+            if (tag, name) not in seen:
+                node = ET.SubElement(root, tag)
+                node.text = name
+                if version:
+                    node.set('version', version)
+    return root
+
+
+class ApplianceReconciler:
+    """Brings appliances in line with a desired spec
+
+    Actions are (method name, arguments) tuples for the StudioAPI instance,
+    so a plan can be inspected before it is applied.
+    """
+    def __init__(self, studio):
+        self.studio = studio
+
+    def plan(self, appliance_id, spec):
+        """returns the actions needed to make appliance_id match spec
+        """
+        actions = []
+        if 'packages' in spec or 'patterns' in spec:
+            software = self.studio.get_appliance_software(appliance_id)
+            actions.extend(self._plan_software(appliance_id, software, spec))
+        for key, method in (('banned', 'ban_appliance_software_package'),
+                            ('unbanned', 'unban_appliance_software_package')):
+            for name in sorted(set(spec.get(key, ()))):
+                actions.append((method, (appliance_id, name)))
+        if 'repositories' in spec:
+            repositories = self.studio.get_appliance_repositories(appliance_id)
+            actions.extend(self._plan_repositories(appliance_id, repositories,
+                                                   spec['repositories']))
+        if 'gpg_keys' in spec:
+            keys = self.studio.get_appliance_gpg_keys(appliance_id)
+            actions.extend(self._plan_gpg_keys(appliance_id, keys,
+                                               spec['gpg_keys']))
+        return actions
+
+    def apply(self, actions):
+        """run the actions in order, returns their results
+        """
+        return [getattr(self.studio, name)(*args) for name, args in actions]
+
+    def reconcile(self, appliance_id, spec, dry_run=False):
+        """plan and (unless dry_run) apply, returns the actions
+        """
+        actions = self.plan(appliance_id, spec)
+        if not dry_run:
+            self.apply(actions)
+        return actions
+
+    def _plan_software(self, appliance_id, software, spec):
+        current = {'package': {}, 'pattern': {}}
+        for node in software:
+            if node.tag in current and node.text:
+                current[node.tag][node.text.strip()] = node.get('version')
+
+        wanted = {}
+        changes = []
+        for tag, key, add, remove in (
+            ('package', 'packages', 'add_appliance_software_package',
+             'remove_appliance_software_package'),
+            ('pattern', 'patterns', 'add_appliance_software_pattern',
+             'remove_appliance_software_pattern')):
+            if key not in spec:
+                continue
+            have = current[tag]
+            want = wanted[tag] = _versions(spec[key])
+            for name, version in sorted(want.items()):
+                if name not in have or (version and version != have[name]):
+                    changes.append((add, (appliance_id, name, version or '')))
+            for name in sorted(have):
+                if name not in want:
+                    changes.append((remove, (appliance_id, name)))
+
+        actions = []
+        if len(changes) == 1:
+            actions.extend(changes)
+        elif changes:
+            actions.append(('set_appliance_software', (appliance_id,
+                _software_xml(software, wanted))))
+        return actions
+
+    def _plan_repositories(self, appliance_id, repositories, wanted):
+        have = [_text(r, 'id') for r in repositories.findall('repository')]
+        want = [str(r).strip() for r in wanted]
+        added = [r for r in want if r not in have]
+        removed = [r for r in have if r not in want]
+
+        if len(added) + len(removed) == 1:
+            if added:
+                return [('add_appliance_repository', (appliance_id, added[0]))]
+            return [('remove_appliance_repository', (appliance_id, removed[0]))]
+        if not added and not removed:
+            return []
+
+        root = ET.Element('repositories', type='array')
+        for node in repositories.findall('repository'):
+            if _text(node, 'id') not in removed:
+                root.append(node)
+        for repo_id in added:
+            ET.SubElement(ET.SubElement(root, 'repository'), 'id').text = repo_id
+        return [('_set_appliance_repositories', (appliance_id, root))]
+
+    def _plan_gpg_keys(self, appliance_id, keys, wanted):
+        have = dict((_text(k, 'name'), k) for k in keys.findall('gpg_key'))
+        actions = []
+        for name, (target, key) in sorted(wanted.items()):
+            node = have.get(name)
+            if node is not None:
+                if (_text(node, 'target') == target
+                    and _text(node, 'key') == key.strip()):
+                    continue
+                actions.append(('delete_appliance_gpg_key',
+                                (appliance_id, _text(node, 'id'))))
+            actions.append(('upload_appliance_gpg_key',
+                            (appliance_id, name, target, key)))
+        for name, node in sorted(have.items()):
+            if name not in wanted:
+                actions.append(('delete_appliance_gpg_key',
+                                (appliance_id, _text(node, 'id'))))
+        return actions
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+
+"""
+Incremental sync of local files to SUSE Studio.
+
+OverlaySync maps a local directory tree onto the overlay files of an
+appliance: a file below the tree at etc/foo.conf becomes the overlay file
+foo.conf in /etc.  The appliance's files are listed once, and only what
+differs is sent - new files are uploaded, files whose size or md5 changed
+are replaced, and files whose owner, group, permissions or enabled flag
+changed only get their meta data updated.  Files are sent in parallel.
+
+RpmSync does the same for the user RPM repository of a base system: the
+local RPMs are hashed in parallel and compared with the checksums from
+get_base_system_rpms, unchanged ones are skipped, changed ones updated,
+new ones uploaded and (optionally) ones that are gone deleted.
+
+Basic Usage:
+import studioapi, studiosync
+
+studio = studioapi.StudioAPI(connection)
+sync = studiosync.OverlaySync(studio)
+actions = sync.sync(appliance_id, 'overlay/')
+
+rpms = studiosync.RpmSync(studio)
+actions = rpms.sync('SLES11_SP1', 'dist/rpms/')
+
+"""
+__all__ = ['OverlaySync', 'RpmSync']
+__license__ = 'GPL v.2 http://www.gnu.org/licenses/gpl.txt'
+
+import os
+import stat
+import hashlib
+import posixpath
+
+from studioapi import StudioError, StudioUtils
+
+
+def _md5(filename, blocksize=65536):
+    return _digest(filename, 'md5', blocksize)
+
+def _digest(filename, algorithm, blocksize=65536):
+    h = hashlib.new(algorithm)
+    with open(filename, 'rb') as fd:
+        for block in iter(lambda: fd.read(blocksize), ''):
+            h.update(block)
+    return h.hexdigest()
+
+def _text(elem, tag):
+    value = elem.findtext(tag)
+    if value is None:
+        return ''
+    return value.strip()
+
+def _apply(studio, work, max_workers):
+    """run work - (key, [(function, args)]) items, each list in order, the
+    lists in parallel - raises the first error once everything has run
+    """
+    def run(key, steps):
+        for function, args in steps:
+            function(*args)
+    errors = [error for key, result, error in studio.batch(run, work,
+                                                           max_workers)
+              if error is not None]
+    if errors:
+        raise errors[0]
+
+
+class OverlaySync:
+    """Keeps the overlay files of appliances in line with local trees
+
+        Arguments:
+
+            studio - StudioAPI instance
+            max_workers (optional) - number of files sent at once
+
+    Actions are (action, local file, file id, meta data) tuples, action
+    being 'upload', 'replace', 'metadata' or 'delete'.
+    """
+    def __init__(self, studio, max_workers=4):
+        self.studio = studio
+        self.max_workers = max_workers
+
+    def local_files(self, directory, root='/', owner='root', group='root'):
+        """{(path, filename): (local file, size, meta data)} for the regular
+        files below directory, permissions are taken from the files
+        """
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames.sort()
+            relative = os.path.relpath(dirpath, directory)
+            path = posixpath.normpath(posixpath.join(root,
+                relative.replace(os.sep, '/')))
+            for filename in sorted(filenames):
+                local = os.path.join(dirpath, filename)
+                st = os.stat(local)
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                files[(path, filename)] = (local, st.st_size, {
+                    'owner': owner, 'group': group,
+                    'permissions': '%o' % stat.S_IMODE(st.st_mode),
+                    'enabled': 'true'})
+        return files
+
+    def plan(self, appliance_id, directory, root='/', owner='root',
+        group='root', delete=False):
+        """returns the actions that make the overlay files of appliance_id
+        match directory
+
+            Arguments:
+
+                appliance_id - Id of the appliance
+                directory - local tree, its top is root on the appliance
+                root (optional) - where the tree goes on the appliance
+                owner, group (optional) - for all files
+                delete (optional) - also delete overlay files below root
+                                    that aren't in directory
+        """
+        local = self.local_files(directory, root, owner, group)
+        remote = {}
+        for node in self.studio.get_appliance_overlay_files(
+            appliance_id).findall('file'):
+            path = posixpath.normpath(_text(node, 'path') or '/')
+            remote[(path, _text(node, 'filename'))] = node
+
+        actions = []
+        for key in sorted(local):
+            filename, size, meta = local[key]
+            node = remote.get(key)
+            if node is None:
+                actions.append(('upload', filename, None, dict(meta,
+                    path=key[0], filename=key[1])))
+                continue
+            file_id = _text(node, 'id')
+            checksum = node.find('checksum')
+            if (_text(node, 'size') != str(size)
+                or checksum is None
+                or checksum.get('type', 'md5') != 'md5'
+                or (checksum.text or '').strip().lower() != _md5(filename)):
+                actions.append(('replace', filename, file_id, None))
+            changed = dict((name, value) for name, value in meta.items()
+                           if not self._same(name, _text(node, name), value))
+            if changed:
+                actions.append(('metadata', filename, file_id, changed))
+        if delete:
+            top = posixpath.normpath(root)
+            for key in sorted(set(remote) - set(local)):
+                if key[0] == top or key[0].startswith(top.rstrip('/') + '/'):
+                    actions.append(('delete', None, _text(remote[key], 'id'),
+                                    None))
+        return actions
+
+    @staticmethod
+    def _same(name, remote, local):
+        if name == 'permissions':
+            try:
+                return int(remote, 8) == int(local, 8)
+            except ValueError:
+                return False
+        return remote == local
+
+    def apply(self, appliance_id, actions):
+        """run the actions, the files in parallel
+        """
+        work = {}
+        for action, filename, file_id, meta in actions:
+            key = file_id or filename
+            work.setdefault(key, []).append(
+                self._step(appliance_id, action, filename, file_id, meta))
+        _apply(self.studio, sorted(work.items()), self.max_workers)
+
+    def sync(self, appliance_id, directory, root='/', owner='root',
+        group='root', delete=False, dry_run=False):
+        """plan and (unless dry_run) apply, returns the actions
+        """
+        actions = self.plan(appliance_id, directory, root, owner, group,
+                            delete)
+        if not dry_run:
+            self.apply(appliance_id, actions)
+        return actions
+
+    def _step(self, appliance_id, action, filename, file_id, meta):
+        studio = self.studio
+        if action == 'upload':
+            return (_upload, (studio, appliance_id, filename, meta))
+        if action == 'replace':
+            return (_replace, (studio, file_id, filename))
+        if action == 'metadata':
+            return (studio.add_overlay_file_metadata,
+                    (file_id, StudioUtils.overlay_file_xml(**meta)))
+        if action == 'delete':
+            return (studio.delete_overlay_file, (file_id,))
+        raise StudioError, "unknown overlay action %s" % action
+
+
+def _upload(studio, appliance_id, filename, meta):
+    with open(filename, 'rb') as fd:
+        return studio.upload_appliance_overlay_file(appliance_id, fd, **meta)
+
+def _replace(studio, file_id, filename):
+    with open(filename, 'rb') as fd:
+        return studio.replace_overlay_file(file_id, fd)
+
+
+class RpmSync:
+    """Keeps the user RPMs of a base system in line with a local directory
+
+        Arguments:
+
+            studio - StudioAPI instance
+            max_workers (optional) - number of files hashed / sent at once
+
+    Actions are (action, local file, rpm id) tuples, action being
+    'upload', 'update' or 'delete'.  Only files ending in suffixes are
+    synced, in the directory and in the repository.
+    """
+    suffixes = ('.rpm',)
+
+    def __init__(self, studio, max_workers=4):
+        self.studio = studio
+        self.max_workers = max_workers
+
+    def plan(self, base_system, directory, delete=False):
+        """returns the actions that make the RPMs of base_system match the
+        files in directory (by file name and checksum)
+        """
+        local = dict((name, os.path.join(directory, name))
+                     for name in sorted(os.listdir(directory))
+                     if name.endswith(self.suffixes)
+                     and os.path.isfile(os.path.join(directory, name)))
+        remote = {}
+        for node in self.studio.get_base_system_rpms(base_system).findall('rpm'):
+            remote.setdefault(_text(node, 'filename'), node)
+
+        # only files that may be unchanged need hashing
+        to_hash = []
+        for name, filename in local.items():
+            node = remote.get(name)
+            if node is None or node.find('checksum') is None:
+                continue
+            if _text(node, 'size') == str(os.path.getsize(filename)):
+                to_hash.append((filename,
+                    node.find('checksum').get('type', 'md5').lower()))
+        digests = {}
+        for (filename, algorithm), digest, error in self.studio.batch(
+            _digest, to_hash, self.max_workers):
+            if error is not None:
+                raise error
+            digests[filename] = digest
+
+        actions = []
+        for name, filename in sorted(local.items()):
+            node = remote.get(name)
+            if node is None:
+                actions.append(('upload', filename, None))
+            elif digests.get(filename) != (node.findtext('checksum') or
+                                           '').strip().lower():
+                actions.append(('update', filename, _text(node, 'id')))
+        if delete:
+            # archives and other entries that plan doesn't upload are kept
+            for name in sorted(set(remote) - set(local)):
+                if name.endswith(self.suffixes):
+                    actions.append(('delete', None, _text(remote[name], 'id')))
+        return actions
+
+    def apply(self, base_system, actions):
+        """run the actions in parallel
+        """
+        work = []
+        for action, filename, rpm_id in actions:
+            if action == 'upload':
+                step = (_upload_rpm, (self.studio, base_system, filename))
+            elif action == 'update':
+                step = (_update_rpm, (self.studio, rpm_id, filename))
+            elif action == 'delete':
+                step = (self.studio.delete_rpm, (rpm_id,))
+            else:
+                raise StudioError, "unknown rpm action %s" % action
+            work.append((filename or rpm_id, [step]))
+        _apply(self.studio, work, self.max_workers)
+
+    def sync(self, base_system, directory, delete=False, dry_run=False):
+        """plan and (unless dry_run) apply, returns the actions
+        """
+        actions = self.plan(base_system, directory, delete)
+        if not dry_run:
+            self.apply(base_system, actions)
+        return actions
+
+
+def _upload_rpm(studio, base_system, filename):
+    with open(filename, 'rb') as fd:
+        return studio.upload_rpm(base_system, fd)
+
+def _update_rpm(studio, rpm_id, filename):
+    with open(filename, 'rb') as fd:
+        return studio.update_rpm(rpm_id, fd)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+"""
+Typed records for StudioAPI responses.
+
+StudioAPI returns ElementTree nodes.  The classes here turn those into
+compact __slots__ records, built once per response: ids, sizes and percent
+are ints, dates are datetimes, flags are bools, and strings that repeat
+across records (arch, version, state, ...) are interned.  The records
+don't keep the XML tree alive.
+
+Basic Usage:
+import studioapi, studiotypes
+
+studio = studioapi.StudioAPI(connection)
+appliances = studiotypes.records(studiotypes.Appliance,
+                                 studio.get_appliances())
+packages = studiotypes.records(studiotypes.Package,
+    studio.iter_appliance_installed_software(appliance_id))
+
+"""
+__all__ = ['Appliance', 'Build', 'RunningBuild', 'Package', 'Rpm',
+           'Repository', 'OverlayFile', 'GpgKey', 'Testdrive', 'records']
+__license__ = 'GPL v.2 http://www.gnu.org/licenses/gpl.txt'
+
+from datetime import datetime
+
+
+def _text(value):
+    if value is None:
+        return None
+    return value.strip()
+
+def _symbol(value):
+    """stripped and interned - for values shared by many records"""
+    if value is None:
+        return None
+    value = value.strip()
+    if isinstance(value, str):
+        return intern(value)
+    return value
+
+def _int(value):
+    if value is None or not value.strip():
+        return None
+    return int(value)
+
+def _bool(value):
+    if value is None:
+        return None
+    return value.strip().lower() == 'true'
+
+def _datetime(value):
+    if value is None or not value.strip():
+        return None
+    return datetime.strptime(value.strip(), '%Y-%m-%d %H:%M:%S UTC')
+
+
+def _value(elem, path):
+    """findtext with two extensions: '.' is the element's own text and
+    'path@attr' (or '@attr') is an attribute
+    """
+    if path == '.':
+        return elem.text
+    if '@' in path:
+        path, attr = path.split('@')
+        node = elem.find(path) if path else elem
+        if node is None:
+            return None
+        return node.get(attr)
+    return elem.findtext(path)
+
+
+class Record(object):
+    """Base class, subclasses list (attribute, path, converter) in fields
+    """
+    __slots__ = ()
+    fields = ()
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name))
+
+    @classmethod
+    def from_element(cls, elem, context=None):
+        record = cls.__new__(cls)
+        for name, path, convert in cls.fields:
+            setattr(record, name, convert(_value(elem, path)))
+        return record
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __eq__(self, other):
+        return (type(self) is type(other)
+                and self.__getstate__() == other.__getstate__())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join(
+            '%s=%r' % (name, getattr(self, name)) for name in self.__slots__))
+
+
+class Build(Record):
+    fields = (
+        ('id', 'id', _int),
+        ('version', 'version', _symbol),
+        ('state', 'state', _symbol),
+        ('expired', 'expired', _bool),
+        ('image_type', 'image_type', _symbol),
+        ('size', 'size', _int),
+        ('compressed_image_size', 'compressed_image_size', _int),
+        ('md5', 'checksum/md5', _text),
+        ('sha1', 'checksum/sha1', _text),
+        ('completed_at', 'completed_at', _datetime),
+        ('download_url', 'download_url', _text),
+    )
+    __slots__ = tuple(f[0] for f in fields)
+
+    @classmethod
+    def from_element(cls, elem, context=None):
+        record = super(Build, cls).from_element(elem)
+        if record.size is None:
+            # builds listed in an appliance report image_size instead
+            record.size = _int(elem.findtext('image_size'))
+        return record
+
+
+class Appliance(Record):
+    fields = (
+        ('id', 'id', _int),
+        ('name', 'name', _text),
+        ('arch', 'arch', _symbol),
+        ('type', 'type', _symbol),
+        ('last_edited', 'last_edited', _datetime),
+        ('estimated_raw_size', 'estimated_raw_size', _text),
+        ('estimated_compressed_size', 'estimated_compressed_size', _text),
+        ('edit_url', 'edit_url', _text),
+        ('icon_url', 'icon_url', _text),
+        ('basesystem', 'basesystem', _symbol),
+        ('uuid', 'uuid', _text),
+        ('parent_id', 'parent/id', _int),
+        ('parent_name', 'parent/name', _text),
+    )
+    __slots__ = tuple(f[0] for f in fields) + ('builds',)
+
+    @classmethod
+    def from_element(cls, elem, context=None):
+        record = super(Appliance, cls).from_element(elem)
+        record.builds = tuple(Build.from_element(b)
+                              for b in elem.findall('builds/build'))
+        return record
+
+
+class RunningBuild(Record):
+    fields = (
+        ('id', 'id', _int),
+        ('state', 'state', _symbol),
+        ('percent', 'percent', _int),
+        ('time_elapsed', 'time_elapsed', _int),
+        ('message', 'message', _symbol),
+    )
+    __slots__ = tuple(f[0] for f in fields)
+
+
+class Package(Record):
+    """A package or pattern (type), from a software list or software map
+
+    The repository fields are filled in when the record comes from
+    iter_appliance_installed_software / iter_appliance_software_search.
+    """
+    fields = (
+        ('name', '.', _symbol),
+        ('version', '@version', _symbol),
+        ('arch', '@arch', _symbol),
+        ('checksum', '@checksum', _text),
+        ('checksum_type', '@checksum_type', _symbol),
+    )
+    __slots__ = ('type',) + tuple(f[0] for f in fields) + (
+        'repository_id', 'repository_name')
+
+    @classmethod
+    def from_element(cls, elem, context=None):
+        record = super(Package, cls).from_element(elem)
+        record.type = intern(elem.tag)
+        if context is None:
+            record.repository_id = record.repository_name = None
+        else:
+            record.repository_id = _int(context.get('id'))
+            record.repository_name = _symbol(context.get('name'))
+        return record
+
+
+class Rpm(Record):
+    fields = (
+        ('id', 'id', _int),
+        ('filename', 'filename', _text),
+        ('size', 'size', _int),
+        ('archive', 'archive', _bool),
+        ('base_system', 'base_system', _symbol),
+        ('checksum', 'checksum', _text),
+        ('checksum_type', 'checksum@type', _symbol),
+    )
+    __slots__ = tuple(f[0] for f in fields)
+
+
+class Repository(Record):
+    fields = (
+        ('id', 'id', _int),
+        ('name', 'name', _text),
+        ('type', 'type', _symbol),
+        ('base_system', 'base_system', _symbol),
+        ('base_url', 'base_url', _text),
+        ('repotag', 'repotag', _text),
+        ('smt_name', 'smt_name', _symbol),
+        ('smt_target', 'smt_target', _symbol),
+    )
+    __slots__ = tuple(f[0] for f in fields)
+
+
+class OverlayFile(Record):
+    fields = (
+        ('id', 'id', _int),
+        ('filename', 'filename', _text),
+        ('path', 'path', _text),
+        ('owner', 'owner', _symbol),
+        ('group', 'group', _symbol),
+        ('permissions', 'permissions', _symbol),
+        ('enabled', 'enabled', _bool),
+        ('size', 'size', _int),
+        ('checksum', 'checksum', _text),
+        ('checksum_type', 'checksum@type', _symbol),
+        ('download_url', 'download_url', _text),
+    )
+    __slots__ = tuple(f[0] for f in fields)
+
+
+class GpgKey(Record):
+    fields = (
+        ('id', 'id', _int),
+        ('name', 'name', _text),
+        ('target', 'target', _symbol),
+        ('key', 'key', _text),
+    )
+    __slots__ = tuple(f[0] for f in fields)
+
+
+class Testdrive(Record):
+    fields = (
+        ('id', 'id', _int),
+        ('state', 'state', _symbol),
+        ('build_id', 'build_id', _int),
+        ('url', 'url', _text),
+        ('vnc_host', 'server/vnc/host', _text),
+        ('vnc_port', 'server/vnc/port', _int),
+        ('vnc_password', 'server/vnc/password', _text),
+    )
+    __slots__ = tuple(f[0] for f in fields)
+
+
+def records(cls, elements):
+    """Build a list of cls records
+
+        Arguments:
+
+            cls - the record class
+            elements - a list response (e.g. from get_appliances), or the
+                       elements yielded by an iter_* method
+
+    The (repository, package) pairs from the software map iterators are
+    accepted too.
+    """
+    result = []
+    for elem in elements:
+        if isinstance(elem, tuple):
+            context, elem = elem
+            result.append(cls.from_element(elem, context))
+        else:
+            result.append(cls.from_element(elem))
+    return result